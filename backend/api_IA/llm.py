@@ -4,18 +4,111 @@ export PYTHONPATH=/opt/data/p82garpr/venv_packages:$PYTHONPATH
 python -m uvicorn apiLLM:app --host 0.0.0.0 --port 8001
 """
 
-from typing import Union, Dict, Any, List
-from fastapi import FastAPI, HTTPException
+from typing import Union, Dict, Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
+from collections import deque
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import asyncio
+import hashlib
+import heapq
+import itertools
 import json
-import requests
+import httpx
 import logging
+import math
+import os
+import sqlite3
+import threading
+import time
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Multi-LLM API", description="API para interactuar con múltiples modelos LLM", debug=True)
+# Conexiones simultáneas máximas con cada servidor LLM (se puede sobrescribir por modelo con
+# la clave "max_connections" de LLM_CONFIG). Las peticiones que no caben esperan a que se
+# libere una conexión hasta LLM_POOL_TIMEOUT segundos
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "8"))
+LLM_POOL_TIMEOUT = float(os.getenv("LLM_POOL_TIMEOUT", "60"))
+# Servidores Ollama separados por comas. Todos los modelos se sirven desde todos ellos salvo
+# que su entrada de LLM_CONFIG indique otras "urls"
+LLM_OLLAMA_HOSTS = [host.strip().rstrip("/") for host in os.getenv("LLM_OLLAMA_HOSTS", "http://localhost:11434").split(",") if host.strip()]
+OLLAMA_GENERATE_URLS = [f"{host}/api/generate" for host in LLM_OLLAMA_HOSTS]
+# Cada petición va al servidor con menos peticiones en curso, pero un servidor que aún no
+# tiene el modelo en memoria (según /api/ps, consultado como mucho cada LLM_PS_INTERVAL
+# segundos) cuenta como si tuviera LLM_COLD_HOST_PENALTY peticiones más, porque cargarlo es lento
+LLM_PS_INTERVAL = float(os.getenv("LLM_PS_INTERVAL", "10"))
+LLM_COLD_HOST_PENALTY = int(os.getenv("LLM_COLD_HOST_PENALTY", "2"))
+# Un servidor con LLM_EJECTION_THRESHOLD fallos seguidos (conexión o HTTP 5xx) deja de recibir
+# peticiones durante LLM_EJECTION_TIME segundos, tiempo que se multiplica si vuelve a fallar
+# tras readmitirlo (hasta 10 veces)
+LLM_EJECTION_THRESHOLD = int(os.getenv("LLM_EJECTION_THRESHOLD", "3"))
+LLM_EJECTION_TIME = float(os.getenv("LLM_EJECTION_TIME", "30"))
+# Un servidor que responde 404 (modelo no instalado) no recibe peticiones de ese modelo
+# durante LLM_MISSING_MODEL_TIME segundos, salvo que no lo tenga ningún otro servidor
+LLM_MISSING_MODEL_TIME = float(os.getenv("LLM_MISSING_MODEL_TIME", "300"))
+# Residencia de los modelos en memoria de Ollama. LLM_PRELOAD son los modelos (separados por
+# comas) que se cargan al arrancar. Dentro de las franjas de LLM_KEEP_WARM_SCHEDULE, con días
+# ISO (1 = lunes) y horas locales, p. ej. "1-5 08:00-21:00; 6 09:00-14:00", se pide a Ollama
+# que conserve los modelos hasta el final de la franja y cada LLM_RESIDENCY_INTERVAL segundos
+# se vuelven a cargar los de LLM_PRELOAD que se hayan descargado. Fuera de las franjas solo se
+# envía keep_alive si se define LLM_KEEP_ALIVE (formato de duración de Ollama); si no, manda
+# la configuración del servidor (OLLAMA_KEEP_ALIVE)
+LLM_PRELOAD = [name.strip() for name in os.getenv("LLM_PRELOAD", "").split(",") if name.strip()]
+LLM_KEEP_WARM_SCHEDULE = os.getenv("LLM_KEEP_WARM_SCHEDULE", "")
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE") or None
+LLM_RESIDENCY_INTERVAL = float(os.getenv("LLM_RESIDENCY_INTERVAL", "60"))
+# Contexto en tokens con el que se cargan los modelos de Ollama (clave "num_ctx" de LLM_CONFIG
+# para cambiarlo por modelo). Si el prompt más los max_tokens de la respuesta y un margen de
+# LLM_CONTEXT_MARGIN tokens no caben, se recorta por el centro la parte variable del prompt
+# ("truncatable", normalmente la solución del alumno) en lugar de dejar que Ollama descarte
+# el principio, donde están las instrucciones
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "8192"))
+LLM_CONTEXT_MARGIN = int(os.getenv("LLM_CONTEXT_MARGIN", "64"))
+# Sin tokenizador (clave "tokenizer" de LLM_CONFIG con un modelo de Hugging Face) los tokens se
+# estiman con estos caracteres por token, que se recalibran con los recuentos de Ollama
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "3.0"))
+TRUNCATION_MARKER = "\n[... {removed} caracteres omitidos ...]\n"
+# Segundos máximos para cargar un modelo en memoria
+LLM_LOAD_TIMEOUT = float(os.getenv("LLM_LOAD_TIMEOUT", "300"))
+# Segundos máximos entre dos fragmentos de la respuesta del servidor LLM
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+# Cada cuántos segundos se comprueba si el cliente sigue esperando la respuesta
+LLM_DISCONNECT_POLL_INTERVAL = float(os.getenv("LLM_DISCONNECT_POLL_INTERVAL", "0.5"))
+# Generaciones simultáneas por modelo (se puede sobrescribir con la clave "max_concurrent"
+# de LLM_CONFIG). Las demás esperan en una cola por prioridad: la cabecera X-Priority
+# indica "interactive" (por defecto) o "batch", y las interactivas se atienden antes
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "2"))
+PRIORITIES = ["interactive", "batch"]
+# Segundos máximos de espera en la cola por prioridad (0 = sin límite); la cabecera
+# X-Deadline los sobrescribe. Si no se pueden cumplir se responde 429
+LLM_DEADLINES = {
+    "interactive": float(os.getenv("LLM_DEADLINE_INTERACTIVE", "120")),
+    "batch": float(os.getenv("LLM_DEADLINE_BATCH", "0"))
+}
+
+# Cache persistente de respuestas en SQLite. Se aplica a las consultas sin streaming con
+# temperature 0 o con "cache": true; al superar LLM_CACHE_MAX_MB se descartan las
+# respuestas usadas hace más tiempo
+LLM_CACHE = os.getenv("LLM_CACHE", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "256"))
+# Los endpoints /admin exigen la cabecera X-Admin-Token con este valor. Si no se define,
+# la administración está desactivada y responden 403
+LLM_ADMIN_TOKEN = os.getenv("LLM_ADMIN_TOKEN")
+
+# Consultas de un lote (/chat/{llm_name}/batch) que se envían a la vez por defecto, máximo
+# que puede pedir el cliente y número máximo de consultas por lote
+LLM_BATCH_PARALLELISM = int(os.getenv("LLM_BATCH_PARALLELISM", "4"))
+LLM_BATCH_MAX_PARALLELISM = int(os.getenv("LLM_BATCH_MAX_PARALLELISM", "16"))
+LLM_BATCH_MAX_ITEMS = int(os.getenv("LLM_BATCH_MAX_ITEMS", "500"))
+
+# Agrupar las peticiones idénticas concurrentes en una única generación
+LLM_COALESCING = os.getenv("LLM_COALESCING", "true").lower() in ("1", "true", "yes")
 
 # Modelos Pydantic para las solicitudes
 class Item(BaseModel):
@@ -26,46 +119,439 @@ class Item(BaseModel):
     top_p: float = 0.9
     top_k: int = 40
     images: List[str] = []  # Lista de imágenes en base64
+    stream: bool = False  # Reenviar la respuesta de Ollama a medida que se genera (NDJSON)
+    cache: Optional[bool] = None  # Usar la cache de respuestas (por defecto solo con temperature 0)
+    truncatable: Optional[str] = None  # Fragmento del prompt que se puede recortar si no cabe en el contexto
+
+class BatchRequest(BaseModel):
+    items: List[Item]
+    parallelism: Optional[int] = None  # Consultas simultáneas (por defecto LLM_BATCH_PARALLELISM)
+    stream: bool = False  # Devolver cada resultado en NDJSON según termina, en vez de todos en orden al final
 
 # Configuración de los diferentes modelos LLM
 LLM_CONFIG = {
     "gemma3:4b": {
-        "url": "http://localhost:11434/api/generate",
+        "urls": OLLAMA_GENERATE_URLS,
         "model_suffix": ":4b",
         "headers": {"Content-Type": "application/json"},
         "processor": "process_ollama_response"
     },
     "gemma3:12b": {
-        "url": "http://localhost:11434/api/generate",
+        "urls": OLLAMA_GENERATE_URLS,
         "model_suffix": ":12b",
         "headers": {"Content-Type": "application/json"},
         "processor": "process_ollama_response"
     },
     "llama3": {
-        "url": "http://localhost:11434/api/generate",
+        "urls": OLLAMA_GENERATE_URLS,
         "model_suffix": "",
         "headers": {"Content-Type": "application/json"},
         "processor": "process_ollama_response"
     },
     "deepseek-coder-v2:latest": {
-        "url": "http://localhost:11434/api/generate",  # Cambiado a Ollama
+        "urls": OLLAMA_GENERATE_URLS,
         "model_suffix": "",
         "headers": {"Content-Type": "application/json"},
         "processor": "process_ollama_response"  # Cambiado al procesador de Ollama
     }
 }
 
+# Un cliente HTTP asíncrono con su pool de conexiones por servidor LLM
+clients: Dict[str, httpx.AsyncClient] = {}
+
+def model_urls(llm_name: str) -> List[str]:
+    """URLs de generación de un modelo: su lista "urls" o su única "url" """
+    config = LLM_CONFIG[llm_name]
+    return config.get("urls") or [config["url"]]
+
+def backend_origin(url: str) -> str:
+    """Servidor (esquema, host y puerto) de la URL de un modelo"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def get_client(llm_name: str, origin: Optional[str] = None) -> httpx.AsyncClient:
+    """
+    Devuelve el cliente de un servidor del modelo (por defecto el primero), creándolo si no
+    existe. Los modelos del mismo servidor comparten cliente, de modo que las conexiones se
+    reutilizan entre peticiones y su número está limitado por servidor.
+    """
+    config = LLM_CONFIG[llm_name]
+    origin = origin or backend_origin(model_urls(llm_name)[0])
+    if origin not in clients:
+        max_connections = config.get("max_connections", LLM_MAX_CONNECTIONS)
+        clients[origin] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=10, pool=LLM_POOL_TIMEOUT)
+        )
+        logger.info(f"Cliente para {origin} con un máximo de {max_connections} conexiones")
+    return clients[origin]
+
+def model_tag(model: str) -> str:
+    """Nombre del modelo tal como lo lista Ollama (con la etiqueta :latest por defecto)"""
+    return model if ":" in model else f"{model}:latest"
+
+class OllamaHost:
+    """
+    Servidor Ollama compartido por los modelos configurados en él. Lleva la cuenta de las
+    peticiones en curso y de los modelos que tiene en memoria, y se expulsa temporalmente
+    tras LLM_EJECTION_THRESHOLD fallos seguidos. La expulsión es pasiva: solo cuenta el
+    resultado de las peticiones reales, sin sondas de salud.
+    """
+    def __init__(self, origin: str):
+        self.origin = origin
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.backoff = 0  # expulsiones seguidas sin ninguna petición correcta entre ellas
+        self.ejected_until = 0.0
+        self.loaded: set = set()
+        self.missing: Dict[str, float] = {}  # modelos no instalados (404) y hasta cuándo se evitan
+        self.last_used: Dict[str, float] = {}  # última petición terminada por modelo (epoch)
+        self.ps_checked_at: Optional[float] = None
+    
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+    
+    def start(self):
+        self.outstanding += 1
+        self.requests += 1
+    
+    def lacks(self, model: str) -> bool:
+        """Indica si el servidor respondió hace poco que no tiene el modelo"""
+        return self.missing.get(model_tag(model), 0) > time.monotonic()
+    
+    def finish(self, model: str, failed: Optional[bool], status_code: Optional[int] = None):
+        """
+        Registra el final de una petición (failed=None si se canceló antes de obtener
+        respuesta) y expulsa el servidor si acumula demasiados fallos. Solo una respuesta
+        2xx indica que el modelo está en memoria; un 404 indica que no está instalado
+        """
+        self.outstanding -= 1
+        if failed is None:
+            return
+        tag = model_tag(model)
+        self.last_used[tag] = time.time()
+        if not failed:
+            self.consecutive_failures = 0
+            self.backoff = 0
+            if status_code is not None and 200 <= status_code < 300:
+                self.loaded.add(tag)
+                self.missing.pop(tag, None)
+            elif status_code == 404:
+                self.loaded.discard(tag)
+                self.missing[tag] = time.monotonic() + LLM_MISSING_MODEL_TIME
+                logger.warning(f"{tag} no está instalado en {self.origin}: no se le envían peticiones durante {LLM_MISSING_MODEL_TIME:.0f}s")
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= LLM_EJECTION_THRESHOLD and not self.ejected:
+            self.consecutive_failures = 0
+            self.ejections += 1
+            self.backoff = min(self.backoff + 1, 10)
+            self.ejected_until = time.monotonic() + LLM_EJECTION_TIME * self.backoff
+            logger.warning(f"Servidor {self.origin} expulsado durante {LLM_EJECTION_TIME * self.backoff:.0f}s tras varios fallos seguidos")
+    
+    def status(self) -> dict:
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "ejected_for_s": round(max(0.0, self.ejected_until - time.monotonic()), 1),
+            "loaded_models": sorted(self.loaded),
+            "missing_models": sorted(tag for tag in self.missing if self.lacks(tag))
+        }
+
+# Estado de cada servidor LLM, por origen
+hosts: Dict[str, OllamaHost] = {}
+_host_rotation = itertools.count()
+
+def get_host(origin: str) -> OllamaHost:
+    if origin not in hosts:
+        hosts[origin] = OllamaHost(origin)
+    return hosts[origin]
+
+async def fetch_loaded(llm_name: str, host: OllamaHost) -> List[Dict[str, Any]]:
+    """Consulta /api/ps del servidor y devuelve los modelos que tiene en memoria ([] si falla)"""
+    # Se marca antes de consultar para que las peticiones concurrentes no repitan la consulta
+    host.ps_checked_at = time.monotonic()
+    try:
+        response = await get_client(llm_name, host.origin).get(f"{host.origin}/api/ps", timeout=2)
+        response.raise_for_status()
+        models = response.json().get("models", [])
+    except (httpx.HTTPError, ValueError) as e:
+        logger.debug(f"No se pudieron consultar los modelos cargados en {host.origin}: {str(e)}")
+        return []
+    host.loaded = {model_tag(m.get("name") or m.get("model", "")) for m in models}
+    return models
+
+async def refresh_loaded(llm_name: str, host: OllamaHost):
+    """Actualiza los modelos en memoria del servidor si la información es antigua"""
+    if host.ps_checked_at is None or time.monotonic() - host.ps_checked_at >= LLM_PS_INTERVAL:
+        await fetch_loaded(llm_name, host)
+
+async def select_host(llm_name: str, model: str, exclude: List[str]) -> Tuple[OllamaHost, str]:
+    """
+    Elige el servidor del modelo con menos peticiones en curso, penalizando los que no lo
+    tienen en memoria. Los servidores expulsados solo se usan si lo están todos.
+    """
+    candidates = [
+        (get_host(backend_origin(url)), url)
+        for url in model_urls(llm_name)
+        if backend_origin(url) not in exclude
+    ]
+    if not candidates:
+        raise httpx.ConnectError(f"No quedan servidores disponibles para {llm_name}")
+    # Evitar los servidores que no tienen el modelo instalado
+    candidates = [c for c in candidates if not c[0].lacks(model)] or candidates
+    available = [c for c in candidates if not c[0].ejected] or [min(candidates, key=lambda c: c[0].ejected_until)]
+    if len(available) == 1:
+        return available[0]
+    
+    await asyncio.gather(*(refresh_loaded(llm_name, host) for host, _ in available))
+    tag = model_tag(model)
+    # Rotar el orden para repartir los empates
+    shift = next(_host_rotation) % len(available)
+    available = available[shift:] + available[:shift]
+    return min(available, key=lambda c: c[0].outstanding + (0 if tag in c[0].loaded else LLM_COLD_HOST_PENALTY))
+
+async def send_request(llm_name: str, payload: Dict[str, Any], stream: bool = False) -> Tuple[OllamaHost, httpx.Response]:
+    """
+    Envía el payload al mejor servidor del modelo, reintentando en los demás si no se puede
+    conectar. La petición cuenta como en curso en el servidor hasta llamar a `finish`.
+    """
+    config = LLM_CONFIG[llm_name]
+    if config["processor"] == "process_ollama_response":
+        # Se añade aquí y no en prepare_payload para que no cambie la clave de la consulta
+        keep_alive = residency.keep_alive()
+        if keep_alive is not None:
+            payload = {**payload, "keep_alive": keep_alive}
+    tried: List[str] = []
+    while True:
+        host, url = await select_host(llm_name, payload["model"], tried)
+        tried.append(host.origin)
+        client = get_client(llm_name, host.origin)
+        request = client.build_request("POST", url, headers=config["headers"], content=json.dumps(payload))
+        host.start()
+        try:
+            response = await client.send(request, stream=stream)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            host.finish(payload["model"], failed=True)
+            if len(tried) == len(model_urls(llm_name)):
+                raise
+            logger.warning(f"No se pudo conectar con {host.origin} para {llm_name}, se reintenta en otro servidor: {str(e)}")
+            continue
+        except httpx.HTTPError:
+            host.finish(payload["model"], failed=True)
+            raise
+        except BaseException:
+            host.finish(payload["model"], failed=None)
+            raise
+        return host, response
+
+def parse_schedule(spec: str) -> List[Tuple[set, int, int]]:
+    """
+    Convierte las franjas "días HH:MM-HH:MM" separadas por ";" en tuplas (días ISO, minuto
+    de inicio, minuto de fin). Los días van sueltos o en rangos: "1-5 08:00-21:00; 6,7 10:00-13:00"
+    """
+    windows = []
+    for part in spec.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            days_spec, hours = part.split()
+            days = set()
+            for days_range in days_spec.split(","):
+                first, _, last = days_range.partition("-")
+                days.update(range(int(first), int(last or first) + 1))
+            start, end = (int(h) * 60 + int(m) for h, m in (t.split(":") for t in hours.split("-")))
+        except ValueError:
+            raise ValueError(f"Franja de LLM_KEEP_WARM_SCHEDULE no válida: '{part}'")
+        if not days <= set(range(1, 8)) or not 0 <= start < end <= 24 * 60:
+            raise ValueError(f"Franja de LLM_KEEP_WARM_SCHEDULE no válida: '{part}'")
+        windows.append((days, start, end))
+    return windows
+
+class ResidencyManager:
+    """
+    Mantiene los modelos en memoria de Ollama para que las peticiones no esperen a que se
+    carguen: precarga los modelos indicados en todos sus servidores y, dentro de las franjas
+    configuradas, pide conservarlos hasta el final de la franja y los recarga si se descargan.
+    """
+    def __init__(self, preload: List[str], schedule: str = "", keep_alive: Optional[str] = None, interval: float = 60):
+        self.preload = preload
+        self.schedule = parse_schedule(schedule)
+        self.default_keep_alive = keep_alive
+        self.interval = interval
+        self.loads = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def warm_until(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Final de la franja en curso, o None si ahora no hay que mantener los modelos cargados"""
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        ends = [end for days, start, end in self.schedule if now.isoweekday() in days and start <= minute < end]
+        return midnight + timedelta(minutes=max(ends)) if ends else None
+    
+    def keep_alive(self, now: Optional[datetime] = None) -> Optional[Union[int, str]]:
+        """
+        Valor de keep_alive para Ollama: los segundos que quedan de franja o LLM_KEEP_ALIVE.
+        None si no hay que enviarlo (se usa el valor configurado en el servidor)
+        """
+        now = now or datetime.now()
+        end = self.warm_until(now)
+        return math.ceil((end - now).total_seconds()) if end else self.default_keep_alive
+    
+    async def load(self, llm_name: str) -> int:
+        """Carga el modelo en los servidores que no lo tienen en memoria y devuelve en cuántos lo ha cargado"""
+        config = LLM_CONFIG[llm_name]
+        loaded = 0
+        for url in model_urls(llm_name):
+            host = get_host(backend_origin(url))
+            if host.ejected:
+                continue
+            await fetch_loaded(llm_name, host)
+            if model_tag(llm_name) in host.loaded:
+                continue
+            # Una petición sin prompt solo carga el modelo
+            started = time.monotonic()
+            load_payload = {"model": llm_name, "options": {"num_ctx": context_length(llm_name)}}
+            keep_alive = self.keep_alive()
+            if keep_alive is not None:
+                load_payload["keep_alive"] = keep_alive
+            try:
+                response = await get_client(llm_name, host.origin).post(
+                    url,
+                    headers=config["headers"],
+                    content=json.dumps(load_payload),
+                    timeout=httpx.Timeout(LLM_LOAD_TIMEOUT, connect=10)
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                logger.warning(f"No se pudo cargar {llm_name} en {host.origin}: {str(e)}")
+                continue
+            host.loaded.add(model_tag(llm_name))
+            self.loads += 1
+            loaded += 1
+            logger.info(f"Modelo {llm_name} cargado en {host.origin} en {time.monotonic() - started:.1f}s")
+        return loaded
+    
+    async def load_all(self):
+        for llm_name in self.preload:
+            if llm_name not in LLM_CONFIG:
+                logger.warning(f"Modelo '{llm_name}' de LLM_PRELOAD no configurado")
+                continue
+            await self.load(llm_name)
+    
+    async def _run(self):
+        await self.load_all()
+        while self.schedule:
+            await asyncio.sleep(self.interval)
+            if self.warm_until() is not None:
+                await self.load_all()
+    
+    def start(self):
+        """Lanza la precarga y el mantenimiento de los modelos en segundo plano"""
+        if self.preload and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def status(self) -> Dict[str, Any]:
+        """Modelos en memoria de cada servidor, cuándo los descargará Ollama y cuánto llevan sin usarse"""
+        origins = {}
+        for llm_name in LLM_CONFIG:
+            for url in model_urls(llm_name):
+                origins.setdefault(backend_origin(url), llm_name)
+        ps = dict(zip(origins, await asyncio.gather(*(fetch_loaded(name, get_host(origin)) for origin, name in origins.items()))))
+        
+        now = time.time()
+        models = {}
+        for llm_name in LLM_CONFIG:
+            tag = model_tag(llm_name)
+            resident = []
+            for url in model_urls(llm_name):
+                host = get_host(backend_origin(url))
+                for info in ps[host.origin]:
+                    if model_tag(info.get("name") or info.get("model", "")) == tag:
+                        last_used = host.last_used.get(tag)
+                        resident.append({
+                            "host": host.origin,
+                            "expires_at": info.get("expires_at"),
+                            "size_vram": info.get("size_vram"),
+                            "idle_s": round(now - last_used, 1) if last_used else None
+                        })
+            idle = [entry["idle_s"] for entry in resident if entry["idle_s"] is not None]
+            models[llm_name] = {
+                "preload": llm_name in self.preload,
+                "resident": resident,
+                "idle_s": min(idle) if idle else None
+            }
+        end = self.warm_until()
+        return {
+            "keep_alive": self.keep_alive(),
+            "warm_until": end.isoformat() if end else None,
+            "loads": self.loads,
+            "models": models
+        }
+
+residency = ResidencyManager(LLM_PRELOAD, LLM_KEEP_WARM_SCHEDULE, LLM_KEEP_ALIVE, LLM_RESIDENCY_INTERVAL)
+
+async def close_clients():
+    """Cierra las conexiones con todos los servidores LLM"""
+    for client in list(clients.values()):
+        await client.aclose()
+    clients.clear()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    residency.start()
+    yield
+    await residency.stop()
+    await close_clients()
+    response_cache.close()
+
+app = FastAPI(title="Multi-LLM API", description="API para interactuar con múltiples modelos LLM", debug=True, lifespan=lifespan)
+
 # Funciones para procesar las respuestas de diferentes tipos de LLM
-def process_ollama_response(response: requests.Response) -> Dict[str, Any]:
+def ollama_usage(response_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Tokens del prompt y de la respuesta, y velocidad de generación, según Ollama"""
+    if "eval_count" not in response_data:
+        return None
+    completion_tokens = response_data["eval_count"]
+    eval_seconds = response_data.get("eval_duration", 0) / 1e9
+    return {
+        "prompt_tokens": response_data.get("prompt_eval_count", 0),
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": round(completion_tokens / eval_seconds, 1) if eval_seconds else None
+    }
+
+def process_ollama_response(response: httpx.Response) -> Dict[str, Any]:
     """Procesa la respuesta de los modelos de Ollama"""
     try:
         response_data = json.loads(response.text)
-        return {"response": response_data.get("response", "No se encontró respuesta")}
+        result = {"response": response_data.get("response", "No se encontró respuesta")}
+        usage = ollama_usage(response_data)
+        if usage:
+            result["usage"] = usage
+        return result
     except json.JSONDecodeError:
         logger.warning(f"Error al decodificar JSON de Ollama: {response.text[:100]}...")
         return {"response": "Error al procesar la respuesta", "raw": response.text}
 
-def process_deepseek_response(response: requests.Response) -> Dict[str, Any]:
+def process_deepseek_response(response: httpx.Response) -> Dict[str, Any]:
     """Procesa la respuesta del modelo DeepSeek"""
     try:
         return response.json()
@@ -87,8 +573,9 @@ def prepare_payload(llm_name: str, item: Item) -> Dict[str, Any]:
         payload = {
             "model": model_name,
             "prompt": item.prompt,
-            "stream": False,
+            "stream": item.stream,
             "options": {
+                "num_ctx": context_length(llm_name),
                 "temperature": item.temperature,
                 "top_p": item.top_p,
                 "top_k": item.top_k,
@@ -107,28 +594,146 @@ def prepare_payload(llm_name: str, item: Item) -> Dict[str, Any]:
             "temperature": item.temperature
         }
 
+def context_length(llm_name: str) -> int:
+    return LLM_CONFIG[llm_name].get("num_ctx", LLM_NUM_CTX)
+
+class TokenCounter:
+    """
+    Cuenta los tokens de un texto para un modelo. Usa su tokenizador de Hugging Face si está
+    configurado y transformers está instalado; si no, estima con los caracteres por token,
+    que se ajustan con los tokens del prompt que informa Ollama en cada respuesta.
+    """
+    def __init__(self, tokenizer_name: Optional[str] = None, chars_per_token: float = LLM_CHARS_PER_TOKEN):
+        self.tokenizer_name = tokenizer_name
+        self.chars_per_token = chars_per_token
+        self._tokenizer = None
+        self._lock = threading.Lock()
+    
+    @property
+    def tokenizer(self):
+        # El tokenizador se carga con el primer recuento
+        with self._lock:
+            if self.tokenizer_name and self._tokenizer is None:
+                try:
+                    from transformers import AutoTokenizer
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+                except Exception as e:
+                    logger.warning(f"No se pudo cargar el tokenizador {self.tokenizer_name}, se estimarán los tokens: {str(e)}")
+                    self.tokenizer_name = None
+            return self._tokenizer
+    
+    def count(self, text: str) -> int:
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        return math.ceil(len(text) / self.chars_per_token)
+    
+    def observe(self, text: str, tokens: int):
+        """Ajusta la estimación con los tokens reales de un prompt"""
+        if self.tokenizer_name or tokens <= 0:
+            return
+        ratio = len(text) / tokens
+        # Ollama no vuelve a contar el prefijo que ya tiene en cache: esas muestras se descartan
+        if ratio > 2 * self.chars_per_token:
+            return
+        self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * ratio
+
+# Un contador de tokens por modelo
+token_counters: Dict[str, TokenCounter] = {}
+
+def get_token_counter(llm_name: str) -> TokenCounter:
+    if llm_name not in token_counters:
+        token_counters[llm_name] = TokenCounter(LLM_CONFIG[llm_name].get("tokenizer"))
+    return token_counters[llm_name]
+
+def truncate_middle(text: str, keep: int) -> str:
+    """Conserva el principio y el final del texto (`keep` caracteres en total) y marca lo omitido"""
+    if keep >= len(text):
+        return text
+    head = keep // 2
+    tail = keep - head
+    return text[:head] + TRUNCATION_MARKER.format(removed=len(text) - keep) + text[len(text) - tail:]
+
+def fit_context(llm_name: str, item: Item) -> Tuple[Item, Optional[Dict[str, Any]]]:
+    """
+    Ajusta el prompt al contexto del modelo recortando por el centro su parte variable (el
+    fragmento `truncatable` o, si no se indica, el prompt entero). Devuelve la consulta
+    ajustada y, si se ha recortado, los datos del recorte.
+    """
+    counter = get_token_counter(llm_name)
+    budget = context_length(llm_name) - item.max_tokens - LLM_CONTEXT_MARGIN
+    if budget <= 0:
+        raise HTTPException(
+            status_code=400,
+            detail=f"max_tokens ({item.max_tokens}) no cabe en el contexto de {context_length(llm_name)} tokens de '{llm_name}'"
+        )
+    tokens = counter.count(item.prompt)
+    if tokens <= budget:
+        return item, None
+    
+    variable = item.truncatable if item.truncatable and item.truncatable in item.prompt else item.prompt
+    start = item.prompt.index(variable)
+    prefix, suffix = item.prompt[:start], item.prompt[start + len(variable):]
+    variable_tokens = max(1, counter.count(variable))
+    allowed = budget - (tokens - variable_tokens) - counter.count(TRUNCATION_MARKER.format(removed=len(variable)))
+    if allowed <= 0:
+        raise HTTPException(
+            status_code=413,
+            detail=f"La parte fija del prompt no cabe en el contexto de {context_length(llm_name)} tokens de '{llm_name}'"
+        )
+    
+    # Primera aproximación proporcional a los tokens y ajuste hasta que quepa
+    keep = int(len(variable) * allowed / variable_tokens)
+    prompt = prefix + truncate_middle(variable, keep) + suffix
+    while keep > 0 and counter.count(prompt) > budget:
+        keep = int(keep * 0.9)
+        prompt = prefix + truncate_middle(variable, keep) + suffix
+    
+    truncation = {
+        "removed_chars": len(variable) - keep,
+        "prompt_tokens": counter.count(prompt),
+        "original_prompt_tokens": tokens,
+        "context_length": context_length(llm_name)
+    }
+    token_stats_for(llm_name)["truncated_prompts"] += 1
+    logger.warning(f"Prompt de {tokens} tokens recortado para {llm_name}: se omiten {truncation['removed_chars']} caracteres")
+    return item.model_copy(update={"prompt": prompt, "truncatable": None}), truncation
+
+# Tokens procesados por modelo
+token_stats: Dict[str, Dict[str, float]] = {}
+
+def token_stats_for(llm_name: str) -> Dict[str, float]:
+    return token_stats.setdefault(llm_name, {
+        "requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "generation_s": 0.0, "truncated_prompts": 0
+    })
+
+def record_usage(llm_name: str, prompt: str, usage: Optional[Dict[str, Any]]):
+    """Acumula los tokens de una generación y recalibra la estimación de tokens del modelo"""
+    if not usage:
+        return
+    stats = token_stats_for(llm_name)
+    stats["requests"] += 1
+    stats["prompt_tokens"] += usage["prompt_tokens"]
+    stats["completion_tokens"] += usage["completion_tokens"]
+    if usage["tokens_per_second"]:
+        stats["generation_s"] += usage["completion_tokens"] / usage["tokens_per_second"]
+    get_token_counter(llm_name).observe(prompt, usage["prompt_tokens"])
+
 # Función para hacer la solicitud al LLM
-def query_llm(llm_name: str, item: Item) -> Dict[str, Any]:
+async def query_llm(llm_name: str, item: Item) -> Dict[str, Any]:
     """Realiza la consulta al modelo LLM especificado"""
     # Verificar si el modelo está configurado
     if llm_name not in LLM_CONFIG:
         raise HTTPException(status_code=404, detail=f"Modelo LLM '{llm_name}' no configurado")
     
     config = LLM_CONFIG[llm_name]
-    url = config["url"]
-    headers = config["headers"]
     
     # Preparar el payload
     payload = prepare_payload(llm_name, item)
     
     try:
-        # Realizar la solicitud HTTP
-        response = requests.post(
-            url=url,
-            headers=headers,
-            data=json.dumps(payload),
-            timeout=60  # 60 segundos de timeout
-        )
+        # Realizar la solicitud HTTP al mejor servidor, reutilizando las conexiones
+        host, response = await send_request(llm_name, payload)
+        host.finish(payload["model"], failed=response.status_code >= 500, status_code=response.status_code)
         
         # Verificar si la solicitud fue exitosa
         if response.status_code != 200:
@@ -142,16 +747,480 @@ def query_llm(llm_name: str, item: Item) -> Dict[str, Any]:
         processor_name = config["processor"]
         processor_func = globals()[processor_name]
         result = processor_func(response)
+        record_usage(llm_name, payload["prompt"], result.get("usage"))
         
         return result
     
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error de conexión con {llm_name}: {str(e)}")
         return {"error": f"Error de conexión: {str(e)}"}
     except Exception as e:
         logger.error(f"Error inesperado al consultar {llm_name}: {str(e)}", exc_info=True)
         return {"error": f"Error inesperado: {str(e)}"}
 
+@asynccontextmanager
+async def open_stream(llm_name: str, payload: Dict[str, Any]) -> AsyncIterator[httpx.Response]:
+    """Abre la respuesta en streaming del servidor LLM y la cierra al salir, lanzando HTTPException si falla"""
+    try:
+        host, response = await send_request(llm_name, payload, stream=True)
+    except httpx.HTTPError as e:
+        logger.error(f"Error de conexión con {llm_name}: {str(e)}")
+        raise HTTPException(status_code=500, detail={"error": f"Error de conexión: {str(e)}"})
+    
+    failed = response.status_code >= 500
+    try:
+        if response.status_code != 200:
+            detail = (await response.aread()).decode(errors="replace")
+            logger.error(f"Error al consultar {llm_name}: {response.status_code} - {detail}")
+            raise HTTPException(status_code=500, detail={"error": f"Error HTTP {response.status_code}", "detail": detail})
+        try:
+            yield response
+        except httpx.HTTPError:
+            failed = True
+            raise
+    finally:
+        await response.aclose()
+        host.finish(payload["model"], failed, response.status_code)
+
+class ModelScheduler:
+    """
+    Limita las generaciones simultáneas de un modelo. Las peticiones que no tienen plaza
+    esperan en una cola por prioridad (y por orden de llegada dentro de cada prioridad).
+    Si la espera estimada, según la duración media de las generaciones, supera el plazo
+    de la petición, o el plazo vence mientras espera, se rechaza con 429.
+    """
+    def __init__(self, name: str, max_concurrent: int):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.active = 0
+        self.queue: List[list] = []  # montículo de [prioridad, orden de llegada, future]
+        self._order = itertools.count()
+        self.avg_duration: Optional[float] = None
+        self.waits = {priority: deque(maxlen=1000) for priority in PRIORITIES}
+        self.rejected = {priority: 0 for priority in PRIORITIES}
+    
+    def queued(self, priority: Optional[str] = None) -> int:
+        return sum(
+            1 for rank, _, future in self.queue
+            if not future.done() and (priority is None or PRIORITIES[rank] == priority)
+        )
+    
+    def estimated_wait(self, priority: str) -> float:
+        """Segundos que esperaría una petición nueva de esta prioridad (0 si no hay historial)"""
+        if self.avg_duration is None:
+            return 0.0
+        rank = PRIORITIES.index(priority)
+        ahead = sum(1 for r, _, future in self.queue if not future.done() and r <= rank)
+        return (ahead + 1) / self.max_concurrent * self.avg_duration
+    
+    def _reject(self, priority: str, wait: float):
+        self.rejected[priority] += 1
+        logger.warning(f"{self.name}: petición {priority} rechazada (espera estimada {wait:.1f}s)")
+        raise HTTPException(
+            status_code=429,
+            detail=f"El modelo '{self.name}' está saturado: no se puede atender la petición a tiempo",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))}
+        )
+    
+    def _release(self):
+        # La plaza pasa directamente a la siguiente petición de la cola que siga esperando
+        while self.queue:
+            _, _, future = heapq.heappop(self.queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+    
+    @asynccontextmanager
+    async def slot(self, priority: str = "interactive", deadline: Optional[float] = None):
+        """Espera una plaza para generar con el modelo y la libera al terminar"""
+        queued_at = time.monotonic()
+        if self.active < self.max_concurrent and not self.queued():
+            self.active += 1
+        else:
+            wait = self.estimated_wait(priority)
+            if deadline and wait > deadline:
+                self._reject(priority, wait)
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.queue, [PRIORITIES.index(priority), next(self._order), future])
+            try:
+                await asyncio.wait_for(future, deadline or None)
+            except asyncio.TimeoutError:
+                self._reject(priority, self.estimated_wait(priority))
+            except asyncio.CancelledError:
+                # Si ya se le había concedido la plaza hay que liberarla
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+        
+        started = time.monotonic()
+        self.waits[priority].append(started - queued_at)
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            self.avg_duration = duration if self.avg_duration is None else 0.8 * self.avg_duration + 0.2 * duration
+            self._release()
+    
+    def status(self) -> dict:
+        def wait_stats(waits) -> dict:
+            ordered = sorted(waits)
+            return {
+                "avg_wait_s": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+                "p95_wait_s": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3) if ordered else 0.0
+            }
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "avg_duration_s": round(self.avg_duration, 3) if self.avg_duration is not None else None,
+            "queues": {
+                priority: {
+                    "depth": self.queued(priority),
+                    "rejected": self.rejected[priority],
+                    **wait_stats(self.waits[priority])
+                }
+                for priority in PRIORITIES
+            }
+        }
+
+# Un planificador por modelo
+schedulers: Dict[str, ModelScheduler] = {}
+
+def get_scheduler(llm_name: str) -> ModelScheduler:
+    if llm_name not in schedulers:
+        # Por defecto LLM_MAX_CONCURRENT generaciones por cada servidor del modelo
+        max_concurrent = LLM_CONFIG[llm_name].get("max_concurrent", LLM_MAX_CONCURRENT * len(model_urls(llm_name)))
+        schedulers[llm_name] = ModelScheduler(llm_name, max_concurrent)
+    return schedulers[llm_name]
+
+class ResponseCache:
+    """
+    Cache persistente en SQLite de las respuestas de los modelos, indexada por la clave
+    del payload (modelo, prompt, imágenes y opciones de muestreo). Cuando el tamaño total
+    supera `max_bytes` se descartan las entradas usadas hace más tiempo hasta bajar al 90%.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        # La base de datos se crea con la primera consulta, no al importar el módulo
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+            self._conn = conn
+        return self._conn
+    
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            conn.execute("UPDATE responses SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self.stats["hits"] += 1
+            return json.loads(row[0])
+    
+    def _put(self, key: str, model: str, response: Dict[str, Any]):
+        data = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, data, len(data.encode()), now, now)
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                target = self.max_bytes * 0.9
+                for old_key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+                    if total <= target:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= size
+                    self.stats["evictions"] += 1
+            conn.commit()
+    
+    def _purge(self, model: Optional[str] = None) -> int:
+        with self._lock:
+            conn = self._connect()
+            if model is None:
+                deleted = conn.execute("DELETE FROM responses").rowcount
+            else:
+                deleted = conn.execute("DELETE FROM responses WHERE model = ?", (model,)).rowcount
+            conn.commit()
+            return deleted
+    
+    def _status(self, limit: int) -> Dict[str, Any]:
+        with self._lock:
+            conn = self._connect()
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            by_model = conn.execute("SELECT model, COUNT(*), SUM(size) FROM responses GROUP BY model").fetchall()
+            recent = conn.execute(
+                "SELECT key, model, size, created_at, last_access, hits FROM responses ORDER BY last_access DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        total = self.stats["hits"] + self.stats["misses"]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "size_mb": round(size / 1024**2, 3),
+            "max_size_mb": round(self.max_bytes / 1024**2, 3),
+            **self.stats,
+            "hit_ratio": round(self.stats["hits"] / total, 3) if total else 0.0,
+            "models": {model: {"entries": count, "size_mb": round(model_size / 1024**2, 3)} for model, count, model_size in by_model},
+            "recent": [
+                {"key": key, "model": model, "size": entry_size, "created_at": created_at, "last_access": last_access, "hits": hits}
+                for key, model, entry_size, created_at, last_access, hits in recent
+            ]
+        }
+    
+    # SQLite es bloqueante: las operaciones se ejecutan fuera del bucle de eventos
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, key)
+    
+    async def put(self, key: str, model: str, response: Dict[str, Any]):
+        await asyncio.to_thread(self._put, key, model, response)
+    
+    async def purge(self, model: Optional[str] = None) -> int:
+        return await asyncio.to_thread(self._purge, model)
+    
+    async def status(self, limit: int = 20) -> Dict[str, Any]:
+        return await asyncio.to_thread(self._status, limit)
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+response_cache = ResponseCache(LLM_CACHE_PATH, int(LLM_CACHE_MAX_MB * 1024**2))
+
+def use_cache(item: Item) -> bool:
+    """Las respuestas solo se cachean si son deterministas (temperature 0) o si se pide expresamente"""
+    if not LLM_CACHE or item.stream:
+        return False
+    return item.temperature == 0 if item.cache is None else item.cache
+
+def payload_key(llm_name: str, payload: Dict[str, Any]) -> str:
+    """Clave de una consulta: el modelo y el payload normalizado (claves ordenadas)"""
+    normalized = json.dumps({"llm": llm_name, "payload": payload}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+# Consultas al servidor LLM lanzadas y peticiones que se han unido a una ya en curso
+coalescing_stats = {"upstream": 0, "coalesced": 0}
+
+class SingleFlight:
+    """
+    Agrupa las consultas idénticas concurrentes: la primera lanza la consulta al servidor
+    y las demás esperan a su resultado. La consulta solo se cancela cuando todas las
+    peticiones que la esperan se han cancelado (por ejemplo, porque sus clientes se
+    desconectaron).
+    """
+    def __init__(self):
+        self.flights: Dict[str, dict] = {}
+    
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = {"task": asyncio.ensure_future(factory()), "waiters": 0}
+            self.flights[key] = flight
+            flight["task"].add_done_callback(lambda _: self._forget(key, flight))
+            coalescing_stats["upstream"] += 1
+        else:
+            coalescing_stats["coalesced"] += 1
+        flight["waiters"] += 1
+        try:
+            return await asyncio.shield(flight["task"])
+        finally:
+            flight["waiters"] -= 1
+            if flight["waiters"] == 0 and not flight["task"].done():
+                flight["task"].cancel()
+    
+    def _forget(self, key: str, flight: dict):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+class StreamFlight:
+    """
+    Generación en streaming compartida por varias peticiones. Los fragmentos se guardan
+    para que quien se une tarde reciba la respuesta completa desde el principio. La
+    conexión con el servidor se cierra cuando se desconecta el último suscriptor.
+    """
+    def __init__(
+        self,
+        open_response: Callable[[], AsyncContextManager[httpx.Response]],
+        slot=None,
+        on_done: Optional[Callable[[bytes], None]] = None
+    ):
+        self.on_done = on_done
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task = asyncio.ensure_future(self._pump(open_response, slot or nullcontext()))
+    
+    async def _pump(self, open_response: Callable[[], AsyncContextManager[httpx.Response]], slot):
+        try:
+            # La plaza del planificador se mantiene mientras dura el streaming
+            async with slot, open_response() as response:
+                self.ready.set_result(None)
+                async for chunk in response.aiter_raw():
+                    async with self.changed:
+                        self.chunks.append(chunk)
+                        self.changed.notify_all()
+            if self.on_done is not None:
+                self.on_done(b"".join(self.chunks))
+        except Exception as e:
+            if not self.ready.done():
+                self.ready.set_exception(e)
+            else:
+                logger.error(f"Error en el streaming del servidor LLM: {str(e)}")
+        finally:
+            if not self.ready.done():
+                self.ready.cancel()
+            async with self.changed:
+                self.done = True
+                self.changed.notify_all()
+    
+    def attach(self):
+        """Reserva una suscripción, para que la generación no quede huérfana mientras se espera a `ready`"""
+        self.subscribers += 1
+    
+    def detach(self):
+        """Libera una suscripción y cancela la generación si no queda ningún suscriptor"""
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.task.done():
+            self.task.cancel()
+    
+    async def subscribe(self, attached: bool = False) -> AsyncIterator[bytes]:
+        """
+        Devuelve los fragmentos de la respuesta desde el principio a medida que llegan.
+        Con `attached` se usa la suscripción ya reservada con attach().
+        """
+        if not attached:
+            self.attach()
+        sent = 0
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: sent < len(self.chunks) or self.done)
+                    pending, finished = self.chunks[sent:], self.done
+                for chunk in pending:
+                    yield chunk
+                sent += len(pending)
+                if finished and sent == len(self.chunks):
+                    return
+        finally:
+            self.detach()
+
+single_flight = SingleFlight()
+stream_flights: Dict[str, StreamFlight] = {}
+
+async def stream_llm(llm_name: str, item: Item, priority: str = "interactive", deadline: Optional[float] = None) -> StreamingResponse:
+    """
+    Consulta el modelo con stream: true y reenvía tal cual las líneas NDJSON del servidor.
+    Las peticiones idénticas concurrentes comparten la misma generación. Si se desconectan
+    todos los clientes se cierra la conexión con el servidor, que cancela la generación.
+    """
+    payload = prepare_payload(llm_name, item)
+    key = payload_key(llm_name, payload)
+    
+    def on_done(data: bytes):
+        # La última línea de Ollama trae los recuentos de tokens
+        lines = data.decode(errors="replace").strip().splitlines()
+        try:
+            record_usage(llm_name, payload["prompt"], ollama_usage(json.loads(lines[-1])) if lines else None)
+        except (json.JSONDecodeError, AttributeError):
+            pass
+    
+    flight = stream_flights.get(key) if LLM_COALESCING else None
+    if flight is None:
+        flight = StreamFlight(lambda: open_stream(llm_name, payload), get_scheduler(llm_name).slot(priority, deadline), on_done)
+        coalescing_stats["upstream"] += 1
+        if LLM_COALESCING:
+            stream_flights[key] = flight
+            flight.task.add_done_callback(lambda _: stream_flights.pop(key, None) if stream_flights.get(key) is flight else None)
+    else:
+        coalescing_stats["coalesced"] += 1
+    
+    # Se suscribe antes de esperar: si el cliente se desconecta mientras tanto y no queda
+    # nadie más esperando, se cancela la generación y se libera la plaza del planificador
+    flight.attach()
+    try:
+        await asyncio.shield(flight.ready)
+    except BaseException:
+        flight.detach()
+        raise
+    return StreamingResponse(flight.subscribe(attached=True), media_type="application/x-ndjson")
+
+async def scheduled_query(
+    llm_name: str,
+    item: Item,
+    priority: str,
+    deadline: Optional[float],
+    cache_key: Optional[str] = None
+) -> Dict[str, Any]:
+    """Consulta el modelo cuando su planificador le concede plaza y guarda la respuesta en cache si se indica"""
+    async with get_scheduler(llm_name).slot(priority, deadline):
+        result = await query_llm(llm_name, item)
+    if cache_key is not None and "error" not in result:
+        await response_cache.put(cache_key, llm_name, result)
+    return result
+
+async def answer(llm_name: str, item: Item, priority: str, deadline: Optional[float]) -> Tuple[Dict[str, Any], bool]:
+    """
+    Responde a una consulta sin streaming desde la cache o consultando el modelo (de forma
+    compartida con las peticiones idénticas en curso). Devuelve el resultado y si venía de la cache.
+    """
+    key = payload_key(llm_name, prepare_payload(llm_name, item))
+    cache_key = key if use_cache(item) else None
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+    
+    if LLM_COALESCING:
+        return await single_flight.do(key, lambda: scheduled_query(llm_name, item, priority, deadline, cache_key)), False
+    return await scheduled_query(llm_name, item, priority, deadline, cache_key), False
+
+async def run_until_disconnected(request: Request, awaitable: Awaitable):
+    """
+    Espera a `awaitable` comprobando periódicamente si el cliente sigue conectado. Si se
+    desconecta, la cancela (cerrando la conexión con el servidor LLM, que deja de generar)
+    y devuelve None.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=LLM_DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info(f"Cliente desconectado: se cancela la petición a {request.url.path}")
+                return None
+    finally:
+        if not task.done():
+            task.cancel()
+
 # Ruta principal
 @app.get("/")
 def read_root():
@@ -161,10 +1230,57 @@ def read_root():
         "modelos_disponibles": list(LLM_CONFIG.keys()),
         "endpoints": [
             {"ruta": "/chat/{llm_name}", "método": "POST", "descripción": "Consultar un modelo LLM específico"},
-            {"ruta": "/models", "método": "GET", "descripción": "Listar todos los modelos disponibles"}
+            {"ruta": "/chat/{llm_name}/batch", "método": "POST", "descripción": "Consultar un modelo con un lote de prompts"},
+            {"ruta": "/models", "método": "GET", "descripción": "Listar todos los modelos disponibles"},
+            {"ruta": "/models/resident", "método": "GET", "descripción": "Modelos en memoria y tiempo sin usarse"},
+            {"ruta": "/metrics", "método": "GET", "descripción": "Métricas del proxy"},
+            {"ruta": "/admin/cache", "método": "GET/DELETE", "descripción": "Consultar o vaciar la cache de respuestas"}
         ]
     }
 
+# Métricas del proxy
+@app.get("/metrics")
+def metrics():
+    """Agrupación de peticiones idénticas, colas de cada modelo, estado de los servidores y tokens procesados"""
+    total = coalescing_stats["upstream"] + coalescing_stats["coalesced"]
+    return {
+        "coalescing": {
+            **coalescing_stats,
+            "ratio": round(coalescing_stats["coalesced"] / total, 3) if total else 0.0
+        },
+        "schedulers": {name: scheduler.status() for name, scheduler in schedulers.items()},
+        "hosts": {origin: host.status() for origin, host in hosts.items()},
+        "tokens": {
+            name: {
+                **stats,
+                "generation_s": round(stats["generation_s"], 3),
+                "tokens_per_second": round(stats["completion_tokens"] / stats["generation_s"], 1) if stats["generation_s"] else None,
+                "chars_per_token": round(get_token_counter(name).chars_per_token, 2)
+            }
+            for name, stats in token_stats.items()
+        }
+    }
+
+def check_admin_token(x_admin_token: Optional[str] = Header(None)):
+    """Exige el token de administración; sin LLM_ADMIN_TOKEN los endpoints /admin están desactivados"""
+    if not LLM_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Administración desactivada: define LLM_ADMIN_TOKEN para usarla")
+    if x_admin_token != LLM_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Token de administración no válido")
+
+# Administración de la cache de respuestas
+@app.get("/admin/cache", dependencies=[Depends(check_admin_token)])
+async def cache_status(limit: int = 20):
+    """Tamaño, aciertos y expulsiones de la cache, y sus `limit` entradas usadas más recientemente"""
+    return await response_cache.status(limit)
+
+@app.delete("/admin/cache", dependencies=[Depends(check_admin_token)])
+async def purge_cache(model: Optional[str] = None):
+    """Vacía la cache de respuestas, entera o solo la de un modelo"""
+    deleted = await response_cache.purge(model)
+    logger.info(f"Cache de respuestas vaciada{f' para {model}' if model else ''}: {deleted} entradas")
+    return {"deleted": deleted}
+
 # Ruta para listar modelos disponibles
 @app.get("/models")
 def list_models():
@@ -173,17 +1289,20 @@ def list_models():
         "modelos": [
             {
                 "nombre": name,
-                "url": config["url"],
+                "urls": model_urls(name),
                 "requiere_sufijo": bool(config["model_suffix"])
             }
             for name, config in LLM_CONFIG.items()
         ]
     }
 
-# Ruta para consultar un modelo específico
-@app.post("/chat/{llm_name}")
-def chat_with_llm(llm_name: str, item: Item):
-    """Consulta un modelo LLM específico"""
+@app.get("/models/resident")
+async def resident_models():
+    """Modelos cargados en memoria en cada servidor, su expiración y cuánto llevan sin usarse"""
+    return await residency.status()
+
+def check_model_and_priority(llm_name: str, priority: str, deadline: Optional[float]) -> Optional[float]:
+    """Comprueba que el modelo y la prioridad existen y devuelve el plazo de espera en la cola"""
     # Verificar si el modelo está en la configuración
     if llm_name not in LLM_CONFIG:
         models = list(LLM_CONFIG.keys())
@@ -192,15 +1311,117 @@ def chat_with_llm(llm_name: str, item: Item):
             detail=f"Modelo '{llm_name}' no encontrado. Modelos disponibles: {models}"
         )
     
-    # Realizar la consulta
-    result = query_llm(llm_name, item)
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Prioridad '{priority}' no válida. Valores posibles: {PRIORITIES}")
+    return LLM_DEADLINES[priority] if deadline is None else deadline
+
+# Ruta para consultar un modelo específico
+@app.post("/chat/{llm_name}")
+async def chat_with_llm(
+    llm_name: str,
+    item: Item,
+    request: Request,
+    x_priority: str = Header("interactive", description="Prioridad de la petición: interactive o batch"),
+    x_deadline: Optional[float] = Header(None, description="Segundos máximos de espera en la cola")
+):
+    """
+    Consulta un modelo LLM específico. Con stream: true reenvía la respuesta en NDJSON.
+    Si el prompt no cabe en el contexto del modelo se recorta la parte variable y se informa
+    en "truncation" (o en la cabecera X-Prompt-Truncated con streaming).
+    Responde 429 si el modelo está saturado y la petición no se puede atender en su plazo.
+    """
+    deadline = check_model_and_priority(llm_name, x_priority, x_deadline)
+    item, truncation = await asyncio.to_thread(fit_context, llm_name, item)
+    
+    if item.stream:
+        response = await stream_llm(llm_name, item, x_priority, deadline)
+        if truncation:
+            response.headers["X-Prompt-Truncated"] = str(truncation["removed_chars"])
+        return response
+    
+    # Realizar la consulta, cancelándola si el cliente deja de esperar
+    outcome = await run_until_disconnected(request, answer(llm_name, item, x_priority, deadline))
+    if outcome is None:
+        # 499: el cliente cerró la conexión (nadie va a leer esta respuesta)
+        return JSONResponse(status_code=499, content={"detail": "Petición cancelada por el cliente"})
+    result, cached = outcome
     
     # Verificar si hubo un error
     if "error" in result:
         raise HTTPException(status_code=500, detail=result)
     
+    if truncation:
+        result = {**result, "truncation": truncation}
+    if cached:
+        return JSONResponse(content=result, headers={"X-Cache": "HIT"})
     return result
 
+async def batch_item(llm_name: str, index: int, item: Item, priority: str, deadline: Optional[float]) -> Dict[str, Any]:
+    """Resultado de una consulta del lote; los errores se devuelven en el propio elemento"""
+    if item.stream:
+        return {"index": index, "status_code": 400, "error": "stream no está disponible en las consultas de un lote"}
+    try:
+        item, truncation = await asyncio.to_thread(fit_context, llm_name, item)
+        result, cached = await answer(llm_name, item, priority, deadline)
+    except HTTPException as e:
+        return {"index": index, "status_code": e.status_code, "error": e.detail}
+    except Exception as e:
+        logger.error(f"Error inesperado en la consulta {index} del lote de {llm_name}: {str(e)}", exc_info=True)
+        return {"index": index, "status_code": 500, "error": f"Error inesperado: {str(e)}"}
+    if "error" in result:
+        return {"index": index, "status_code": 500, "error": result}
+    if truncation:
+        result = {**result, "truncation": truncation}
+    return {"index": index, "status_code": 200, "result": result, "cached": cached}
+
+@app.post("/chat/{llm_name}/batch")
+async def chat_batch(
+    llm_name: str,
+    batch: BatchRequest,
+    request: Request,
+    x_priority: str = Header("batch", description="Prioridad de las consultas: interactive o batch"),
+    x_deadline: Optional[float] = Header(None, description="Segundos máximos de espera en la cola de cada consulta")
+):
+    """
+    Consulta un modelo con un lote de prompts, enviando a la vez como mucho `parallelism`.
+    Devuelve los resultados en el orden de las consultas o, con stream: true, una línea
+    NDJSON por consulta a medida que terminan. Cada elemento lleva su índice y su propio
+    código de estado: el fallo de una consulta no invalida las demás.
+    """
+    deadline = check_model_and_priority(llm_name, x_priority, x_deadline)
+    if not batch.items:
+        raise HTTPException(status_code=400, detail="El lote no contiene consultas")
+    if len(batch.items) > LLM_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"El lote supera el máximo de {LLM_BATCH_MAX_ITEMS} consultas")
+    parallelism = max(1, min(batch.parallelism or LLM_BATCH_PARALLELISM, LLM_BATCH_MAX_PARALLELISM))
+    semaphore = asyncio.Semaphore(parallelism)
+    
+    async def run(index: int, item: Item) -> Dict[str, Any]:
+        async with semaphore:
+            return await batch_item(llm_name, index, item, x_priority, deadline)
+    
+    def summary(results: List[Dict[str, Any]]) -> Dict[str, int]:
+        ok = sum(1 for r in results if r["status_code"] == 200)
+        return {"total": len(results), "ok": ok, "errors": len(results) - ok}
+    
+    if not batch.stream:
+        results = await run_until_disconnected(request, asyncio.gather(*(run(i, item) for i, item in enumerate(batch.items))))
+        if results is None:
+            return JSONResponse(status_code=499, content={"detail": "Petición cancelada por el cliente"})
+        return {"results": results, "summary": summary(results)}
+    
+    async def stream_results() -> AsyncIterator[bytes]:
+        tasks = [asyncio.ensure_future(run(i, item)) for i, item in enumerate(batch.items)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield (json.dumps(await finished, ensure_ascii=False) + "\n").encode()
+        finally:
+            # Si el cliente se desconecta se cancelan las consultas pendientes
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
 # Para ejecutar directamente con uvicorn
 if __name__ == "__main__":
     import uvicorn
@@ -4,100 +4,1054 @@ export PYTHONPATH=/opt/data/p82garpr/venv_packages:$PYTHONPATH
 python -m uvicorn ocr:app --host 0.0.0.0
 """
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from PIL import Image
 import io
 import torch
+import numpy as np
 import base64
 import requests
 import json
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, DynamicCache, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
 from qwen_vl_utils import process_vision_info
 from pydantic import BaseModel
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from collections import OrderedDict
+from functools import partial
+import asyncio
+import copy
+import difflib
+import gc
 import logging
 import os
+import math
+import threading
+import time
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Memoria máxima (GB) que pueden ocupar los modelos cargados; 0 = sin límite.
+# Al superarla se descarga el modelo usado hace más tiempo, salvo los fijados en
+# OCR_PINNED_MODELS (separados por comas, p. ej. OCR_PINNED_MODELS=qwen7b). Por defecto ninguno
+OCR_MODEL_MEMORY_BUDGET_GB = float(os.getenv("OCR_MODEL_MEMORY_BUDGET_GB", "0"))
+OCR_PINNED_MODELS = [m.strip() for m in os.getenv("OCR_PINNED_MODELS", "").split(",") if m.strip()]
 
-# Cache para los modelos cargados
-loaded_models = {}
+# Presupuesto de píxeles de las imágenes para los modelos Qwen. Cada token de visión
+# cubre un parche de 28x28 píxeles. Se puede sobrescribir por modelo con "min_pixels"/"max_pixels"
+QWEN_PATCH_SIZE = 28
+OCR_MIN_PIXELS = int(os.getenv("OCR_MIN_PIXELS", str(256 * 28 * 28)))
+OCR_MAX_PIXELS = int(os.getenv("OCR_MAX_PIXELS", str(1280 * 28 * 28)))
+
+# Modelos que se cargan (y calientan) al arrancar el servidor, separados por comas
+# (p. ej. OCR_PRELOAD_MODELS=qwen7b). Por defecto ninguno: se cargan con la primera petición.
+# /health/ready solo responde 200 cuando todos los precargados están listos
+OCR_PRELOAD_MODELS = [m.strip() for m in os.getenv("OCR_PRELOAD_MODELS", "").split(",") if m.strip()]
+OCR_WARMUP = os.getenv("OCR_WARMUP", "true").lower() in ("1", "true", "yes")
+
+# Estado de la precarga de cada modelo: "pending", "loading", "ready" o "error: ..."
+model_status: Dict[str, str] = {}
+
+# Agrupación de peticiones (micro-batching) para los modelos transformers.
+# Se pueden sobrescribir por modelo con las claves "max_batch_size" y "max_wait_ms" de OCR_CONFIG
+OCR_MAX_BATCH_SIZE = int(os.getenv("OCR_MAX_BATCH_SIZE", "4"))
+OCR_MAX_WAIT_MS = float(os.getenv("OCR_MAX_WAIT_MS", "25"))
+
+# OCR por franjas: las imágenes más altas que OCR_TILE_MIN_ASPECT veces su anchura se
+# dividen en franjas horizontales de altura OCR_TILE_HEIGHT_RATIO * anchura que se
+# solapan un OCR_TILE_OVERLAP de su altura
+OCR_TILING = os.getenv("OCR_TILING", "false").lower() in ("1", "true", "yes")
+OCR_TILE_MIN_ASPECT = float(os.getenv("OCR_TILE_MIN_ASPECT", "1.5"))
+OCR_TILE_HEIGHT_RATIO = float(os.getenv("OCR_TILE_HEIGHT_RATIO", "0.75"))
+OCR_TILE_OVERLAP = float(os.getenv("OCR_TILE_OVERLAP", "0.2"))
+
+# Reutilizar la cache KV del prefijo común de la plantilla (mensaje de sistema + instrucción),
+# que se calcula una vez por modelo en lugar de en cada petición. Para que la instrucción forme
+# parte del prefijo se coloca antes de la imagen; sin la cache se mantiene el orden original
+# (imagen e instrucción). bench_ocr_prefix_cache.py compara el CER de ambos órdenes
+OCR_PREFIX_CACHE = os.getenv("OCR_PREFIX_CACHE", "true").lower() in ("1", "true", "yes")
+
+# Presupuesto de generación adaptativo: max_new_tokens se estima a partir de las líneas de
+# texto detectadas en la imagen (con un margen y un mínimo) sin superar el máximo del modelo
+# (clave "max_new_tokens" de OCR_CONFIG, por defecto OCR_MAX_NEW_TOKENS)
+OCR_ADAPTIVE_TOKENS = os.getenv("OCR_ADAPTIVE_TOKENS", "true").lower() in ("1", "true", "yes")
+OCR_MAX_NEW_TOKENS = int(os.getenv("OCR_MAX_NEW_TOKENS", "1024"))
+OCR_MIN_NEW_TOKENS = int(os.getenv("OCR_MIN_NEW_TOKENS", "64"))
+OCR_TOKEN_BUDGET_MARGIN = float(os.getenv("OCR_TOKEN_BUDGET_MARGIN", "1.5"))
+OCR_CHARS_PER_TOKEN = 3.0
+# La estimación no se considera fiable con menos líneas de las indicadas o si alguna línea
+# mide más de OCR_MAX_LINE_HEIGHT_RATIO veces la altura mediana (líneas fundidas por una
+# imagen torcida o un interlineado estrecho); en ese caso se usa el máximo del modelo
+OCR_MIN_TEXT_LINES = int(os.getenv("OCR_MIN_TEXT_LINES", "3"))
+OCR_MAX_LINE_HEIGHT_RATIO = 2.5
+# Suelo del presupuesto estimado, como fracción del máximo del modelo
+OCR_MIN_TOKEN_FRACTION = float(os.getenv("OCR_MIN_TOKEN_FRACTION", "0.25"))
+
+# Detección de bucles de repetición: se detiene la generación cuando los últimos tokens son
+# un mismo bloque de hasta OCR_REPETITION_MAX_PERIOD tokens repetido OCR_REPETITION_MIN_REPEATS
+# veces y cubriendo al menos OCR_REPETITION_MIN_TOKENS tokens
+OCR_REPETITION_MAX_PERIOD = int(os.getenv("OCR_REPETITION_MAX_PERIOD", "32"))
+OCR_REPETITION_MIN_REPEATS = int(os.getenv("OCR_REPETITION_MIN_REPEATS", "6"))
+OCR_REPETITION_MIN_TOKENS = int(os.getenv("OCR_REPETITION_MIN_TOKENS", "48"))
+# Últimos tokens que se examinan en busca de bucles. Un bucle nunca recorta más allá de esta
+# ventana, así que en streaming se retienen estos tokens hasta conocer el texto definitivo
+OCR_REPETITION_WINDOW = max(OCR_REPETITION_MAX_PERIOD * OCR_REPETITION_MIN_REPEATS, OCR_REPETITION_MIN_TOKENS)
+
+# Decodificación asistida (especulativa): el modelo indicado en la clave "draft_model" de
+# OCR_CONFIG propone tokens y el modelo pedido los verifica. Se activa por petición con
+# ?assisted=true; OCR_ASSISTED_DECODING fija el valor por defecto
+OCR_ASSISTED_DECODING = os.getenv("OCR_ASSISTED_DECODING", "false").lower() in ("1", "true", "yes")
+
+# Ejecutor dedicado para la inferencia: la decodificación de imágenes, el procesador y
+# generate se ejecutan fuera del bucle de eventos para no bloquear /models ni otras peticiones
+OCR_INFERENCE_WORKERS = int(os.getenv("OCR_INFERENCE_WORKERS", "1"))
+inference_executor = ThreadPoolExecutor(max_workers=OCR_INFERENCE_WORKERS, thread_name_prefix="ocr-inference")
 
-# Configuración de los modelos OCR
+# Control de admisión: peticiones procesándose a la vez, peticiones en espera y
+# segundos que se indican en Retry-After cuando la cola está llena
+OCR_MAX_CONCURRENT = int(os.getenv("OCR_MAX_CONCURRENT", "8"))
+OCR_MAX_QUEUE = int(os.getenv("OCR_MAX_QUEUE", "32"))
+OCR_RETRY_AFTER = int(os.getenv("OCR_RETRY_AFTER", "5"))
+
+# Formatos que Ollama decodifica directamente: las imágenes en estos formatos se le envían
+# con los bytes originales. El resto se recodifica en JPEG con esta calidad
+OLLAMA_PASSTHROUGH_FORMATS = {"JPEG", "PNG"}
+OLLAMA_JPEG_QUALITY = int(os.getenv("OLLAMA_JPEG_QUALITY", "90"))
+
+# Configuración de los modelos OCR. "memory_gb" es la memoria aproximada de los pesos, que
+# ModelManager usa para hacer sitio antes de la primera carga (después usa la huella medida)
 OCR_CONFIG = {
     "qwen7b": {
         "model_name": "Qwen/Qwen2.5-VL-7B-Instruct",
         "type": "transformers",
-        "processor": "process_qwen_response"
+        "processor": "process_qwen_response",
+        # El 3B comparte tokenizador con el 7B pero su vocabulario tiene otro tamaño (151936 frente
+        # a 152064), así que se le pasan los tokenizadores de ambos a generate (ver assisted_generate)
+        "draft_model": "qwen3b",
+        "memory_gb": 16.6
     },
     "qwen3b": {
         "model_name": "Qwen/Qwen2.5-VL-3B-Instruct",
         "type": "transformers",
-        "processor": "process_qwen_response"
+        "processor": "process_qwen_response",
+        "memory_gb": 7.5
+    },
+    # Variante cuantizada en int8 para los nodos sin GPU
+    "qwen3b-int8": {
+        "model_name": "Qwen/Qwen2.5-VL-3B-Instruct",
+        "type": "transformers",
+        "processor": "process_qwen_response",
+        "quantization": "int8",
+        "memory_gb": 5.0
     },
     "gemma3:4b": {
         "url": "http://localhost:11434/api/generate",
         "type": "ollama",
         "processor": "process_ollama_response",
-        "headers": {"Content-Type": "application/json"}
+        "headers": {"Content-Type": "application/json"},
+        "max_new_tokens": 2048
     }
 }
 
+def select_device() -> tuple[str, Any]:
+    """
+    Elige el dispositivo y el tipo de datos para los modelos transformers:
+    CUDA si está disponible y, si no, CPU en float32 (bfloat16/float16 son muy lentos
+    en la mayoría de CPUs). Se puede forzar el dispositivo con OCR_DEVICE.
+    """
+    device = os.getenv("OCR_DEVICE") or ("cuda:0" if torch.cuda.is_available() else "cpu")
+    if device.startswith("cuda"):
+        return device, "auto"
+    return device, torch.float32
+
+class ModelManager:
+    """
+    Cache de modelos cargados con presupuesto de memoria y expulsión LRU.
+    
+    Antes de cargar un modelo se descargan los menos usados recientemente hasta que
+    quepa (según la huella medida en una carga anterior o la clave "memory_gb" de
+    OCR_CONFIG). Los modelos fijados y los que se están usando nunca se descargan.
+    Las cargas se hacen fuera del cerrojo: mientras un modelo se carga, el resto de
+    modelos y el estado siguen disponibles, y quien pida el mismo modelo espera a esa carga.
+    """
+    def __init__(self, loader: Callable[[str], dict], memory_budget_gb: float = 0, pinned: Optional[List[str]] = None):
+        self.loader = loader
+        self.memory_budget = int(memory_budget_gb * 1024**3)
+        self.pinned = set(pinned or [])
+        self.models: "OrderedDict[str, dict]" = OrderedDict()
+        self.footprints: Dict[str, int] = {}
+        self.last_used: Dict[str, float] = {}
+        self.in_use: Dict[str, int] = {}
+        self.evictions = 0
+        # Cargas en curso y memoria reservada para ellas
+        self.loading: Dict[str, Future] = {}
+        self.reserved: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        pinned_estimate = sum(self._estimate(name) for name in self.pinned)
+        if self.memory_budget and pinned_estimate > self.memory_budget:
+            logger.warning(
+                f"Los modelos fijados ({', '.join(sorted(self.pinned))}) necesitan unos {pinned_estimate / 1024**3:.1f} GB "
+                f"y superan el presupuesto de {self.memory_budget / 1024**3:.1f} GB"
+            )
+    
+    def memory_used(self) -> int:
+        return sum(self.footprints.get(name, 0) for name in self.models) + sum(self.reserved.values())
+    
+    def over_budget(self) -> bool:
+        return bool(self.memory_budget) and self.memory_used() > self.memory_budget
+    
+    def can_fit(self, model_name: str) -> bool:
+        """Indica si un modelo está cargado o cabe descargando solo modelos no fijados ni en uso"""
+        with self._lock:
+            if model_name in self.models or model_name in self.loading or not self.memory_budget:
+                return True
+            reclaimable = sum(
+                self.footprints.get(name, 0) for name in self.models
+                if name not in self.pinned and not self.in_use.get(name)
+            )
+            return self.memory_used() - reclaimable + self._estimate(model_name) <= self.memory_budget
+    
+    def _estimate(self, model_name: str) -> int:
+        if model_name in self.footprints:
+            return self.footprints[model_name]
+        memory_gb = OCR_CONFIG.get(model_name, {}).get("memory_gb")
+        if memory_gb:
+            return int(memory_gb * 1024**3)
+        return 0
+    
+    def _make_room(self, needed: int, keep: str):
+        """Descarga modelos en orden LRU hasta que `needed` bytes quepan en el presupuesto"""
+        if not self.memory_budget:
+            return
+        while self.memory_used() + needed > self.memory_budget:
+            candidates = [
+                name for name in self.models
+                if name != keep and name not in self.pinned and not self.in_use.get(name)
+            ]
+            if not candidates:
+                logger.warning(f"No se puede liberar memoria para {keep}: el resto de modelos están fijados o en uso")
+                return
+            self.evict(candidates[0])
+    
+    def evict(self, model_name: str):
+        """Descarga un modelo y libera la memoria del acelerador"""
+        with self._lock:
+            model_data = self.models.pop(model_name, None)
+            if model_data is None:
+                return
+            logger.info(f"Descargando {model_name} ({self.footprints.get(model_name, 0) / 1024**3:.1f} GB)")
+            del model_data
+            self.evictions += 1
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    
+    def evict_if_idle(self, model_name: str) -> bool:
+        """Descarga un modelo salvo que esté fijado o en uso. Indica si se ha descargado"""
+        with self._lock:
+            if model_name in self.pinned or self.in_use.get(model_name):
+                return False
+            self.evict(model_name)
+            return True
+    
+    def get(self, model_name: str) -> dict:
+        """Devuelve un modelo cargado, cargándolo si es necesario"""
+        with self._lock:
+            if model_name in self.models:
+                self.models.move_to_end(model_name)
+                self.last_used[model_name] = time.time()
+                return self.models[model_name]
+            loading = self.loading.get(model_name)
+            if loading is None:
+                loading = self.loading[model_name] = Future()
+                needed = self._estimate(model_name)
+                if self.memory_budget and not needed:
+                    logger.warning(f"Se desconoce la memoria de {model_name}: no se puede comprobar el presupuesto antes de cargarlo")
+                self._make_room(needed, keep=model_name)
+                self.reserved[model_name] = needed
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Otra petición ya lo está cargando
+            return loading.result()
+        
+        try:
+            model_data = self.loader(model_name)
+        except BaseException as e:
+            with self._lock:
+                del self.loading[model_name]
+                del self.reserved[model_name]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            model = model_data.get("model")
+            if "memory_bytes" in model_data:
+                self.footprints[model_name] = model_data["memory_bytes"]
+            elif hasattr(model, "get_memory_footprint"):
+                self.footprints[model_name] = model.get_memory_footprint()
+            del self.loading[model_name]
+            del self.reserved[model_name]
+            self.models[model_name] = model_data
+            self.last_used[model_name] = time.time()
+            # La huella real puede ser mayor que la estimada
+            self._make_room(0, keep=model_name)
+            self._warn_pinned_over_budget()
+        loading.set_result(model_data)
+        return model_data
+    
+    def _warn_pinned_over_budget(self):
+        if not self.memory_budget:
+            return
+        pinned_used = sum(self.footprints.get(name, 0) for name in self.models if name in self.pinned)
+        if pinned_used > self.memory_budget:
+            logger.warning(
+                f"Los modelos fijados ocupan {pinned_used / 1024**3:.1f} GB y superan el presupuesto "
+                f"de {self.memory_budget / 1024**3:.1f} GB"
+            )
+    
+    @contextmanager
+    def use(self, model_name: str):
+        """Obtiene un modelo y lo protege de ser descargado mientras se usa"""
+        while True:
+            model_data = self.get(model_name)
+            with self._lock:
+                # Se comprueba que no se haya descargado entre la carga y el registro del uso
+                if self.models.get(model_name) is model_data:
+                    self.in_use[model_name] = self.in_use.get(model_name, 0) + 1
+                    break
+        try:
+            yield model_data
+        finally:
+            with self._lock:
+                self.in_use[model_name] -= 1
+    
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "memory_budget_gb": round(self.memory_budget / 1024**3, 2),
+                "memory_used_gb": round(self.memory_used() / 1024**3, 2),
+                "evictions": self.evictions,
+                "loading": list(self.loading),
+                "modelos": [
+                    {
+                        "nombre": name,
+                        "memory_gb": round(self.footprints.get(name, 0) / 1024**3, 2),
+                        "pinned": name in self.pinned,
+                        "in_use": self.in_use.get(name, 0),
+                        "idle_seconds": round(time.time() - self.last_used.get(name, time.time()), 1)
+                    }
+                    for name in self.models
+                ]
+            }
+
+def quantize_int8(model):
+    """Cuantización dinámica int8 de las capas lineales del modelo (solo para CPU)"""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def state_dict_nbytes(model) -> int:
+    """
+    Memoria que ocupan los pesos del modelo. A diferencia de get_memory_footprint,
+    incluye los pesos empaquetados de las capas cuantizadas.
+    """
+    def nbytes(value) -> int:
+        if isinstance(value, torch.Tensor):
+            if value.is_quantized:
+                return value.int_repr().numel() * value.int_repr().element_size()
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(v) for v in value)
+        return 0
+    return sum(nbytes(value) for value in model.state_dict().values())
+
+def load_qwen_checkpoint(model_name: str) -> dict:
+    """Carga desde disco un modelo Qwen y su procesador"""
+    quantization = OCR_CONFIG[model_name].get("quantization")
+    if quantization not in (None, "int8"):
+        raise ValueError(f"Cuantización '{quantization}' no soportada para {model_name}")
+    device, dtype = select_device()
+    if quantization == "int8":
+        # La cuantización dinámica solo tiene kernels de CPU y parte de float32
+        device, dtype = "cpu", torch.float32
+    logger.info(f"Cargando {model_name} en {device}" + (f" ({quantization})" if quantization else ""))
+    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+        OCR_CONFIG[model_name]["model_name"], 
+        torch_dtype=dtype, 
+        device_map=device
+    )
+    model_data = {}
+    if quantization == "int8":
+        model = quantize_int8(model)
+        model_data["memory_bytes"] = state_dict_nbytes(model)
+    processor = AutoProcessor.from_pretrained(
+        OCR_CONFIG[model_name]["model_name"],
+        min_pixels=OCR_CONFIG[model_name].get("min_pixels", OCR_MIN_PIXELS),
+        max_pixels=OCR_CONFIG[model_name].get("max_pixels", OCR_MAX_PIXELS)
+    )
+    # Relleno a la izquierda para poder generar varias peticiones en un mismo lote
+    processor.tokenizer.padding_side = "left"
+    model_data.update({"model": model, "processor": processor})
+    return model_data
+
+# Cache para los modelos cargados
+model_manager = ModelManager(load_qwen_checkpoint, OCR_MODEL_MEMORY_BUDGET_GB, OCR_PINNED_MODELS)
+
 def load_qwen_model(model_name: str):
     """Carga un modelo Qwen si no está ya cargado"""
-    if model_name not in loaded_models:
-        model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            OCR_CONFIG[model_name]["model_name"], 
-            torch_dtype="auto", 
-            device_map="cuda:0"
+    return model_manager.get(model_name)
+
+OCR_PROMPT = "transcript the text in the image. Preserve all formatting, indentation, and whitespace exactly as shown in the image. Do not add any explanations or markdown, only output the exact text with its original formatting."
+
+def pixel_budget_size(width: int, height: int, min_pixels: int, max_pixels: int, factor: int = QWEN_PATCH_SIZE) -> tuple[int, int]:
+    """
+    Calcula el tamaño al que redimensionar una imagen manteniendo su relación de aspecto,
+    con ambos lados múltiplos de `factor` y un área entre min_pixels y max_pixels.
+    """
+    new_width = max(factor, round(width / factor) * factor)
+    new_height = max(factor, round(height / factor) * factor)
+    if new_width * new_height > max_pixels:
+        beta = math.sqrt(width * height / max_pixels)
+        new_width = max(factor, math.floor(width / beta / factor) * factor)
+        new_height = max(factor, math.floor(height / beta / factor) * factor)
+    elif new_width * new_height < min_pixels:
+        beta = math.sqrt(min_pixels / (width * height))
+        new_width = math.ceil(width * beta / factor) * factor
+        new_height = math.ceil(height * beta / factor) * factor
+    return new_width, new_height
+
+def vision_token_count(width: int, height: int, factor: int = QWEN_PATCH_SIZE) -> int:
+    """Número de tokens de visión que genera una imagen ya ajustada a la rejilla de parches"""
+    return (width // factor) * (height // factor)
+
+def prepare_image(image: Image.Image, model_name: str) -> Image.Image:
+    """Redimensiona la imagen al presupuesto de píxeles del modelo sin deformarla"""
+    config = OCR_CONFIG[model_name]
+    size = pixel_budget_size(
+        image.width, image.height,
+        config.get("min_pixels", OCR_MIN_PIXELS),
+        config.get("max_pixels", OCR_MAX_PIXELS)
+    )
+    if size == image.size:
+        return image
+    return image.resize(size, Image.BICUBIC)
+
+def build_qwen_inputs(images: List[Image.Image], model_name: str, processor, device):
+    """Construye las entradas del modelo (plantilla de chat + imágenes) para un lote"""
+    messages_batch = []
+    for image in images:
+        content = [
+            {"type": "image", "image": prepare_image(image, model_name)},
+            {"type": "text", "text": OCR_PROMPT}
+        ]
+        # Con la cache del prefijo, la instrucción va antes de la imagen para que todo lo
+        # anterior a los tokens de visión sea igual en todas las peticiones
+        if OCR_PREFIX_CACHE:
+            content.reverse()
+        messages_batch.append([{"role": "user", "content": content}])
+    
+    texts = [
+        processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        for messages in messages_batch
+    ]
+    image_inputs, video_inputs = process_vision_info(messages_batch)
+    return processor(
+        text=texts, images=image_inputs, videos=video_inputs,
+        padding=True, return_tensors="pt"
+    ).to(device)
+
+# Estadísticas de la cache del prefijo (peticiones que la reutilizan y tokens ahorrados)
+prefix_cache_stats = {"hits": 0, "misses": 0, "tokens_reused": 0}
+prefix_cache_lock = threading.Lock()
+
+def _text_model(model):
+    """Módulo que calcula las posiciones M-RoPE (cambia de sitio entre versiones de transformers)"""
+    inner = getattr(model, "model", None)
+    return inner if hasattr(inner, "get_rope_index") else model
+
+def get_prefix_cache(model_data: dict, prefix_ids: torch.Tensor) -> DynamicCache:
+    """
+    Devuelve la cache KV del prefijo de la plantilla, calculándola la primera vez.
+    Los tokens de texto anteriores a la imagen tienen las mismas posiciones en las tres
+    componentes de M-RoPE, así que su cache no depende de la imagen que venga después.
+    """
+    with prefix_cache_lock:
+        cached = model_data.get("prefix_cache")
+        if cached is not None and torch.equal(cached["input_ids"], prefix_ids):
+            prefix_cache_stats["hits"] += 1
+            prefix_cache_stats["tokens_reused"] += prefix_ids.shape[1]
+            return cached["cache"]
+        
+        prefix_cache_stats["misses"] += 1
+        model = model_data["model"]
+        length = prefix_ids.shape[1]
+        cache = DynamicCache()
+        with torch.no_grad():
+            _text_model(model)(
+                input_ids=prefix_ids,
+                attention_mask=torch.ones_like(prefix_ids),
+                position_ids=torch.arange(length, device=prefix_ids.device).view(1, 1, -1).expand(3, 1, -1),
+                past_key_values=cache,
+                use_cache=True,
+                cache_position=torch.arange(length, device=prefix_ids.device)
+            )
+        model_data["prefix_cache"] = {"input_ids": prefix_ids.clone(), "cache": cache}
+        return cache
+
+def prefill_with_prefix_cache(model_data: dict, inputs) -> Optional[DynamicCache]:
+    """
+    Rellena la cache KV de una petición partiendo de la cache del prefijo: solo se
+    procesan la imagen y los tokens posteriores. Se deja fuera el último token para que
+    generate lo procese y produzca los logits del primer token de la respuesta.
+    Devuelve None si la entrada no tiene el prefijo esperado.
+    """
+    model = model_data["model"]
+    input_ids = inputs["input_ids"]
+    vision_start = (input_ids[0] == model.config.vision_start_token_id).nonzero()
+    if len(vision_start) == 0:
+        return None
+    prefix_len = int(vision_start[0]) + 1
+    total_len = input_ids.shape[1]
+    cache = copy.deepcopy(get_prefix_cache(model_data, input_ids[:, :prefix_len]))
+    
+    text_model = _text_model(model)
+    rope_kwargs = {"image_grid_thw": inputs.get("image_grid_thw"), "attention_mask": inputs["attention_mask"]}
+    if inputs.get("mm_token_type_ids") is not None:
+        rope_kwargs["mm_token_type_ids"] = inputs["mm_token_type_ids"]
+    # Las posiciones de la imagen y el texto posterior dependen de la secuencia completa
+    position_ids, rope_deltas = text_model.get_rope_index(input_ids, **rope_kwargs)
+    with torch.no_grad():
+        text_model(
+            input_ids=input_ids[:, prefix_len:total_len - 1],
+            attention_mask=inputs["attention_mask"][:, :total_len - 1],
+            pixel_values=inputs["pixel_values"],
+            image_grid_thw=inputs["image_grid_thw"],
+            position_ids=position_ids[:, :, prefix_len:total_len - 1],
+            past_key_values=cache,
+            use_cache=True,
+            cache_position=torch.arange(prefix_len, total_len - 1, device=input_ids.device)
         )
-        processor = AutoProcessor.from_pretrained(
-            OCR_CONFIG[model_name]["model_name"],
-            min_pixels=256*28*28,
-            max_pixels=1280*28*28
+    # generate usa este desplazamiento para las posiciones de los tokens generados
+    text_model.rope_deltas = rope_deltas
+    return cache
+
+def qwen_generate(model_data: dict, inputs, **generate_kwargs):
+    """
+    Llama a generate reutilizando la cache del prefijo común cuando la petición va sola.
+    En los lotes el relleno a la izquierda desplaza el prefijo de cada fila, así que se
+    genera sin ella.
+    """
+    model = model_data["model"]
+    if OCR_PREFIX_CACHE and inputs["input_ids"].shape[0] == 1:
+        cache = prefill_with_prefix_cache(model_data, inputs)
+        if cache is not None:
+            return model.generate(
+                input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"],
+                past_key_values=cache, **generate_kwargs
+            )
+    return model.generate(**inputs, **generate_kwargs)
+
+def load_draft_model(model_name: str) -> Optional[str]:
+    """
+    Carga el modelo borrador de `model_name` si cabe en memoria junto a él.
+    Devuelve su nombre, o None si no hay borrador configurado, no cabe o falla la carga.
+    """
+    draft_name = OCR_CONFIG[model_name].get("draft_model")
+    if not draft_name:
+        return None
+    if not model_manager.can_fit(draft_name):
+        logger.info(f"{draft_name} no cabe en memoria junto a {model_name}: se genera sin decodificación asistida")
+        return None
+    try:
+        model_manager.get(draft_name)
+    except Exception as e:
+        logger.warning(f"No se pudo cargar el modelo borrador {draft_name}: {str(e)}")
+        return None
+    # La huella real puede superar la estimada: en ese caso se descarta el borrador
+    # y, como ya se conoce su huella, no se vuelve a intentar cargar
+    if model_manager.over_budget():
+        # Si otra petición lo está usando ya ocupa memoria: se usa y se descarga más adelante
+        if not model_manager.evict_if_idle(draft_name):
+            return draft_name
+        logger.warning(f"{draft_name} no cabe en memoria junto a {model_name}: se descarga")
+        return None
+    return draft_name
+
+def assisted_generate(model_data: dict, model_name: str, inputs, **generate_kwargs):
+    """generate con decodificación asistida por el modelo borrador, o sin ella si no está disponible"""
+    draft_name = load_draft_model(model_name)
+    if draft_name is None:
+        return qwen_generate(model_data, inputs, **generate_kwargs)
+    with model_manager.use(draft_name) as draft_data:
+        model, draft = model_data["model"], draft_data["model"]
+        tokenizers = {}
+        if model.config.get_text_config().vocab_size != draft.config.get_text_config().vocab_size:
+            # Con vocabularios de distinto tamaño generate necesita los dos tokenizadores
+            # para traducir los tokens del borrador (decodificación asistida universal)
+            if "processor" in model_data and "processor" in draft_data:
+                tokenizers = {
+                    "tokenizer": model_data["processor"].tokenizer,
+                    "assistant_tokenizer": draft_data["processor"].tokenizer
+                }
+        try:
+            return model.generate(**inputs, assistant_model=draft, **tokenizers, **generate_kwargs)
+        except ValueError as e:
+            # generate valida el borrador antes de empezar a generar: si no es compatible
+            # se genera sin él en lugar de fallar la petición
+            logger.warning(f"{draft_name} no es compatible como borrador de {model_name}: {str(e)}. Se genera sin decodificación asistida")
+            return qwen_generate(model_data, inputs, **generate_kwargs)
+
+def detect_text_lines(image: Image.Image, max_width: int = 800) -> List[tuple[int, float]]:
+    """
+    Detecta las líneas de texto de una imagen a partir del perfil horizontal de tinta.
+    Devuelve, para cada línea, su altura y la anchura con tinta desde el margen izquierdo
+    del texto (incluida la sangría), ambas en píxeles de la imagen reducida a `max_width`.
+    """
+    gray = image.convert("L")
+    if gray.width > max_width:
+        gray = gray.resize((max_width, max(1, round(gray.height * max_width / gray.width))))
+    pixels = np.asarray(gray, dtype=np.float32)
+    # Texto claro sobre fondo oscuro (capturas en modo oscuro)
+    if pixels.mean() < 128:
+        pixels = 255 - pixels
+    if pixels.std() < 5:
+        return []
+    ink = pixels < min(200, pixels.mean() - 2 * pixels.std())
+    
+    rows = np.append(ink.mean(axis=1) > 0.002, False)
+    spans, start = [], None
+    for y, has_ink in enumerate(rows):
+        if has_ink and start is None:
+            start = y
+        elif not has_ink and start is not None:
+            if y - start >= 2:
+                spans.append((start, y))
+            start = None
+    if not spans:
+        return []
+    
+    left = int(np.argmax(ink.any(axis=0)))
+    lines = []
+    for top, bottom in spans:
+        columns = np.nonzero(ink[top:bottom].any(axis=0))[0]
+        lines.append((bottom - top, float(columns[-1] - left + 1)))
+    return lines
+
+def estimate_max_new_tokens(image: Image.Image, max_tokens: int) -> int:
+    """
+    Estima los tokens necesarios para transcribir la imagen: cada línea aporta los caracteres
+    que caben en su anchura (con un ancho de letra de media altura de línea) más el salto de
+    línea. Si no se detecta texto, hay muy pocas líneas o alguna es demasiado alta (varias
+    líneas fundidas en una) se usa el máximo, ya que la estimación no es fiable. El resultado
+    nunca baja de OCR_MIN_TOKEN_FRACTION del máximo.
+    """
+    if not OCR_ADAPTIVE_TOKENS:
+        return max_tokens
+    lines = detect_text_lines(image)
+    if len(lines) < max(1, OCR_MIN_TEXT_LINES):
+        return max_tokens
+    heights = [height for height, _ in lines]
+    if max(heights) > OCR_MAX_LINE_HEIGHT_RATIO * float(np.median(heights)):
+        return max_tokens
+    chars = sum(width / (0.5 * height) for height, width in lines)
+    estimate = (chars / OCR_CHARS_PER_TOKEN + len(lines)) * OCR_TOKEN_BUDGET_MARGIN + OCR_MIN_NEW_TOKENS
+    floor = int(max_tokens * OCR_MIN_TOKEN_FRACTION)
+    return max(1, min(max_tokens, max(floor, int(estimate))))
+
+def find_repetition(
+    tokens: List[int],
+    max_period: int = OCR_REPETITION_MAX_PERIOD,
+    min_repeats: int = OCR_REPETITION_MIN_REPEATS,
+    min_tokens: int = OCR_REPETITION_MIN_TOKENS
+) -> Optional[tuple[int, int]]:
+    """
+    Busca un bucle al final de `tokens`: un bloque de hasta `max_period` tokens repetido al
+    menos `min_repeats` veces seguidas cubriendo `min_tokens` tokens. Devuelve el periodo
+    y el número de copias completas, o None si no hay bucle.
+    """
+    for period in range(1, max_period + 1):
+        needed = max(min_repeats, math.ceil(min_tokens / period)) * period
+        if len(tokens) < needed:
+            continue
+        tail = tokens[-needed:]
+        if tail[period:] == tail[:-period]:
+            start = len(tokens) - needed
+            while start > 0 and tokens[start - 1] == tokens[start - 1 + period]:
+                start -= 1
+            return period, (len(tokens) - start) // period
+    return None
+
+class TokenBudgetCriteria(StoppingCriteria):
+    """
+    Detiene cada secuencia del lote al agotar su presupuesto de tokens o al entrar en un
+    bucle de repetición. En `stop_at` guarda la longitud a la que hay que recortar cada
+    secuencia (en los bucles, tras la primera copia del bloque repetido) y en
+    `stop_reasons` el motivo ("length" o "loop").
+    """
+    def __init__(self, prompt_length: int, budgets: List[int], finished_ids: List[int]):
+        self.prompt_length = prompt_length
+        self.budgets = budgets
+        self.finished_ids = set(finished_ids)
+        self.window = OCR_REPETITION_WINDOW
+        self.stop_at: Dict[int, int] = {}
+        self.stop_reasons: Dict[int, str] = {}
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        length = input_ids.shape[1]
+        tails = input_ids[:, max(self.prompt_length, length - self.window):].tolist()
+        for row, tail in enumerate(tails):
+            if row in self.stop_at:
+                done[row] = True
+                continue
+            # Las secuencias ya terminadas se rellenan con el token de fin
+            if not tail or tail[-1] in self.finished_ids:
+                continue
+            repetition = find_repetition(tail)
+            if repetition:
+                period, copies = repetition
+                self.stop_at[row] = length - (copies - 1) * period
+                self.stop_reasons[row] = "loop"
+                done[row] = True
+            elif length - self.prompt_length >= self.budgets[row]:
+                self.stop_at[row] = length
+                self.stop_reasons[row] = "length"
+                done[row] = True
+        return done
+
+# Criterios de parada adicionales que se aplican a todas las generaciones. Cada elemento es
+# una función sin argumentos que crea un StoppingCriteria nuevo por llamada a generate
+extra_stopping_criteria: List[Callable[[], StoppingCriteria]] = []
+
+def register_stopping_criteria(factory: Callable[[], StoppingCriteria]):
+    """Registra un criterio de parada adicional para las generaciones de los modelos Qwen"""
+    extra_stopping_criteria.append(factory)
+
+# Motivos de parada de menor a mayor gravedad (para resumir varias generaciones)
+STOP_REASON_SEVERITY = ["eos", "length", "loop"]
+
+# Tokens generados por los modelos transformers y motivo por el que terminó cada generación
+generation_stats = {"requests": 0, "tokens": 0, "eos": 0, "length": 0, "loop": 0}
+
+def generate_qwen_batch(
+    images: List[Image.Image],
+    model_name: str,
+    max_new_tokens: Optional[int] = None,
+    assisted: bool = False,
+    stopping_criteria: Optional[List[StoppingCriteria]] = None,
+    streamer=None
+) -> List[dict]:
+    """
+    Procesa un lote de imágenes con un modelo Qwen en una única llamada a generate.
+    Sin `max_new_tokens` el presupuesto de cada imagen se estima a partir de su texto.
+    Devuelve, para cada imagen, el texto, los tokens generados, el presupuesto y el
+    motivo de parada ("eos", "length" o "loop").
+    La decodificación asistida solo admite lotes de una imagen.
+    """
+    max_tokens = OCR_CONFIG[model_name].get("max_new_tokens", OCR_MAX_NEW_TOKENS)
+    if max_new_tokens is None:
+        budgets = [estimate_max_new_tokens(image, max_tokens) for image in images]
+    else:
+        budgets = [max_new_tokens] * len(images)
+    
+    with model_manager.use(model_name) as model_data:
+        model = model_data["model"]
+        processor = model_data["processor"]
+        inputs = build_qwen_inputs(images, model_name, processor, model.device)
+        
+        prompt_length = inputs["input_ids"].shape[1]
+        eos_ids = model.generation_config.eos_token_id
+        finished_ids = [eos_ids] if isinstance(eos_ids, int) else list(eos_ids or [])
+        if processor.tokenizer.pad_token_id is not None:
+            finished_ids.append(processor.tokenizer.pad_token_id)
+        budget_criteria = TokenBudgetCriteria(prompt_length, budgets, finished_ids)
+        criteria = StoppingCriteriaList(
+            [budget_criteria] + list(stopping_criteria or []) + [factory() for factory in extra_stopping_criteria]
         )
-        loaded_models[model_name] = {"model": model, "processor": processor}
-    return loaded_models[model_name]
+        generate_kwargs = dict(max_new_tokens=max(budgets), stopping_criteria=criteria, streamer=streamer)
+        
+        if assisted and len(images) == 1:
+            generated_ids = assisted_generate(model_data, model_name, inputs, **generate_kwargs)
+        else:
+            generated_ids = qwen_generate(model_data, inputs, **generate_kwargs)
+        
+        results = []
+        for row, out_ids in enumerate(generated_ids.tolist()):
+            new_ids = out_ids[prompt_length:budget_criteria.stop_at.get(row, len(out_ids))]
+            stop_reason = budget_criteria.stop_reasons.get(row, "eos")
+            ends = [i for i, token in enumerate(new_ids) if token in finished_ids]
+            if ends:
+                new_ids = new_ids[:ends[0]]
+            elif stop_reason == "eos" and len(new_ids) >= budgets[row]:
+                stop_reason = "length"
+            results.append({
+                "text": processor.decode(new_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False),
+                "tokens": len(new_ids),
+                "max_new_tokens": budgets[row],
+                "stop_reason": stop_reason
+            })
+            generation_stats["requests"] += 1
+            generation_stats["tokens"] += len(new_ids)
+            generation_stats[stop_reason] += 1
+            if stop_reason == "loop":
+                logger.warning(f"Bucle de repetición detectado con {model_name} tras {len(new_ids)} tokens")
+        
+        return results
+
+def process_qwen_batch(images: List[Image.Image], model_name: str, max_new_tokens: Optional[int] = None, assisted: bool = False) -> List[str]:
+    """Procesa un lote de imágenes con un modelo Qwen y devuelve solo los textos"""
+    return [result["text"] for result in generate_qwen_batch(images, model_name, max_new_tokens, assisted)]
 
 def process_qwen_response(image: Image.Image, model_name: str):
     """Procesa una imagen usando un modelo Qwen"""
-    model_data = load_qwen_model(model_name)
-    model = model_data["model"]
-    processor = model_data["processor"]
+    return process_qwen_batch([image], model_name)[0]
+
+class MicroBatcher:
+    """
+    Agrupa las peticiones que llegan dentro de una ventana de tiempo corta (o hasta
+    completar el tamaño máximo de lote) y las procesa con una única llamada a
+    `procesar_lote`, devolviendo a cada petición su resultado.
+    """
+    def __init__(
+        self,
+        procesar_lote: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 4,
+        max_wait_ms: float = 25,
+        executor: Optional[Executor] = None
+    ):
+        self.procesar_lote = procesar_lote
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._worker = None
+        self.lotes_procesados = 0
     
-    max_size = (640, 640)
-    image = image.resize(max_size, Image.LANCZOS)
+    async def submit(self, item: Any) -> Any:
+        """Encola un elemento y espera al resultado de su lote"""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
     
-    messages = [
-        {"role": "user", "content": [
-            {"type": "image", "image": image},
-            {"type": "text", "text": "transcript the text in the image. Preserve all formatting, indentation, and whitespace exactly as shown in the image. Do not add any explanations or markdown, only output the exact text with its original formatting."}
-        ]}
-    ]
+    async def close(self):
+        """Detiene el planificador"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
     
-    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    image_inputs, video_inputs = process_vision_info(messages)
-    inputs = processor(
-        text=[text], images=image_inputs, videos=video_inputs,
-        padding=True, return_tensors="pt"
-    ).to("cuda")
+    async def _recoger_lote(self) -> list:
+        lote = [await self.queue.get()]
+        limite = asyncio.get_running_loop().time() + self.max_wait
+        while len(lote) < self.max_batch_size:
+            restante = limite - asyncio.get_running_loop().time()
+            if restante <= 0:
+                break
+            try:
+                lote.append(await asyncio.wait_for(self.queue.get(), restante))
+            except asyncio.TimeoutError:
+                break
+        # Descartar las peticiones cuyo cliente ya no espera respuesta
+        return [(item, future) for item, future in lote if not future.done()]
     
-    generated_ids = model.generate(**inputs, max_new_tokens=1024)  # Aumentado para manejar textos más largos
-    generated_ids_trimmed = [out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
-    output_text = processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    async def _run(self):
+        while True:
+            lote = await self._recoger_lote()
+            if not lote:
+                continue
+            try:
+                resultados = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.procesar_lote, [item for item, _ in lote]
+                )
+            except Exception as e:
+                for _, future in lote:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.lotes_procesados += 1
+            for (_, future), resultado in zip(lote, resultados):
+                if not future.done():
+                    future.set_result(resultado)
+
+# Un planificador de lotes por modelo
+batchers: Dict[str, MicroBatcher] = {}
+
+def get_batcher(model_name: str) -> MicroBatcher:
+    """Devuelve el planificador de lotes de un modelo transformers, creándolo si no existe"""
+    if model_name not in batchers:
+        config = OCR_CONFIG[model_name]
+        batchers[model_name] = MicroBatcher(
+            lambda images: generate_qwen_batch(images, model_name),
+            max_batch_size=config.get("max_batch_size", OCR_MAX_BATCH_SIZE),
+            max_wait_ms=config.get("max_wait_ms", OCR_MAX_WAIT_MS),
+            executor=inference_executor
+        )
+    return batchers[model_name]
+
+def split_into_strips(image: Image.Image, strip_height: int, overlap: float) -> List[Image.Image]:
+    """Divide una imagen en franjas horizontales de `strip_height` px que se solapan"""
+    if image.height <= strip_height:
+        return [image]
+    step = max(1, int(strip_height * (1 - overlap)))
+    tops = list(range(0, image.height - strip_height, step))
+    # La última franja se alinea con el borde inferior
+    tops.append(image.height - strip_height)
+    return [image.crop((0, top, image.width, top + strip_height)) for top in tops]
+
+def _normalize_line(line: str) -> str:
+    return " ".join(line.split()).lower()
+
+def _lines_match(a: str, b: str) -> bool:
+    a, b = _normalize_line(a), _normalize_line(b)
+    if not a or not b:
+        return a == b
+    return difflib.SequenceMatcher(None, a, b).ratio() >= 0.8
+
+def merge_overlapping_texts(first: str, second: str, max_overlap_lines: int = 10) -> str:
+    """
+    Une el texto de dos franjas consecutivas eliminando las líneas repetidas por el solape:
+    busca el mayor número de líneas al final de `first` que coinciden (de forma aproximada)
+    con las del principio de `second`.
+    """
+    first_lines = first.rstrip("\n").split("\n")
+    second_lines = second.lstrip("\n").split("\n")
+    if not first.strip():
+        return second
+    if not second.strip():
+        return first
+    for k in range(min(len(first_lines), len(second_lines), max_overlap_lines), 0, -1):
+        if all(_lines_match(a, b) for a, b in zip(first_lines[-k:], second_lines[:k])):
+            return "\n".join(first_lines + second_lines[k:])
+    # Una línea cortada por el borde de la franja puede aparecer incompleta en una de las dos
+    if _normalize_line(first_lines[-1]) and _normalize_line(second_lines[0]) and (
+        _normalize_line(first_lines[-1]) in _normalize_line(second_lines[0])
+        or _normalize_line(second_lines[0]) in _normalize_line(first_lines[-1])
+    ):
+        longest = max(first_lines[-1], second_lines[0], key=len)
+        return "\n".join(first_lines[:-1] + [longest] + second_lines[1:])
+    return "\n".join(first_lines + second_lines)
+
+def needs_tiling(image: Image.Image) -> bool:
+    return image.height > image.width * OCR_TILE_MIN_ASPECT
+
+async def process_assisted(image: Image.Image, model_name: str) -> dict:
+    """Transcribe una imagen con decodificación asistida (fuera del planificador de lotes)"""
+    results = await asyncio.get_running_loop().run_in_executor(
+        inference_executor, partial(generate_qwen_batch, [image], model_name, assisted=True)
+    )
+    return results[0]
+
+async def process_tiled(image: Image.Image, model_name: str, assisted: bool = False) -> dict:
+    """
+    Transcribe una imagen alta por franjas. Las franjas se envían a la vez al planificador
+    de lotes del modelo, de modo que se generan juntas, y después se unen en orden.
+    Con decodificación asistida las franjas se generan una a una.
+    """
+    strip_height = max(QWEN_PATCH_SIZE, int(image.width * OCR_TILE_HEIGHT_RATIO))
+    strips = split_into_strips(image, strip_height, OCR_TILE_OVERLAP)
+    submit = partial(process_assisted, model_name=model_name) if assisted else get_batcher(model_name).submit
+    results = await asyncio.gather(*(submit(strip) for strip in strips))
+    text = results[0]["text"]
+    for result in results[1:]:
+        text = merge_overlapping_texts(text, result["text"])
+    return {
+        "text": text,
+        "tokens": sum(result["tokens"] for result in results),
+        "max_new_tokens": sum(result["max_new_tokens"] for result in results),
+        "stop_reason": max((result["stop_reason"] for result in results), key=STOP_REASON_SEVERITY.index)
+    }
+
+class AdmissionQueue:
+    """
+    Limita las peticiones que se procesan a la vez y el número de peticiones en espera.
+    Cuando la cola está llena se rechaza la petición con 429 y la cabecera Retry-After.
+    """
+    def __init__(self, max_concurrent: int, max_queue: int, retry_after: int):
+        self._semaforo = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.en_curso = 0
+        self.en_espera = 0
+        self.rechazadas = 0
     
-    return output_text[0]
+    @asynccontextmanager
+    async def admitir(self):
+        if self._semaforo.locked() and self.en_espera >= self.max_queue:
+            self.rechazadas += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Servidor OCR saturado, inténtalo de nuevo más tarde",
+                headers={"Retry-After": str(self.retry_after)}
+            )
+        self.en_espera += 1
+        try:
+            await self._semaforo.acquire()
+        finally:
+            self.en_espera -= 1
+        self.en_curso += 1
+        try:
+            yield
+        finally:
+            self.en_curso -= 1
+            self._semaforo.release()
+    
+    def status(self) -> dict:
+        return {
+            "en_curso": self.en_curso,
+            "en_espera": self.en_espera,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "rechazadas": self.rechazadas
+        }
+
+admission_queue = AdmissionQueue(OCR_MAX_CONCURRENT, OCR_MAX_QUEUE, OCR_RETRY_AFTER)
 
-def process_ollama_response(image: Image.Image, model_name: str):
+def ollama_generation_info(response_data: dict, max_new_tokens: int) -> dict:
+    """Tokens generados y motivo de parada de la respuesta final de Ollama"""
+    return {
+        "tokens": response_data.get("eval_count", 0),
+        "max_new_tokens": max_new_tokens,
+        "stop_reason": "length" if response_data.get("done_reason") == "length" else "eos"
+    }
+
+def encode_image_for_ollama(image: Image.Image, image_data: Optional[bytes] = None) -> str:
+    """
+    Imagen en base64 para Ollama. Si se tienen los bytes originales y su formato es uno
+    de OLLAMA_PASSTHROUGH_FORMATS se envían tal cual; si no, se recodifica en JPEG, que
+    se codifica mucho más rápido que PNG y ocupa menos en las fotos de cámara.
+    """
+    if image_data is not None:
+        try:
+            image_format = Image.open(io.BytesIO(image_data)).format
+        except Exception:
+            image_format = None
+        if image_format in OLLAMA_PASSTHROUGH_FORMATS:
+            return base64.b64encode(image_data).decode()
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=OLLAMA_JPEG_QUALITY)
+    return base64.b64encode(buffered.getvalue()).decode()
+
+def process_ollama_response(image: Image.Image, model_name: str, image_data: Optional[bytes] = None):
     """Procesa una imagen usando Ollama"""
+    return generate_ollama(image, model_name, image_data)["text"]
+
+def generate_ollama(image: Image.Image, model_name: str, image_data: Optional[bytes] = None) -> dict:
+    """
+    Procesa una imagen usando Ollama y devuelve el texto, los tokens generados y el motivo
+    de parada. Con `image_data` (los bytes subidos) se evita recodificar la imagen.
+    """
+    max_new_tokens = estimate_max_new_tokens(image, OCR_CONFIG[model_name].get("max_new_tokens", OCR_MAX_NEW_TOKENS))
     try:
-        # Convertir la imagen a base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        img_str = encode_image_for_ollama(image, image_data)
         
         # Configurar la URL de Ollama
         ollama_url = os.getenv("OLLAMA_API_URL", "http://localhost:11434")
@@ -108,7 +1062,7 @@ def process_ollama_response(image: Image.Image, model_name: str):
             "stream": False,
             "options": {
                 "temperature": 0.1,  # Temperatura baja para mantener la precisión
-                "num_predict": 2048  # Aumentado para manejar textos más largos
+                "num_predict": max_new_tokens  # Estimado a partir del texto de la imagen
             },
             "images": [img_str]
         }
@@ -128,8 +1082,10 @@ def process_ollama_response(image: Image.Image, model_name: str):
             )
         
         response_data = response.json()
-        return response_data.get("response", "")
+        return {"text": response_data.get("response", ""), **ollama_generation_info(response_data, max_new_tokens)}
         
+    except HTTPException:
+        raise
     except requests.exceptions.ConnectionError as e:
         logger.error(f"Error de conexión con Ollama: {str(e)}")
         raise HTTPException(
@@ -143,6 +1099,263 @@ def process_ollama_response(image: Image.Image, model_name: str):
             detail=f"Error al procesar con Ollama: {str(e)}"
         )
 
+class CancelledCriteria(StoppingCriteria):
+    """Detiene generate cuando el cliente deja de leer la respuesta en streaming"""
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.cancelled.is_set()
+
+async def iterate_in_thread(iterator: Iterator[str]) -> AsyncIterator[str]:
+    """Recorre un iterador bloqueante sin bloquear el bucle de eventos"""
+    loop = asyncio.get_running_loop()
+    end = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, end)
+        if item is end:
+            return
+        yield item
+
+class HoldbackStreamer(TextIteratorStreamer):
+    """
+    TextIteratorStreamer que retiene los últimos `holdback` tokens generados. Al terminar, los
+    tokens retenidos se descartan: quien consume el streamer envía el resto del texto ya
+    recortado por los criterios de parada, para no emitir copias de un bucle que luego se quitan.
+    """
+    def __init__(self, tokenizer, holdback: int, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.holdback = holdback
+        self.pending: List[int] = []
+    
+    def put(self, value):
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            super().put(value)
+            return
+        self.pending.extend(value.reshape(-1).tolist())
+        if len(self.pending) > self.holdback:
+            ready = self.pending[:len(self.pending) - self.holdback]
+            self.pending = self.pending[len(ready):]
+            super().put(torch.tensor(ready))
+    
+    def end(self):
+        self.pending = []
+        super().end()
+
+async def stream_qwen(image: Image.Image, model_name: str, assisted: bool = False, result: Optional[dict] = None) -> AsyncIterator[str]:
+    """
+    Transcribe una imagen con un modelo Qwen devolviendo el texto a medida que se genera.
+    Al terminar, `result` se completa con los tokens generados y el motivo de parada.
+    Los últimos tokens se retienen hasta descartar un bucle de repetición, de modo que el
+    texto concatenado coincide con el de una transcripción sin streaming.
+    """
+    loop = asyncio.get_running_loop()
+    model_data = await loop.run_in_executor(inference_executor, load_qwen_model, model_name)
+    streamer = HoldbackStreamer(
+        model_data["processor"].tokenizer, OCR_REPETITION_WINDOW, skip_prompt=True,
+        skip_special_tokens=True, clean_up_tokenization_spaces=False
+    )
+    cancelled = threading.Event()
+    errors: List[Exception] = []
+    final: Dict[str, str] = {}
+    
+    def generate():
+        try:
+            generated = generate_qwen_batch(
+                [image], model_name, assisted=assisted,
+                stopping_criteria=[CancelledCriteria(cancelled)], streamer=streamer
+            )[0]
+            final["text"] = generated["text"]
+            if result is not None:
+                result.update({key: value for key, value in generated.items() if key != "text"})
+        except Exception as e:
+            errors.append(e)
+            # Desbloquear al consumidor del streamer
+            streamer.end()
+    
+    generation = loop.run_in_executor(inference_executor, generate)
+    try:
+        sent = ""
+        async for text in iterate_in_thread(iter(streamer)):
+            if text:
+                sent += text
+                yield text
+        await generation
+        if errors:
+            raise errors[0]
+        # Enviar lo retenido ya recortado
+        text = final.get("text", "")
+        if text.startswith(sent) and len(text) > len(sent):
+            yield text[len(sent):]
+        elif not text.startswith(sent):
+            logger.warning("El texto enviado en streaming no es prefijo de la transcripción final")
+    finally:
+        cancelled.set()
+
+def stream_ollama_response(
+    image: Image.Image,
+    model_name: str,
+    result: Optional[dict] = None,
+    image_data: Optional[bytes] = None,
+    stop: Optional[threading.Event] = None
+) -> Iterator[str]:
+    """
+    Procesa una imagen usando Ollama con stream: true, devolviendo los fragmentos de texto.
+    Al terminar, `result` se completa con los tokens generados y el motivo de parada.
+    Si se activa `stop`, deja de leer y cierra la conexión con Ollama en el siguiente fragmento.
+    """
+    max_new_tokens = estimate_max_new_tokens(image, OCR_CONFIG[model_name].get("max_new_tokens", OCR_MAX_NEW_TOKENS))
+    img_str = encode_image_for_ollama(image, image_data)
+    ollama_url = os.getenv("OLLAMA_API_URL", "http://localhost:11434")
+    
+    payload = {
+        "model": "gemma3:4b",
+        "prompt": "transcript the text in the image. Do not add any explanations or markdown.",
+        "stream": True,
+        "options": {
+            "temperature": 0.1,
+            "num_predict": max_new_tokens
+        },
+        "images": [img_str]
+    }
+    
+    with requests.post(
+        f"{ollama_url}/api/generate",
+        headers={"Content-Type": "application/json"},
+        json=payload,
+        stream=True
+    ) as response:
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Error en la solicitud a Ollama: {response.text}"
+            )
+        for line in response.iter_lines():
+            if stop is not None and stop.is_set():
+                return
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise HTTPException(status_code=500, detail=f"Error en Ollama: {chunk['error']}")
+            if chunk.get("response"):
+                yield chunk["response"]
+            if chunk.get("done"):
+                if result is not None:
+                    result.update(ollama_generation_info(chunk, max_new_tokens))
+                return
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse que libera la plaza de admisión al terminar la respuesta, también
+    si el cliente se desconecta antes de que se empiece a leer el cuerpo (en ese caso el
+    generador de eventos nunca llega a ejecutarse y su finally no libera la plaza)
+    """
+    def __init__(self, content, admission: AsyncExitStack, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admission = admission
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.admission.aclose()
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def preload_model(model_name: str):
+    """Carga un modelo y, si está activado, ejecuta una generación corta de calentamiento"""
+    model_status[model_name] = "loading"
+    inicio = time.perf_counter()
+    load_qwen_model(model_name)
+    if OCR_WARMUP:
+        process_qwen_batch([Image.new("RGB", (224, 224), "white")], model_name, max_new_tokens=8)
+    model_status[model_name] = "ready"
+    logger.info(f"Modelo {model_name} listo en {time.perf_counter() - inicio:.1f}s")
+
+async def preload_models():
+    """Precarga en el ejecutor de inferencia los modelos configurados en OCR_PRELOAD_MODELS"""
+    loop = asyncio.get_running_loop()
+    for model_name in OCR_PRELOAD_MODELS:
+        try:
+            await loop.run_in_executor(inference_executor, preload_model, model_name)
+        except Exception as e:
+            model_status[model_name] = f"error: {str(e)}"
+            logger.error(f"Error precargando {model_name}: {str(e)}", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # La precarga se hace en segundo plano para que el servidor responda a /health/live
+    # mientras tanto; /health/ready indica cuándo los modelos están listos
+    for model_name in OCR_PRELOAD_MODELS:
+        if OCR_CONFIG.get(model_name, {}).get("type") != "transformers":
+            raise RuntimeError(f"OCR_PRELOAD_MODELS: '{model_name}' no es un modelo transformers de OCR_CONFIG")
+        model_status[model_name] = "pending"
+    preload_task = asyncio.create_task(preload_models())
+    yield
+    preload_task.cancel()
+    for batcher in batchers.values():
+        await batcher.close()
+
+app = FastAPI(lifespan=lifespan)
+
+def decode_image(image_data: bytes) -> Image.Image:
+    """Decodifica los bytes de la imagen a RGB"""
+    return Image.open(io.BytesIO(image_data)).convert("RGB")
+
+@app.post("/predict/{model_name}/stream")
+async def predict_stream(
+    model_name: str,
+    image: UploadFile = File(...),
+    assisted: Optional[bool] = Query(None, description="Decodificación asistida por el modelo borrador (por defecto OCR_ASSISTED_DECODING)")
+):
+    """
+    Variante en streaming de /predict: devuelve eventos SSE `data: {"text": ...}` con el
+    texto a medida que se genera, y un evento final `data: {"done": true}` (o `{"error": ...}`)
+    """
+    if model_name not in OCR_CONFIG:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Modelo '{model_name}' no encontrado. Modelos disponibles: {list(OCR_CONFIG.keys())}"
+        )
+    
+    # La plaza en la cola de admisión se mantiene hasta que termina el streaming
+    admission = AsyncExitStack()
+    await admission.enter_async_context(admission_queue.admitir())
+    try:
+        image_data = await image.read()
+        decoded = await asyncio.get_running_loop().run_in_executor(None, decode_image, image_data)
+    except Exception as e:
+        await admission.aclose()
+        raise HTTPException(status_code=400, detail=f"Imagen no válida: {str(e)}")
+    
+    async def events():
+        # Detiene la lectura de Ollama si el cliente se desconecta antes de terminar
+        stop = threading.Event()
+        # Tokens generados y motivo de parada, que se envían en el evento final
+        result: dict = {}
+        try:
+            if OCR_CONFIG[model_name]["type"] == "transformers":
+                chunks = stream_qwen(decoded, model_name, OCR_ASSISTED_DECODING if assisted is None else assisted, result)
+            else:  # ollama
+                chunks = iterate_in_thread(stream_ollama_response(decoded, model_name, result, image_data, stop))
+            async for text in chunks:
+                yield sse_event({"text": text})
+            yield sse_event({"done": True, **result})
+        except Exception as e:
+            logger.error(f"Error en streaming con {model_name}: {str(e)}", exc_info=True)
+            yield sse_event({"error": getattr(e, "detail", str(e))})
+        finally:
+            # No se cierra el generador de Ollama: puede estar ejecutándose en otro hilo.
+            # Se libera primero la plaza de admisión y se avisa al productor para que termine.
+            try:
+                await admission.aclose()
+            finally:
+                stop.set()
+    
+    return AdmittedStreamingResponse(events(), admission, media_type="text/event-stream")
+
 @app.get("/models")
 def list_models():
     """Lista todos los modelos OCR disponibles"""
@@ -150,8 +1363,38 @@ def list_models():
         "modelos": list(OCR_CONFIG.keys())
     }
 
+@app.get("/models/loaded")
+def loaded_models_status():
+    """Modelos cargados en memoria, memoria que ocupa cada uno y presupuesto configurado"""
+    return {**model_manager.status(), "prefix_cache": prefix_cache_stats, "generation": generation_stats}
+
+@app.get("/health/live")
+def liveness():
+    """El proceso está vivo y atiende peticiones"""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+def readiness():
+    """Los modelos precargados están listos para atender peticiones"""
+    device, _ = select_device()
+    ready = all(status == "ready" for status in model_status.values())
+    content = {"ready": ready, "device": device, "modelos": model_status}
+    if not ready:
+        return JSONResponse(status_code=503, content=content)
+    return content
+
+@app.get("/queue")
+def queue_status():
+    """Estado de la cola de admisión de peticiones"""
+    return admission_queue.status()
+
 @app.post("/predict/{model_name}")
-async def predict(model_name: str, image: UploadFile = File(...)):
+async def predict(
+    model_name: str,
+    image: UploadFile = File(...),
+    tiling: Optional[bool] = Query(None, description="Transcribir por franjas las imágenes altas (por defecto OCR_TILING)"),
+    assisted: Optional[bool] = Query(None, description="Decodificación asistida por el modelo borrador (por defecto OCR_ASSISTED_DECODING)")
+):
     """Endpoint principal para OCR que soporta múltiples modelos"""
     if model_name not in OCR_CONFIG:
         raise HTTPException(
@@ -160,19 +1403,38 @@ async def predict(model_name: str, image: UploadFile = File(...)):
         )
     
     try:
-        # Leer y convertir la imagen
-        image_data = await image.read()
-        image = Image.open(io.BytesIO(image_data)).convert("RGB")
-        
-        # Procesar según el tipo de modelo
-        config = OCR_CONFIG[model_name]
-        if config["type"] == "transformers":
-            result = process_qwen_response(image, model_name)
-        else:  # ollama
-            result = process_ollama_response(image, model_name)
+        async with admission_queue.admitir():
+            # Leer y convertir la imagen fuera del bucle de eventos
+            image_data = await image.read()
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(None, decode_image, image_data)
+            
+            # Procesar según el tipo de modelo
+            config = OCR_CONFIG[model_name]
+            use_tiling = OCR_TILING if tiling is None else tiling
+            use_assisted = (OCR_ASSISTED_DECODING if assisted is None else assisted) and "draft_model" in config
+            if config["type"] == "transformers" and use_tiling and needs_tiling(image):
+                result = await process_tiled(image, model_name, use_assisted)
+            elif use_assisted:
+                # La decodificación asistida genera de una en una: no pasa por el planificador de lotes
+                result = await process_assisted(image, model_name)
+            elif config["type"] == "transformers":
+                # Las peticiones concurrentes al mismo modelo se agrupan en un único generate
+                result = await get_batcher(model_name).submit(image)
+            else:  # ollama
+                # Se pasan los bytes originales para no recodificar la imagen si no hace falta
+                result = await loop.run_in_executor(None, partial(generate_ollama, image, model_name, image_data))
         
-        return {"prediction": result}
+        logger.info(f"{model_name}: {result['tokens']}/{result['max_new_tokens']} tokens generados ({result['stop_reason']})")
+        return {
+            "prediction": result["text"],
+            "tokens": result["tokens"],
+            "max_new_tokens": result["max_new_tokens"],
+            "stop_reason": result["stop_reason"]
+        }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error procesando imagen con {model_name}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error procesando imagen: {str(e)}")
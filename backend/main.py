@@ -2,6 +2,7 @@ from fastapi import FastAPI
 from models.usuario import Base
 from routers import usuario, auth, asignatura, inscripcion, actividad, entrega
 from database import init_db
+from services.ocr_service import OCRServiceFactory
 import asyncio
 import socket
 from contextlib import asynccontextmanager
@@ -34,7 +35,12 @@ async def lifespan(app: FastAPI):
         
     # Inicializar la base de datos
     await init_db()
+    
+    # Sondas de salud periódicas contra los servidores OCR configurados
+    ocr_pool = OCRServiceFactory.get_backend_pool()
+    ocr_pool.start_health_checks(float(os.getenv("OCR_HEALTH_CHECK_INTERVAL", "10")))
     yield
+    await ocr_pool.stop_health_checks()
 
 app = FastAPI(lifespan=lifespan) # Inicializa la base de datos
 
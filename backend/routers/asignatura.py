@@ -12,10 +12,9 @@ from models.usuario import Usuario, TipoUsuario
 from schemas.asignatura import AsignaturaCreate, AsignaturaResponse
 from security import get_current_user
 from models.inscripcion import Inscripcion
-from fastapi.responses import Response
-import csv
-from io import StringIO
-from sqlalchemy import func
+from fastapi.responses import StreamingResponse
+from services.export_service import fila_csv, consulta_en_streaming
+from sqlalchemy import and_, func
 from passlib.context import CryptContext
 
 router = APIRouter()
@@ -344,7 +343,7 @@ async def export_subject_csv(
     - asignatura_id (int): ID de la asignatura
 
     Returns:
-    - Response: Archivo CSV con las calificaciones
+    - StreamingResponse: Archivo CSV con las calificaciones, generado fila a fila
         Incluye: nombre alumno, apellidos, email, actividades y notas
 
     Raises:
@@ -376,80 +375,83 @@ async def export_subject_csv(
             detail="No tienes permiso para exportar las calificaciones de esta asignatura"
         )
 
-    # Obtener todos los alumnos inscritos
-    query_alumnos = (
-        select(Usuario)
+    # Actividades de la asignatura (solo las columnas necesarias)
+    query_actividades = (
+        select(Actividad.id, Actividad.titulo)
+        .where(Actividad.asignatura_id == asignatura_id)
+        .order_by(Actividad.id)
+    )
+    actividades = (await db.execute(query_actividades)).all()
+
+    # Una única consulta con las notas de todos los alumnos inscritos: una fila por entrega
+    # (o una sola fila sin entrega si el alumno no ha entregado nada). No se lee la imagen
+    query_notas = (
+        select(Usuario.id, Usuario.nombre, Usuario.apellidos, Usuario.email, Entrega.actividad_id, Entrega.calificacion)
         .join(Inscripcion, Inscripcion.alumno_id == Usuario.id)
+        .outerjoin(
+            Entrega,
+            and_(
+                Entrega.alumno_id == Usuario.id,
+                Entrega.actividad_id.in_(select(Actividad.id).where(Actividad.asignatura_id == asignatura_id))
+            )
+        )
         .where(
             Inscripcion.asignatura_id == asignatura_id,
             Usuario.tipo_usuario == TipoUsuario.ALUMNO
         )
+        .order_by(Usuario.id, Entrega.id)
+        .execution_options(yield_per=500)
     )
-    result_alumnos = await db.execute(query_alumnos)
-    alumnos = result_alumnos.scalars().all()
-
-    # Obtener todas las actividades de la asignatura
-    query_actividades = select(Actividad).where(Actividad.asignatura_id == asignatura_id)
-    result_actividades = await db.execute(query_actividades)
-    actividades = result_actividades.scalars().all()
 
-    # Crear el CSV
-    output = StringIO()
-    writer = csv.writer(output)
-    
-    # Escribir encabezados
-    headers = ['Nombre', 'Apellidos', 'Email']
-    for actividad in actividades:
-        headers.extend([
-            f'{actividad.titulo} - Estado',
-            f'{actividad.titulo} - Nota'
-        ])
-    headers.append('Nota Media')
-    writer.writerow(headers)
-
-    # Para cada alumno
-    for alumno in alumnos:
+    def fila_alumno(alumno, entregas: dict) -> str:
         row = [alumno.nombre, alumno.apellidos, alumno.email]
         total_notas = 0
         total_actividades = len(actividades)  # Todas las actividades cuentan
-
-        # Para cada actividad
         for actividad in actividades:
-            # Obtener la entrega del alumno para esta actividad
-            query_entrega = (
-                select(Entrega)
-                .where(
-                    Entrega.actividad_id == actividad.id,
-                    Entrega.alumno_id == alumno.id
-                )
-            )
-            result_entrega = await db.execute(query_entrega)
-            entrega = result_entrega.scalar_one_or_none()
-
-            if entrega and entrega.calificacion is not None:
-                row.extend(['Entregado', str(entrega.calificacion)])
-                total_notas += entrega.calificacion
+            calificacion = entregas.get(actividad.id)
+            if calificacion is not None:
+                row.extend(['Entregado', str(calificacion)])
+                total_notas += calificacion
             else:
                 # Si no hay entrega o no está calificada, cuenta como 0
-                row.extend(['No entregado' if not entrega else 'Sin calificar', '0'])
-                # No sumamos nada a total_notas (equivalente a sumar 0)
+                row.extend(['No entregado' if actividad.id not in entregas else 'Sin calificar', '0'])
 
         # Calcular la nota media usando el total de actividades
         nota_media = total_notas / total_actividades if total_actividades > 0 else 0
         row.append(f'{nota_media:.2f}')
-        
-        writer.writerow(row)
+        return fila_csv(row)
 
-    # Preparar la respuesta
-    output.seek(0)
-    response = Response(
-        content=output.getvalue(),
+    async def filas_csv():
+        # Escribir encabezados
+        headers = ['Nombre', 'Apellidos', 'Email']
+        for actividad in actividades:
+            headers.extend([
+                f'{actividad.titulo} - Estado',
+                f'{actividad.titulo} - Nota'
+            ])
+        headers.append('Nota Media')
+        yield fila_csv(headers)
+
+        # Cursor en el servidor: las filas llegan ordenadas por alumno y se agrupan según se leen
+        async with consulta_en_streaming(query_notas) as result:
+            alumno, entregas = None, {}
+            async for fila in result:
+                if alumno is not None and fila.id != alumno.id:
+                    yield fila_alumno(alumno, entregas)
+                    entregas = {}
+                alumno = fila
+                # Si hay varias entregas de una actividad cuenta la última
+                if fila.actividad_id is not None:
+                    entregas[fila.actividad_id] = fila.calificacion
+            if alumno is not None:
+                yield fila_alumno(alumno, entregas)
+
+    return StreamingResponse(
+        filas_csv(),
         media_type='text/csv',
         headers={
             'Content-Disposition': f'attachment; filename=calificaciones_{asignatura_id}.csv'
         }
     )
     
-    return response
-    
 
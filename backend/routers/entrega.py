@@ -9,7 +9,7 @@ from models.entrega import Entrega
 from models.actividad import Actividad
 from models.asignatura import Asignatura
 from models.usuario import Usuario, TipoUsuario
-from schemas.entrega import EntregaCreate, EntregaUpdate, EntregaResponse
+from schemas.entrega import EntregaCreate, EntregaUpdate, EntregaResponse, OCRBatchResponse
 from security import get_current_user
 from datetime import datetime, UTC
 import requests
@@ -18,7 +18,7 @@ import asyncio
 from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 import io
-import csv
+import json
 import google.generativeai as genai
 import os
 import mimetypes
@@ -26,7 +26,8 @@ from enum import Enum
 from typing import Optional
 from abc import ABC, abstractmethod
 import base64
-from services.ocr_service import OCRServiceFactory, QWEN3BOCRService, AzureOCRService, OllamaGemma3OCRService
+from services.export_service import fila_csv, consulta_en_streaming
+from services.ocr_service import OCRServiceFactory, QWEN3BOCRService, AzureOCRService, OllamaGemma3OCRService, procesar_lote_imagenes, limpiar_texto
 from services.evaluador_service import construir_prompt, EvaluadorFactory, EvaluadorIA
 
 router = APIRouter()
@@ -445,6 +446,92 @@ async def process_image_ocr(
     ocr_service = OCRServiceFactory.get_ocr_service()
     return await ocr_service.process_image(image, current_user)
 
+@router.post("/ocr/process-stream")
+async def process_image_ocr_stream(
+    image: UploadFile = File(...),
+    current_user: Usuario = Depends(get_current_user)
+):
+    """
+    Procesa una imagen con el servicio OCR predeterminado y devuelve el texto a medida
+    que se genera, como eventos SSE (text/event-stream):
+    - `data: {"text": "..."}` por cada fragmento de texto
+    - `data: {"done": true}` al terminar
+    - `data: {"error": "..."}` si falla el procesamiento
+
+    Parameters:
+    - image (UploadFile): Archivo de imagen a procesar (JPEG, PNG, GIF o JPG)
+
+    Returns:
+    - StreamingResponse: Eventos SSE con el texto extraído
+    """
+    ocr_service = OCRServiceFactory.get_ocr_service()
+    # Copiar la imagen en memoria: el fichero subido se cierra al devolver la respuesta
+    imagen = UploadFile(
+        file=io.BytesIO(await image.read()),
+        filename=image.filename,
+        headers=image.headers
+    )
+
+    async def eventos():
+        try:
+            async for fragmento in ocr_service.process_image_stream(imagen, current_user):
+                yield f"data: {json.dumps({'text': limpiar_texto(fragmento)}, ensure_ascii=False)}\n\n"
+            yield f"data: {json.dumps({'done': True})}\n\n"
+        except HTTPException as e:
+            yield f"data: {json.dumps({'error': e.detail}, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            # Errores de conexión con el servidor OCR u otros fallos a mitad del streaming
+            print(f"Error en el OCR en streaming: {str(e)}")
+            yield f"data: {json.dumps({'error': f'Error al procesar la imagen: {str(e)}'}, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+
+# Número máximo de imágenes aceptadas en una petición de OCR por lotes
+OCR_BATCH_MAX_IMAGES = int(os.getenv("OCR_BATCH_MAX_IMAGES", "20"))
+
+@router.post("/ocr/process-batch", response_model=OCRBatchResponse)
+async def process_images_ocr_batch(
+    images: List[UploadFile] = File(...),
+    current_user: Usuario = Depends(get_current_user)
+):
+    """
+    Procesa varias imágenes (p. ej. las páginas de una solución) con el servicio OCR
+    predeterminado. Las páginas se procesan de forma concurrente con un límite de
+    peticiones simultáneas y el texto se devuelve concatenado en el orden de envío.
+
+    Parameters:
+    - images (List[UploadFile]): Imágenes a procesar, en orden de página
+
+    Returns:
+    - OCRBatchResponse: Texto concatenado y texto/tiempo de cada página
+
+    Raises:
+    - HTTPException(400): Si no se envía ninguna imagen o se supera el máximo permitido
+    - HTTPException(403): Si el usuario no tiene permisos
+    - HTTPException(500): Si hay un error en el procesamiento OCR
+    """
+    if not images:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Debes enviar al menos una imagen"
+        )
+    if len(images) > OCR_BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"No se pueden procesar más de {OCR_BATCH_MAX_IMAGES} imágenes a la vez"
+        )
+
+    ocr_service = OCRServiceFactory.get_ocr_service()
+    inicio = datetime.now()
+    paginas = await procesar_lote_imagenes(ocr_service, images, current_user)
+    tiempo_total_ms = (datetime.now() - inicio).total_seconds() * 1000
+
+    return {
+        "texto": "\n\n".join(pagina["texto"] for pagina in paginas),
+        "paginas": paginas,
+        "tiempo_total_ms": round(tiempo_total_ms, 2)
+    }
+
 @router.get("/actividad/{actividad_id}/export-csv")
 async def export_submissions_csv(
     actividad_id: int,
@@ -459,7 +546,7 @@ async def export_submissions_csv(
     - actividad_id (int): ID de la actividad
 
     Returns:
-    - StreamingResponse: Archivo CSV con las entregas
+    - StreamingResponse: Archivo CSV con las entregas, generado fila a fila
 
     Raises:
     - HTTPException(403): Si el usuario no es profesor
@@ -471,20 +558,13 @@ async def export_submissions_csv(
             detail="Solo los profesores pueden exportar entregas"
         )
 
-    # Obtener la actividad y sus entregas
+    # Obtener la actividad y el profesor de su asignatura (sin cargar inscripciones ni entregas)
     query = (
-        select(Actividad)
-        .options(
-            selectinload(Actividad.asignatura)
-            .selectinload(Asignatura.inscripciones)
-            .selectinload(Inscripcion.alumno),
-            selectinload(Actividad.entregas)
-            .selectinload(Entrega.alumno)
-        )
+        select(Actividad.titulo, Actividad.asignatura_id, Asignatura.profesor_id)
+        .join(Asignatura, Asignatura.id == Actividad.asignatura_id)
         .where(Actividad.id == actividad_id)
     )
-    result = await db.execute(query)
-    actividad = result.scalar_one_or_none()
+    actividad = (await db.execute(query)).one_or_none()
 
     if not actividad:
         raise HTTPException(
@@ -493,43 +573,59 @@ async def export_submissions_csv(
         )
 
     # Verificar que el profesor tiene acceso a esta actividad
-    if actividad.asignatura.profesor_id != current_user.id:
+    if actividad.profesor_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tienes permiso para exportar estas entregas"
         )
 
-    # Crear el CSV en memoria
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Nombre', 'Apellidos', 'Email', 'Calificación', 'Estado', 'Fecha Entrega'])
-
-    # Para cada alumno inscrito en la asignatura
-    for inscripcion in actividad.asignatura.inscripciones:
-        alumno = inscripcion.alumno
-        # Buscar su entrega
-        entrega = next(
-            (e for e in actividad.entregas if e.alumno_id == alumno.id),
-            None
+    # Alumnos inscritos con su entrega de la actividad, solo con las columnas del CSV
+    query_entregas = (
+        select(
+            Inscripcion.alumno_id,
+            Usuario.nombre,
+            Usuario.apellidos,
+            Usuario.email,
+            Entrega.id.label("entrega_id"),
+            Entrega.calificacion,
+            Entrega.fecha_entrega
         )
+        .join(Usuario, Usuario.id == Inscripcion.alumno_id)
+        .outerjoin(
+            Entrega,
+            and_(Entrega.alumno_id == Inscripcion.alumno_id, Entrega.actividad_id == actividad_id)
+        )
+        .where(Inscripcion.asignatura_id == actividad.asignatura_id)
+        .order_by(Inscripcion.id, Entrega.id.desc())
+        .execution_options(yield_per=500)
+    )
 
-        writer.writerow([
-            alumno.nombre,
-            alumno.apellidos,
-            alumno.email,
-            entrega.calificacion if entrega else "No entregado",
-            "Entregado" if entrega else "No entregado",
-            entrega.fecha_entrega.strftime("%Y-%m-%d %H:%M:%S") if entrega and entrega.fecha_entrega else "-"
-        ])
-
-    # Rebobinar el buffer
-    output.seek(0)
+    async def filas_csv():
+        yield fila_csv(['Nombre', 'Apellidos', 'Email', 'Calificación', 'Estado', 'Fecha Entrega'])
+
+        # Cursor en el servidor: las filas se leen por bloques según se envían
+        async with consulta_en_streaming(query_entregas) as result:
+            ultimo_alumno = None
+            async for fila in result:
+                # Si el alumno tiene varias entregas cuenta la última, como en el CSV de la asignatura
+                if fila.alumno_id == ultimo_alumno:
+                    continue
+                ultimo_alumno = fila.alumno_id
+                entregado = fila.entrega_id is not None
+                yield fila_csv([
+                    fila.nombre,
+                    fila.apellidos,
+                    fila.email,
+                    fila.calificacion if entregado else "No entregado",
+                    "Entregado" if entregado else "No entregado",
+                    fila.fecha_entrega.strftime("%Y-%m-%d %H:%M:%S") if entregado and fila.fecha_entrega else "-"
+                ])
     
     # Generar nombre del archivo
     filename = f"entregas_{actividad.titulo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
     
     return StreamingResponse(
-        iter([output.getvalue()]),
+        filas_csv(),
         media_type="text/csv",
         headers={
             'Content-Disposition': f'attachment; filename="{filename}"'
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 from schemas.actividad import ActividadResponse
 from schemas.usuario import UsuarioResponse
 from fastapi import UploadFile
@@ -30,4 +30,14 @@ class EntregaResponse(EntregaBase):
     #alumno: Optional[UsuarioResponse] = None
 
     class Config:
-        from_attributes = True 
\ No newline at end of file
+        from_attributes = True
+
+class OCRPaginaResponse(BaseModel):
+    pagina: int
+    texto: str
+    tiempo_ms: float
+
+class OCRBatchResponse(BaseModel):
+    texto: str
+    paginas: List[OCRPaginaResponse]
+    tiempo_total_ms: float
@@ -103,7 +103,9 @@ class OllamaEvaluador(EvaluadorIA):
                 "max_tokens": 4096,
                 "temperature": 0.7,
                 "top_p": 0.9,
-                "top_k": 40
+                "top_k": 40,
+                # Si el prompt no cabe en el contexto del modelo, la API recorta la solución y no el enunciado
+                "truncatable": solucion
             }
             
             response = requests.post(
@@ -0,0 +1,33 @@
+import csv
+from contextlib import asynccontextmanager
+from io import StringIO
+from typing import AsyncIterator
+from sqlalchemy.ext.asyncio import AsyncResult
+from database import AsyncSessionLocal
+
+
+def fila_csv(valores: list) -> str:
+    """Convierte una fila en una línea CSV"""
+    buffer = StringIO()
+    csv.writer(buffer).writerow(valores)
+    return buffer.getvalue()
+
+
+@asynccontextmanager
+async def consulta_en_streaming(query) -> AsyncIterator[AsyncResult]:
+    """
+    Ejecuta una consulta con un cursor en el servidor para recorrer sus filas por bloques
+    mientras se envía una respuesta en streaming.
+
+    Cuando empieza la respuesta la sesión de la dependencia get_db ya se ha cerrado, así que
+    se abre una sesión propia, que se cierra al salir del bloque (al terminar o si el cliente
+    se desconecta).
+
+    Args:
+        query: Consulta a ejecutar (con execution_options(yield_per=...) para leer por bloques)
+
+    Returns:
+        AsyncResult: Resultado que se recorre con `async for`
+    """
+    async with AsyncSessionLocal() as session:
+        yield await session.stream(query)
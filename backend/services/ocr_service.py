@@ -1,9 +1,11 @@
 from fastapi import HTTPException, UploadFile, status
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import AsyncIterator, Optional, List
 import requests
 import asyncio
 import base64
+import json
+import time
 import os
 import io
 from models.usuario import Usuario, TipoUsuario
@@ -13,6 +15,188 @@ class OCRService(ABC):
     async def process_image(self, image: UploadFile, current_user: Usuario) -> str:
         """Procesa una imagen y retorna el texto extraído"""
         pass
+    
+    async def process_image_stream(self, image: UploadFile, current_user: Usuario) -> AsyncIterator[str]:
+        """
+        Procesa una imagen devolviendo el texto a medida que se extrae. Los servicios
+        que no admiten streaming devuelven todo el texto en un único fragmento.
+        """
+        yield await self.process_image(image, current_user)
+
+class OCRBackend:
+    """Estado de un servidor de la API OCR (api_IA/ocr.py) dentro del pool"""
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0  # Peticiones en curso contra este servidor
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.last_error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error
+        }
+
+class OCRBackendPool:
+    """
+    Pool de servidores OCR con balanceo por menor número de peticiones en curso.
+    
+    Un servidor se expulsa del pool tras `failure_threshold` fallos consecutivos
+    (de peticiones o de sondas de salud contra /health/ready) y se readmite tras
+    `recovery_threshold` sondas correctas consecutivas.
+    """
+    def __init__(
+        self,
+        urls: List[str],
+        failure_threshold: int = 3,
+        recovery_threshold: int = 2,
+        probe_timeout: float = 5.0,
+        request_timeout: float = 300.0
+    ):
+        if not urls:
+            raise ValueError("El pool de OCR necesita al menos una URL")
+        self.backends = [OCRBackend(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.recovery_threshold = recovery_threshold
+        self.probe_timeout = probe_timeout
+        self.request_timeout = request_timeout
+        self._cursor = 0
+        self._health_task: Optional[asyncio.Task] = None
+
+    @property
+    def urls(self) -> List[str]:
+        return [backend.url for backend in self.backends]
+
+    def select_backend(self, exclude: Optional[List[OCRBackend]] = None) -> OCRBackend:
+        """Elige el servidor sano con menos peticiones en curso (rotando en caso de empate)"""
+        exclude = exclude or []
+        total = len(self.backends)
+        candidatos = [
+            self.backends[(self._cursor + i) % total] for i in range(total)
+        ]
+        candidatos = [b for b in candidatos if b.healthy and b not in exclude]
+        if not candidatos:
+            raise requests.exceptions.ConnectionError("No hay servidores OCR disponibles")
+        self._cursor = (self._cursor + 1) % total
+        return min(candidatos, key=lambda b: b.outstanding)
+
+    def record_success(self, backend: OCRBackend):
+        backend.consecutive_failures = 0
+        backend.consecutive_successes += 1
+        backend.last_error = None
+        if not backend.healthy and backend.consecutive_successes >= self.recovery_threshold:
+            backend.healthy = True
+            print(f"Servidor OCR {backend.url} readmitido en el pool")
+
+    def record_failure(self, backend: OCRBackend, error: str):
+        backend.consecutive_successes = 0
+        backend.consecutive_failures += 1
+        backend.last_error = error
+        if backend.healthy and backend.consecutive_failures >= self.failure_threshold:
+            backend.healthy = False
+            print(f"Servidor OCR {backend.url} expulsado del pool: {error}")
+
+    async def post(self, path: str, **kwargs) -> requests.Response:
+        """
+        Envía una petición POST al mejor servidor disponible. Si la conexión falla
+        se reintenta en el resto de servidores sanos antes de propagar el error.
+        
+        Con stream=True la respuesta se devuelve al recibir las cabeceras: la petición
+        cuenta como en curso hasta que se cierra la respuesta.
+        """
+        intentados: List[OCRBackend] = []
+        ultimo_error: Optional[Exception] = None
+        for _ in range(len(self.backends)):
+            try:
+                backend = self.select_backend(exclude=intentados)
+            except requests.exceptions.ConnectionError as e:
+                ultimo_error = ultimo_error or e
+                break
+            intentados.append(backend)
+            backend.outstanding += 1
+            try:
+                response = await asyncio.to_thread(
+                    requests.post,
+                    f"{backend.url}{path}",
+                    timeout=self.request_timeout,
+                    **kwargs
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                backend.outstanding -= 1
+                self.record_failure(backend, str(e))
+                ultimo_error = e
+                continue
+            except BaseException:
+                backend.outstanding -= 1
+                raise
+            self.record_success(backend)
+            if kwargs.get("stream"):
+                self._release_on_close(response, backend)
+            else:
+                backend.outstanding -= 1
+            return response
+        raise requests.exceptions.ConnectionError(str(ultimo_error))
+
+    @staticmethod
+    def _release_on_close(response: requests.Response, backend: OCRBackend):
+        """Descuenta la petición en curso del servidor al cerrar la respuesta (una sola vez)"""
+        close = response.close
+        liberada = False
+
+        def close_and_release():
+            nonlocal liberada
+            if not liberada:
+                liberada = True
+                backend.outstanding -= 1
+            close()
+
+        response.close = close_and_release
+
+    async def check_backend(self, backend: OCRBackend) -> bool:
+        """
+        Sonda de salud activa contra /health/ready: un servidor que aún está precargando
+        modelos, o en el que alguno falló, responde 503 y no recibe peticiones
+        """
+        try:
+            response = await asyncio.to_thread(
+                requests.get, f"{backend.url}/health/ready", timeout=self.probe_timeout
+            )
+            response.raise_for_status()
+        except Exception as e:
+            self.record_failure(backend, str(e))
+            return False
+        self.record_success(backend)
+        return True
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check_backend(backend) for backend in self.backends))
+
+    async def _run_health_checks(self, interval: float):
+        while True:
+            await self.check_all()
+            await asyncio.sleep(interval)
+
+    def start_health_checks(self, interval: float = 10.0):
+        """Lanza las sondas de salud periódicas en segundo plano"""
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._run_health_checks(interval))
+
+    async def stop_health_checks(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    def status(self) -> List[dict]:
+        return [backend.to_dict() for backend in self.backends]
 
 # Implementación del OCR de la UCO
 class AzureOCRService(OCRService):
@@ -32,7 +216,8 @@ class AzureOCRService(OCRService):
         
         try:
             # Enviar la imagen como datos binarios
-            response = requests.post(
+            response = await asyncio.to_thread(
+                requests.post,
                 os.getenv("AZURE_VISION_ENDPOINT", "https://pruebarafagvision.cognitiveservices.azure.com/vision/v3.2/read/analyze"),
                 headers=headers,
                 data=await image.read()  # Enviar los bytes directamente
@@ -46,7 +231,8 @@ class AzureOCRService(OCRService):
             # Esperar a que el análisis termine
             analysis_result = None
             while True:
-                result_response = requests.get(
+                result_response = await asyncio.to_thread(
+                    requests.get,
                     operation_url,
                     headers={'Ocp-Apim-Subscription-Key': os.getenv("AZURE_API_KEY", "9TnsLp0OUYoyH25UP7V5n3mb2tSnm54J4WySPu0IKZwEJNY4RnJ7JQQJ99ALAC5RqLJXJ3w3AAAFACOGHcqc")}
                 )
@@ -65,51 +251,14 @@ class AzureOCRService(OCRService):
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error al procesar la imagen: {str(e)}")
         
-# Implementación del OCR de Ollama
-class OllamaGemma3OCRService(OCRService):
-    async def process_image(self, image: UploadFile, current_user: Usuario) -> str:
-        try:
-            # Comprobar que el usuario está logueado
-            if current_user.tipo_usuario != TipoUsuario.PROFESOR and current_user.tipo_usuario != TipoUsuario.ALUMNO:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="No tienes permiso para procesar imágenes OCR"
-                )
-                
-            # Configurar la URL de la API OCR
-            api_url = os.getenv("OCR_API_URL", "http://localhost:8000")
-            
-            # Preparar el archivo para enviarlo
-            files = {"image": (image.filename, await image.read(), image.content_type)}
-            
-            # Hacer la petición a la API OCR
-            response = requests.post(
-                f"{api_url}/predict/gemma3:4b",
-                files=files
-            )
-            
-            if response.status_code == 404:
-                raise HTTPException(
-                    status_code=404,
-                    detail="Servicio OCR no encontrado. Verifica que la API OCR esté funcionando correctamente."
-                )
-            
-            response.raise_for_status()
-            
-            # Extraer la respuesta
-            response_data = response.json()
-            return response_data.get("prediction", "")
-            
-        except requests.exceptions.ConnectionError:
-            error_msg = f"No se pudo conectar al servicio OCR en {api_url}. Verifica que el servicio esté activo."
-           
-            raise HTTPException(status_code=503, detail=error_msg)
-        except Exception as e:
-            error_msg = f"Error en Ollama OCR API: {str(e)}"
-           
-            raise HTTPException(status_code=500, detail=error_msg)
+# Implementación base de los OCR servidos por nuestra API OCR (api_IA/ocr.py)
+class RemoteOCRService(OCRService):
+    modelo: str = ""  # Nombre del modelo en la API OCR
+    nombre: str = ""  # Nombre para los mensajes de error
+
+    def __init__(self, pool: Optional[OCRBackendPool] = None):
+        self.pool = pool or OCRServiceFactory.get_backend_pool()
 
-class QWEN3BOCRService(OCRService):
     async def process_image(self, image: UploadFile, current_user: Usuario) -> str:
         try:
             # Comprobar que el usuario está logueado
@@ -118,23 +267,18 @@ class QWEN3BOCRService(OCRService):
                     status_code=status.HTTP_403_FORBIDDEN,
                     detail="No tienes permiso para procesar imágenes OCR"
                 )
-                
-            # Configurar la URL de la API OCR
-            api_url = os.getenv("OCR_API_URL", "http://localhost:8000")
             
             # Preparar el archivo para enviarlo
             files = {"image": (image.filename, await image.read(), image.content_type)}
             
-            # Hacer la petición a la API OCR
-            response = requests.post(
-                f"{api_url}/predict/qwen3b",
-                files=files
-            )
+            # Hacer la petición al servidor OCR con menos carga
+            response = await self.pool.post(f"/predict/{self.modelo}", files=files)
             
             if response.status_code == 404:
+                # Un 404 del servidor OCR es un fallo de configuración: se devuelve como 500
                 raise HTTPException(
-                    status_code=404,
-                    detail="Servicio OCR no encontrado. Verifica que la API OCR esté funcionando correctamente."
+                    status_code=500,
+                    detail=f"Error en {self.nombre} OCR API: 404: Servicio OCR no encontrado. Verifica que la API OCR esté funcionando correctamente."
                 )
             
             response.raise_for_status()
@@ -143,57 +287,198 @@ class QWEN3BOCRService(OCRService):
             response_data = response.json()
             return response_data.get("prediction", "")
             
+        except HTTPException:
+            raise
         except requests.exceptions.ConnectionError:
-            error_msg = f"No se pudo conectar al servicio OCR en {api_url}. Verifica que el servicio esté activo."
+            error_msg = f"No se pudo conectar al servicio OCR en {', '.join(self.pool.urls)}. Verifica que el servicio esté activo."
             
             raise HTTPException(status_code=503, detail=error_msg)
         except Exception as e:
-            error_msg = f"Error en QWEN3B OCR API: {str(e)}"
+            error_msg = f"Error en {self.nombre} OCR API: {str(e)}"
             
             raise HTTPException(status_code=500, detail=error_msg)
 
-class QWEN7BOCRService(OCRService):
-    async def process_image(self, image: UploadFile, current_user: Usuario) -> str:
-        try:
-            # Comprobar que el usuario está logueado
-            if current_user.tipo_usuario != TipoUsuario.PROFESOR and current_user.tipo_usuario != TipoUsuario.ALUMNO:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="No tienes permiso para procesar imágenes OCR"
-                )
-                
-            # Configurar la URL de la API OCR
-            api_url = os.getenv("OCR_API_URL", "http://localhost:8000")
-            
-            # Preparar el archivo para enviarlo
-            files = {"image": (image.filename, await image.read(), image.content_type)}
-            
-            # Hacer la petición a la API OCR
-            response = requests.post(
-                f"{api_url}/predict/qwen7b",
-                files=files
+    async def process_image_stream(self, image: UploadFile, current_user: Usuario) -> AsyncIterator[str]:
+        # Comprobar que el usuario está logueado
+        if current_user.tipo_usuario != TipoUsuario.PROFESOR and current_user.tipo_usuario != TipoUsuario.ALUMNO:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="No tienes permiso para procesar imágenes OCR"
             )
-            
-            if response.status_code == 404:
-                raise HTTPException(
-                    status_code=404,
-                    detail="Servicio OCR no encontrado. Verifica que la API OCR esté funcionando correctamente."
-                )
-            
-            response.raise_for_status()
-            
-            # Extraer la respuesta
-            response_data = response.json()
-            return response_data.get("prediction", "")
-            
+        
+        files = {"image": (image.filename, await image.read(), image.content_type)}
+        try:
+            response = await self.pool.post(f"/predict/{self.modelo}/stream", files=files, stream=True)
         except requests.exceptions.ConnectionError:
-            error_msg = f"No se pudo conectar al servicio OCR en {api_url}. Verifica que el servicio esté activo."
+            raise HTTPException(
+                status_code=503,
+                detail=f"No se pudo conectar al servicio OCR en {', '.join(self.pool.urls)}. Verifica que el servicio esté activo."
+            )
+        
+        try:
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=f"Error en {self.nombre} OCR API: {response.text}")
             
-            raise HTTPException(status_code=503, detail=error_msg)
+            # Leer los eventos SSE en un hilo para no bloquear el bucle de eventos
+            lineas = response.iter_lines(decode_unicode=True)
+            while True:
+                linea = await asyncio.to_thread(next, lineas, None)
+                if linea is None:
+                    return
+                if not linea.startswith("data: "):
+                    continue
+                evento = json.loads(linea[len("data: "):])
+                if "error" in evento:
+                    raise HTTPException(status_code=500, detail=f"Error en {self.nombre} OCR API: {evento['error']}")
+                if evento.get("done"):
+                    return
+                yield evento.get("text", "")
+        finally:
+            response.close()
+
+# Implementación del OCR de Ollama
+class OllamaGemma3OCRService(RemoteOCRService):
+    modelo = "gemma3:4b"
+    nombre = "Ollama"
+
+class QWEN3BOCRService(RemoteOCRService):
+    modelo = "qwen3b"
+    nombre = "QWEN3B"
+
+class QWEN7BOCRService(RemoteOCRService):
+    modelo = "qwen7b"
+    nombre = "QWEN7B"
+
+def parsear_tsv_tesseract(tsv: str) -> tuple[str, float]:
+    """
+    Reconstruye el texto a partir de la salida TSV de Tesseract y calcula su confianza.
+    
+    La sangría de cada línea se aproxima a partir de la posición horizontal de la primera
+    palabra, ya que en las soluciones de código la indentación es relevante.
+    
+    Args:
+        tsv: Salida de `tesseract ... tsv`
+        
+    Returns:
+        Tupla (texto, confianza media ponderada por número de caracteres, de 0 a 100)
+    """
+    lineas = {}  # (bloque, párrafo, línea) -> lista de (left, ancho, texto)
+    suma_confianza = 0.0
+    total_caracteres = 0
+    for fila in tsv.splitlines()[1:]:
+        campos = fila.split("\t")
+        if len(campos) < 12 or campos[0] != "5":  # Nivel 5 = palabra
+            continue
+        texto = campos[11]
+        confianza = float(campos[10])
+        if not texto.strip() or confianza < 0:
+            continue
+        clave = (int(campos[2]), int(campos[3]), int(campos[4]))
+        lineas.setdefault(clave, []).append((int(campos[6]), int(campos[8]), texto))
+        suma_confianza += confianza * len(texto)
+        total_caracteres += len(texto)
+    
+    if not lineas:
+        return "", 0.0
+    
+    # Ancho medio de un carácter para traducir píxeles a espacios de sangría
+    palabras = [p for palabras_linea in lineas.values() for p in palabras_linea]
+    ancho_caracter = max(sum(p[1] for p in palabras) / sum(len(p[2]) for p in palabras), 1.0)
+    margen = min(p[0] for p in palabras)
+    
+    salida = []
+    bloque_anterior = None
+    for clave in sorted(lineas):
+        palabras_linea = sorted(lineas[clave])
+        if bloque_anterior is not None and clave[:2] != bloque_anterior:
+            salida.append("")
+        sangria = " " * round((palabras_linea[0][0] - margen) / ancho_caracter)
+        salida.append(sangria + " ".join(p[2] for p in palabras_linea))
+        bloque_anterior = clave[:2]
+    
+    return "\n".join(salida), suma_confianza / total_caracteres
+
+async def ejecutar_tesseract(contenido: bytes) -> tuple[str, float]:
+    """
+    Ejecuta el binario local de Tesseract sobre una imagen.
+    
+    Args:
+        contenido: Bytes de la imagen
+        
+    Returns:
+        Tupla (texto, confianza de 0 a 100)
+        
+    Raises:
+        OSError: Si no se encuentra el binario de Tesseract
+        RuntimeError: Si Tesseract termina con error
+    """
+    proceso = await asyncio.create_subprocess_exec(
+        os.getenv("TESSERACT_CMD", "tesseract"), "stdin", "stdout",
+        "-l", os.getenv("TESSERACT_LANG", "spa+eng"),
+        "-c", "preserve_interword_spaces=1",
+        "tsv",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    salida, error = await proceso.communicate(contenido)
+    if proceso.returncode != 0:
+        raise RuntimeError(f"Tesseract terminó con código {proceso.returncode}: {error.decode(errors='ignore')}")
+    return parsear_tsv_tesseract(salida.decode(errors="ignore"))
+
+# Implementación del OCR local con Tesseract
+class TesseractOCRService(OCRService):
+    async def process_image(self, image: UploadFile, current_user: Usuario) -> str:
+        # Comprobar que el usuario está logueado
+        if current_user.tipo_usuario != TipoUsuario.PROFESOR and current_user.tipo_usuario != TipoUsuario.ALUMNO:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="No tienes permiso para procesar imágenes OCR"
+            )
+        
+        try:
+            texto, _ = await ejecutar_tesseract(await image.read())
+            return texto
+        except OSError as e:
+            raise HTTPException(status_code=503, detail=f"Tesseract no está disponible: {str(e)}")
         except Exception as e:
-            error_msg = f"Error en QWEN7B OCR API: {str(e)}"
-            
-            raise HTTPException(status_code=500, detail=error_msg)
+            raise HTTPException(status_code=500, detail=f"Error en Tesseract OCR: {str(e)}")
+
+# OCR en cascada: Tesseract primero y el modelo de visión solo si la confianza es baja
+class CascadeOCRService(OCRService):
+    # Imágenes resueltas por Tesseract y por el modelo de respaldo. Se comparten entre todas
+    # las instancias, ya que la factoría crea un servicio nuevo en cada petición
+    estadisticas = {"tesseract": 0, "fallback": 0}
+    
+    def __init__(self, fallback: Optional[OCRService] = None, threshold: Optional[float] = None):
+        if fallback is None:
+            nombre_fallback = os.getenv("OCR_CASCADE_FALLBACK", "qwen7b").lower()
+            # Evitar que la cascada se use a sí misma como respaldo
+            fallback = OCRServiceFactory.get_ocr_service("qwen7b" if nombre_fallback == "cascade" else nombre_fallback)
+        self.fallback = fallback
+        self.threshold = threshold if threshold is not None else float(os.getenv("OCR_CASCADE_THRESHOLD", "80"))
+    
+    async def process_image(self, image: UploadFile, current_user: Usuario) -> str:
+        # Comprobar que el usuario está logueado
+        if current_user.tipo_usuario != TipoUsuario.PROFESOR and current_user.tipo_usuario != TipoUsuario.ALUMNO:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="No tienes permiso para procesar imágenes OCR"
+            )
+        
+        try:
+            texto, confianza = await ejecutar_tesseract(await image.read())
+            if texto.strip() and confianza >= self.threshold:
+                CascadeOCRService.estadisticas["tesseract"] += 1
+                return texto
+            print(f"Confianza de Tesseract {confianza:.1f} < {self.threshold}, usando el modelo de visión")
+        except (OSError, RuntimeError) as e:
+            print(f"Tesseract no disponible, usando el modelo de visión: {str(e)}")
+        
+        # Rebobinar la imagen para que el servicio de respaldo pueda leerla de nuevo
+        await image.seek(0)
+        CascadeOCRService.estadisticas["fallback"] += 1
+        return await self.fallback.process_image(image, current_user)
 
 # Factory para crear servicios OCR
 class OCRServiceFactory:
@@ -202,14 +487,29 @@ class OCRServiceFactory:
         "qwen3b": QWEN3BOCRService,
         "qwen7b": QWEN7BOCRService,
         "gemma3": OllamaGemma3OCRService,
-        
+        "tesseract": TesseractOCRService,
+        "cascade": CascadeOCRService,
     }
+    _backend_pool: Optional[OCRBackendPool] = None
     
     @classmethod
-    def get_ocr_service(cls) -> OCRService:
-        # Obtener el servicio OCR configurado en las variables de entorno
+    def get_backend_pool(cls) -> OCRBackendPool:
+        # OCR_API_URL admite varias URLs separadas por comas
+        if cls._backend_pool is None:
+            urls = [url.strip() for url in os.getenv("OCR_API_URL", "http://localhost:8000").split(",") if url.strip()]
+            cls._backend_pool = OCRBackendPool(
+                urls,
+                failure_threshold=int(os.getenv("OCR_BACKEND_FAILURE_THRESHOLD", "3")),
+                recovery_threshold=int(os.getenv("OCR_BACKEND_RECOVERY_THRESHOLD", "2")),
+                request_timeout=float(os.getenv("OCR_REQUEST_TIMEOUT", "300"))
+            )
+        return cls._backend_pool
+    
+    @classmethod
+    def get_ocr_service(cls, nombre: Optional[str] = None) -> OCRService:
+        # Obtener el servicio OCR indicado o el configurado en las variables de entorno
         # Por defecto, usar el servicio de la UCO
-        ocr_service = os.getenv("OCR_SERVICE", "qwen7b").lower()
+        ocr_service = (nombre or os.getenv("OCR_SERVICE", "qwen7b")).lower()
         
         # Obtener la clase de servicio
         service_class = cls._services.get(ocr_service)
@@ -240,4 +540,52 @@ def limpiar_texto(texto: str) -> str:
     
     # Aquí se pueden agregar más reglas de limpieza si es necesario
     
-    return texto_limpio 
\ No newline at end of file
+    return texto_limpio
+
+# Número máximo de páginas que se envían a la vez al servicio OCR en un lote
+OCR_BATCH_CONCURRENCY = int(os.getenv("OCR_BATCH_CONCURRENCY", "4"))
+
+async def procesar_lote_imagenes(
+    ocr_service: OCRService,
+    images: List[UploadFile],
+    current_user: Usuario,
+    max_concurrency: Optional[int] = None
+) -> List[dict]:
+    """
+    Procesa varias imágenes con el servicio OCR de forma concurrente, limitando
+    el número de peticiones simultáneas y conservando el orden de las páginas.
+    
+    Args:
+        ocr_service: Servicio OCR a utilizar
+        images: Lista de imágenes a procesar, en orden de página
+        current_user: Usuario que realiza la petición
+        max_concurrency: Máximo de páginas procesadas a la vez (por defecto OCR_BATCH_CONCURRENCY)
+        
+    Returns:
+        Lista con el texto y el tiempo de procesamiento de cada página, en el mismo orden
+        
+    Raises:
+        La excepción de la primera página que falle, tras cancelar las pendientes
+    """
+    semaforo = asyncio.Semaphore(max_concurrency or OCR_BATCH_CONCURRENCY)
+    
+    async def procesar_pagina(indice: int, image: UploadFile) -> dict:
+        async with semaforo:
+            inicio = time.perf_counter()
+            texto = await ocr_service.process_image(image, current_user)
+            return {
+                "pagina": indice + 1,
+                "texto": limpiar_texto(texto),
+                "tiempo_ms": round((time.perf_counter() - inicio) * 1000, 2)
+            }
+    
+    tareas = [asyncio.create_task(procesar_pagina(i, image)) for i, image in enumerate(images)]
+    try:
+        # gather devuelve los resultados en el orden de las tareas, no en el de finalización
+        return list(await asyncio.gather(*tareas))
+    except BaseException:
+        # Si falla una página (o se cancela la petición) no se sigue con las demás
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        raise
@@ -0,0 +1,212 @@
+"""
+Benchmark de las exportaciones a CSV con clases de tamaño realista:
+
+- Calificaciones de una asignatura: la consulta por cada pareja (alumno, actividad) que se
+  usaba antes frente a la consulta única de `export_subject_csv`.
+- Entregas de una actividad: cargar la actividad con sus inscripciones y entregas completas
+  (imágenes incluidas) frente al cursor sobre la consulta de columnas de `export_submissions_csv`.
+
+Crea una base de datos SQLite temporal (o usa --db-url) con alumnos, actividades y
+entregas con imagen, e informa del tiempo, el número de consultas y el pico de memoria.
+
+Uso (desde el directorio backend):
+python tests/benchmarks/bench_export_csv.py --alumnos 200 --actividades 30
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+from datetime import datetime, UTC
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import selectinload
+
+from database import Base
+from models.actividad import Actividad
+from models.asignatura import Asignatura
+from models.entrega import Entrega
+from models.inscripcion import Inscripcion
+from models.usuario import TipoUsuario, Usuario
+from routers.asignatura import export_subject_csv
+from routers.entrega import export_submissions_csv
+import services.export_service
+from utils import percentil
+
+
+async def poblar(engine, alumnos: int, actividades: int, kb_imagen: int) -> int:
+    """Crea una asignatura con sus alumnos, actividades y entregas y devuelve su id"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        profesor_id = (await conn.execute(insert(Usuario).returning(Usuario.id), [{
+            "nombre": "Profesor", "apellidos": "Bench", "email": "profesor@bench.com",
+            "contrasena": "-", "tipo_usuario": TipoUsuario.PROFESOR
+        }])).scalar_one()
+        asignatura_id = (await conn.execute(insert(Asignatura).returning(Asignatura.id), [{
+            "nombre": "Asignatura", "descripcion": "-", "profesor_id": profesor_id, "codigo_acceso": "-"
+        }])).scalar_one()
+        alumno_ids = (await conn.execute(insert(Usuario).returning(Usuario.id), [{
+            "nombre": f"Alumno{i}", "apellidos": "Bench", "email": f"alumno{i}@bench.com",
+            "contrasena": "-", "tipo_usuario": TipoUsuario.ALUMNO
+        } for i in range(alumnos)])).scalars().all()
+        await conn.execute(insert(Inscripcion), [{"alumno_id": a, "asignatura_id": asignatura_id} for a in alumno_ids])
+        actividad_ids = (await conn.execute(insert(Actividad).returning(Actividad.id), [{
+            "titulo": f"Actividad {i}", "descripcion": "-", "fecha_entrega": datetime.now(UTC),
+            "asignatura_id": asignatura_id
+        } for i in range(actividades)])).scalars().all()
+
+        # El 85% de los alumnos entrega cada actividad y el 90% de las entregas está calificado
+        imagen = os.urandom(kb_imagen * 1024)
+        entregas = [
+            {
+                "alumno_id": a, "actividad_id": act, "imagen": imagen, "tipo_imagen": "image/jpeg",
+                "calificacion": round(random.uniform(0, 10), 1) if random.random() < 0.9 else None
+            }
+            for a in alumno_ids for act in actividad_ids if random.random() < 0.85
+        ]
+        for inicio in range(0, len(entregas), 500):
+            await conn.execute(insert(Entrega), entregas[inicio:inicio + 500])
+    return asignatura_id
+
+
+async def por_pareja(db: AsyncSession, asignatura_id: int) -> str:
+    """Implementación anterior: una consulta de Entrega completa por cada (alumno, actividad)"""
+    alumnos = (await db.execute(
+        select(Usuario).join(Inscripcion, Inscripcion.alumno_id == Usuario.id)
+        .where(Inscripcion.asignatura_id == asignatura_id, Usuario.tipo_usuario == TipoUsuario.ALUMNO)
+    )).scalars().all()
+    actividades = (await db.execute(select(Actividad).where(Actividad.asignatura_id == asignatura_id))).scalars().all()
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Nombre', 'Apellidos', 'Email'] + [t for a in actividades for t in (f'{a.titulo} - Estado', f'{a.titulo} - Nota')] + ['Nota Media'])
+    for alumno in alumnos:
+        row = [alumno.nombre, alumno.apellidos, alumno.email]
+        total = 0
+        for actividad in actividades:
+            entrega = (await db.execute(
+                select(Entrega).where(Entrega.actividad_id == actividad.id, Entrega.alumno_id == alumno.id)
+            )).scalar_one_or_none()
+            if entrega and entrega.calificacion is not None:
+                row.extend(['Entregado', str(entrega.calificacion)])
+                total += entrega.calificacion
+            else:
+                row.extend(['No entregado' if not entrega else 'Sin calificar', '0'])
+        row.append(f'{total / len(actividades) if actividades else 0:.2f}')
+        writer.writerow(row)
+    return output.getvalue()
+
+
+async def profesor(db: AsyncSession) -> Usuario:
+    return (await db.execute(select(Usuario).where(Usuario.tipo_usuario == TipoUsuario.PROFESOR))).scalar_one()
+
+
+async def primera_actividad(db: AsyncSession, asignatura_id: int) -> int:
+    return (await db.execute(select(func.min(Actividad.id)).where(Actividad.asignatura_id == asignatura_id))).scalar_one()
+
+
+async def consulta_unica(db: AsyncSession, asignatura_id: int) -> str:
+    response = await export_subject_csv(asignatura_id, db=db, current_user=await profesor(db))
+    return "".join([fila async for fila in response.body_iterator])
+
+
+async def entregas_en_memoria(db: AsyncSession, asignatura_id: int) -> str:
+    """Implementación anterior: la actividad con todas sus inscripciones y entregas completas"""
+    actividad = (await db.execute(
+        select(Actividad)
+        .options(
+            selectinload(Actividad.asignatura).selectinload(Asignatura.inscripciones).selectinload(Inscripcion.alumno),
+            selectinload(Actividad.entregas).selectinload(Entrega.alumno)
+        )
+        .where(Actividad.id == await primera_actividad(db, asignatura_id))
+    )).scalar_one()
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Nombre', 'Apellidos', 'Email', 'Calificación', 'Estado', 'Fecha Entrega'])
+    for inscripcion in actividad.asignatura.inscripciones:
+        alumno = inscripcion.alumno
+        # Si el alumno tiene varias entregas cuenta la última
+        entrega = max((e for e in actividad.entregas if e.alumno_id == alumno.id), key=lambda e: e.id, default=None)
+        writer.writerow([
+            alumno.nombre,
+            alumno.apellidos,
+            alumno.email,
+            entrega.calificacion if entrega else "No entregado",
+            "Entregado" if entrega else "No entregado",
+            entrega.fecha_entrega.strftime("%Y-%m-%d %H:%M:%S") if entrega and entrega.fecha_entrega else "-"
+        ])
+    return output.getvalue()
+
+
+async def entregas_cursor(db: AsyncSession, asignatura_id: int) -> str:
+    response = await export_submissions_csv(await primera_actividad(db, asignatura_id), db=db, current_user=await profesor(db))
+    return "".join([fila async for fila in response.body_iterator])
+
+
+EXPORTACIONES = {
+    "calificaciones": {"por_pareja": por_pareja, "consulta_unica": consulta_unica},
+    "entregas": {"en_memoria": entregas_en_memoria, "cursor": entregas_cursor},
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--alumnos", type=int, default=200)
+    parser.add_argument("--actividades", type=int, default=30)
+    parser.add_argument("--kb-imagen", type=int, default=200, help="Tamaño de la imagen de cada entrega en KB")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--db-url", help="Base de datos vacía en la que crear los datos (por defecto SQLite temporal)")
+    parser.add_argument("--exportacion", choices=list(EXPORTACIONES), help="Medir solo una exportación")
+    args = parser.parse_args()
+
+    directorio = tempfile.TemporaryDirectory()
+    engine = create_async_engine(args.db_url or f"sqlite+aiosqlite:///{directorio.name}/bench.db")
+    asignatura_id = await poblar(engine, args.alumnos, args.actividades, args.kb_imagen)
+    # Las exportaciones en streaming abren su propia sesión: se enlazan a la base de datos del benchmark
+    sesiones = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    services.export_service.AsyncSessionLocal = sesiones
+
+    consultas = 0
+    def contar(*_):
+        nonlocal consultas
+        consultas += 1
+    event.listen(engine.sync_engine, "before_cursor_execute", contar)
+
+    print(f"{args.alumnos} alumnos, {args.actividades} actividades, imágenes de {args.kb_imagen} KB")
+    for exportacion, estrategias in EXPORTACIONES.items():
+        if args.exportacion and exportacion != args.exportacion:
+            continue
+        print(f"\n{exportacion}")
+        print(f"{'estrategia':<16}{'p50 s':>10}{'p95 s':>10}{'consultas':>11}{'pico MB':>10}")
+        resultados = {}
+        for nombre, estrategia in estrategias.items():
+            tiempos, picos = [], []
+            for _ in range(args.repeticiones):
+                consultas = 0
+                tracemalloc.start()
+                inicio = time.perf_counter()
+                async with AsyncSession(engine, expire_on_commit=False) as db:
+                    resultados[nombre] = await estrategia(db, asignatura_id)
+                tiempos.append(time.perf_counter() - inicio)
+                picos.append(tracemalloc.get_traced_memory()[1] / 1024**2)
+                tracemalloc.stop()
+            print(f"{nombre:<16}{percentil(tiempos, 50):>10.3f}{percentil(tiempos, 95):>10.3f}{consultas:>11}{max(picos):>10.1f}")
+
+        anterior, nueva = resultados.values()
+        print(f"CSV idénticos: {anterior.splitlines() == nueva.splitlines()}")
+    await engine.dispose()
+    directorio.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""
+Benchmark de la cache persistente de respuestas del proxy LLM: reproduce una traza de
+peticiones contra un proxy en marcha y mide la tasa de aciertos y la latencia de las
+respuestas servidas desde la cache frente a las generadas por el modelo.
+
+La traza es un fichero JSONL con una petición por línea:
+{"llm_name": "llama3", "payload": {"model": "llama3", "prompt": "...", "temperature": 0}}
+
+Uso (desde el directorio backend, con api_IA/llm.py en marcha):
+python tests/benchmarks/bench_llm_cache.py --traza traza.jsonl --url http://localhost:8001
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils import percentil
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--traza", required=True, help="Fichero JSONL con las peticiones a reproducir")
+    parser.add_argument("--url", default="http://localhost:8001", help="URL base del proxy LLM")
+    parser.add_argument("--vaciar", action="store_true", help="Vaciar la cache antes de empezar")
+    parser.add_argument("--admin-token", default=os.getenv("LLM_ADMIN_TOKEN"), help="Token de /admin/cache (LLM_ADMIN_TOKEN del proxy)")
+    args = parser.parse_args()
+
+    with open(args.traza, encoding="utf-8") as f:
+        traza = [json.loads(linea) for linea in f if linea.strip()]
+
+    cabeceras = {"X-Admin-Token": args.admin_token} if args.admin_token else {}
+    latencias = {"HIT": [], "MISS": []}
+    errores = 0
+    with httpx.Client(base_url=args.url, timeout=None, headers=cabeceras) as client:
+        if args.vaciar:
+            client.delete("/admin/cache").raise_for_status()
+        for peticion in traza:
+            inicio = time.perf_counter()
+            response = client.post(f"/chat/{peticion['llm_name']}", json=peticion["payload"])
+            duracion = time.perf_counter() - inicio
+            if response.status_code != 200:
+                errores += 1
+                continue
+            latencias[response.headers.get("X-Cache", "MISS")].append(duracion)
+        response = client.get("/admin/cache", params={"limit": 0})
+        response.raise_for_status()
+        estado = response.json()
+
+    total = len(latencias["HIT"]) + len(latencias["MISS"])
+    print(f"{len(traza)} peticiones ({errores} con error) contra {args.url}")
+    if total:
+        print(f"Tasa de aciertos: {len(latencias['HIT']) / total:.1%}")
+    print(f"{'origen':<8}{'peticiones':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for origen, tiempos in latencias.items():
+        if tiempos:
+            print(f"{origen:<8}{len(tiempos):>12}{percentil(tiempos, 50) * 1000:>10.1f}{percentil(tiempos, 95) * 1000:>10.1f}")
+    print(
+        f"Cache: {estado['entries']} entradas, {estado['size_mb']} de {estado['max_size_mb']} MB, "
+        f"{estado['evictions']} expulsiones, tasa de aciertos acumulada {estado['hit_ratio']:.1%}"
+    )
+
+
+if __name__ == "__main__":
+    main()
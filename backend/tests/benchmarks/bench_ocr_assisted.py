@@ -0,0 +1,100 @@
+"""
+Benchmark de la decodificación asistida: el modelo grande genera solo o verificando los
+tokens que propone su modelo borrador (por defecto qwen7b con qwen3b).
+
+Informa de la latencia, la velocidad en tokens/s, la tasa aproximada de tokens del
+borrador aceptados y si las transcripciones coinciden con la generación normal.
+
+Uso (en el entorno del servidor OCR, desde el directorio backend):
+python tests/benchmarks/bench_ocr_assisted.py --muestras ruta/a/muestras --modelo qwen7b
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import io
+from PIL import Image
+import ocr
+from utils import cargar_muestras, cer, percentil
+
+
+class ContadorLlamadas:
+    """Cuenta las llamadas a forward de un modelo"""
+    def __init__(self, model):
+        self.llamadas = 0
+        model.register_forward_hook(self._contar)
+
+    def _contar(self, *args):
+        self.llamadas += 1
+
+
+def generar(imagen, modelo, asistida):
+    """Devuelve el texto y el número de tokens generados"""
+    with ocr.model_manager.use(modelo) as model_data:
+        processor = model_data["processor"]
+        inputs = ocr.build_qwen_inputs([imagen], modelo, processor, model_data["model"].device)
+        if asistida:
+            generated_ids = ocr.assisted_generate(model_data, modelo, inputs, max_new_tokens=1024)
+        else:
+            generated_ids = ocr.qwen_generate(model_data, inputs, max_new_tokens=1024)
+        nuevos = generated_ids[0, inputs["input_ids"].shape[1]:]
+        return processor.decode(nuevos, skip_special_tokens=True, clean_up_tokenization_spaces=False), len(nuevos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--muestras", required=True, help="Directorio con imágenes y sus .txt de referencia")
+    parser.add_argument("--modelo", default="qwen7b", choices=[m for m, c in ocr.OCR_CONFIG.items() if "draft_model" in c])
+    args = parser.parse_args()
+
+    muestras = cargar_muestras(args.muestras)
+    imagenes = [(Image.open(io.BytesIO(datos)).convert("RGB"), referencia) for _, datos, referencia in muestras]
+
+    # Cargar y calentar ambos modelos antes de medir
+    ocr.preload_model(args.modelo)
+    borrador = ocr.load_draft_model(args.modelo)
+    if borrador is None:
+        print(f"El modelo borrador de {args.modelo} no está disponible: no hay nada que comparar")
+        return
+    contador_principal = ContadorLlamadas(ocr.model_manager.get(args.modelo)["model"])
+    contador_borrador = ContadorLlamadas(ocr.model_manager.get(borrador)["model"])
+
+    print(f"{len(imagenes)} muestras con {args.modelo} (borrador {borrador}) en {ocr.select_device()[0]}")
+    print(f"{'modo':<10}{'p50 s':>10}{'p95 s':>10}{'tokens/s':>10}{'CER':>10}{'aceptados':>11}")
+    textos = {}
+    latencias_medias = {}
+    for modo, asistida in (("normal", False), ("asistida", True)):
+        latencias, tokens, errores, textos[modo] = [], 0, [], []
+        aceptados, propuestos = 0, 0
+        for imagen, referencia in imagenes:
+            principal_antes, borrador_antes = contador_principal.llamadas, contador_borrador.llamadas
+            inicio = time.perf_counter()
+            texto, generados = generar(imagen, args.modelo, asistida)
+            latencias.append(time.perf_counter() - inicio)
+            tokens += generados
+            errores.append(cer(referencia, texto))
+            textos[modo].append(texto)
+            if asistida:
+                # Cada verificación del modelo principal acepta varios tokens del borrador y añade uno propio
+                verificaciones = contador_principal.llamadas - principal_antes
+                aceptados += max(0, generados - verificaciones)
+                propuestos += contador_borrador.llamadas - borrador_antes
+        latencias_medias[modo] = sum(latencias) / len(latencias)
+        tasa = f"{aceptados / propuestos:>11.1%}" if propuestos else f"{'-':>11}"
+        print(
+            f"{modo:<10}{percentil(latencias, 50):>10.2f}{percentil(latencias, 95):>10.2f}"
+            f"{tokens / sum(latencias):>10.1f}{sum(errores) / len(errores):>10.3f}{tasa}"
+        )
+
+    print(f"Aceleración media: {latencias_medias['normal'] / latencias_medias['asistida']:.2f}x")
+    distintas = sum(a != b for a, b in zip(textos["normal"], textos["asistida"]))
+    print(f"Transcripciones distintas entre modos: {distintas}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark del OCR en cascada (Tesseract + modelo de visión) frente a usar siempre el modelo de visión.
+
+Uso (desde el directorio backend, con la API OCR en OCR_API_URL y Tesseract instalado):
+python tests/benchmarks/bench_ocr_cascade.py --muestras ruta/a/muestras --fallback qwen7b --threshold 80
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import UploadFile
+from models.usuario import Usuario, TipoUsuario
+from services.ocr_service import OCRServiceFactory, CascadeOCRService
+from utils import cargar_muestras, cer
+
+
+async def ejecutar(servicio, muestras, concurrencia: int):
+    usuario = Usuario(tipo_usuario=TipoUsuario.ALUMNO)
+    semaforo = asyncio.Semaphore(concurrencia)
+
+    async def procesar(nombre, imagen, referencia):
+        async with semaforo:
+            texto = await servicio.process_image(UploadFile(file=io.BytesIO(imagen), filename=nombre), usuario)
+            return cer(referencia, texto)
+
+    inicio = time.perf_counter()
+    errores = await asyncio.gather(*(procesar(*m) for m in muestras))
+    duracion = time.perf_counter() - inicio
+    return len(muestras) / duracion, sum(errores) / len(errores)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--muestras", required=True, help="Directorio con imágenes y sus .txt de referencia")
+    parser.add_argument("--fallback", default="qwen7b", help="Servicio OCR de visión (qwen7b, qwen3b, gemma3)")
+    parser.add_argument("--threshold", type=float, default=80.0, help="Confianza mínima de Tesseract (0-100)")
+    parser.add_argument("--concurrencia", type=int, default=4)
+    args = parser.parse_args()
+
+    muestras = cargar_muestras(args.muestras)
+    vlm = OCRServiceFactory.get_ocr_service(args.fallback)
+    cascada = CascadeOCRService(fallback=vlm, threshold=args.threshold)
+
+    print(f"{len(muestras)} muestras, concurrencia {args.concurrencia}")
+    print(f"{'modo':<12}{'img/s':>10}{'CER':>10}")
+    for nombre, servicio in (("vlm", vlm), ("cascada", cascada)):
+        rendimiento, error = await ejecutar(servicio, muestras, args.concurrencia)
+        print(f"{nombre:<12}{rendimiento:>10.2f}{error:>10.3f}")
+
+    total = sum(cascada.estadisticas.values())
+    print(f"Resueltas por Tesseract: {cascada.estadisticas['tesseract']}/{total}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""
+Benchmark de la preparación de la imagen que se envía a Ollama: recodificar en PNG (el
+comportamiento anterior), reenviar los bytes originales o recodificar en JPEG.
+
+Informa del tiempo de CPU y del tamaño de la carga útil en base64 de cada estrategia.
+No necesita Ollama ni los modelos: solo mide la codificación.
+
+Uso (desde el directorio backend):
+python tests/benchmarks/bench_ocr_ollama_payload.py --muestras ruta/a/muestras
+"""
+
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ocr
+from utils import cargar_muestras, percentil
+
+
+def png(datos):
+    buffered = io.BytesIO()
+    ocr.decode_image(datos).save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def bytes_originales(datos):
+    return ocr.encode_image_for_ollama(ocr.decode_image(datos), datos)
+
+
+def jpeg(datos):
+    return ocr.encode_image_for_ollama(ocr.decode_image(datos))
+
+
+ESTRATEGIAS = {
+    "png": png,
+    "originales": bytes_originales,
+    "jpeg": jpeg,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--muestras", required=True, help="Directorio con imágenes (y sus .txt de referencia)")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    imagenes = [datos for _, datos, _ in cargar_muestras(args.muestras)]
+
+    print(f"{len(imagenes)} muestras, {args.repeticiones} repeticiones (incluye decodificar la subida)")
+    print(f"{'estrategia':<12}{'CPU p50 ms':>12}{'CPU p95 ms':>12}{'KB medios':>12}")
+    for nombre, estrategia in ESTRATEGIAS.items():
+        tiempos, tamanos = [], []
+        for datos in imagenes:
+            for _ in range(args.repeticiones):
+                inicio = time.process_time()
+                carga = estrategia(datos)
+                tiempos.append((time.process_time() - inicio) * 1000)
+            tamanos.append(len(carga) / 1024)
+        print(
+            f"{nombre:<12}{percentil(tiempos, 50):>12.1f}{percentil(tiempos, 95):>12.1f}"
+            f"{sum(tamanos) / len(tamanos):>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
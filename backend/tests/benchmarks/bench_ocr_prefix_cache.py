@@ -0,0 +1,74 @@
+"""
+Benchmark de la cache KV del prefijo de la plantilla en los modelos Qwen: compara el
+tiempo hasta el primer token (prefill) y la latencia total con y sin reutilizar la
+cache del mensaje de sistema y la instrucción.
+
+Con la cache la instrucción va antes de la imagen en el mensaje y sin ella después, así que
+también se compara el CER de ambos modos frente a las transcripciones de referencia y se
+cuentan las transcripciones que cambian.
+
+Uso (en el entorno del servidor OCR, desde el directorio backend):
+python tests/benchmarks/bench_ocr_prefix_cache.py --muestras ruta/a/muestras --modelo qwen3b
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import io
+from PIL import Image
+import ocr
+from utils import cargar_muestras, cer, percentil
+
+
+def medir(imagenes, modelo):
+    primer_token, totales, textos = [], [], []
+    for _, imagen in imagenes:
+        inicio = time.perf_counter()
+        ocr.process_qwen_batch([imagen], modelo, max_new_tokens=1)
+        primer_token.append(time.perf_counter() - inicio)
+        inicio = time.perf_counter()
+        textos.append(ocr.process_qwen_response(imagen, modelo))
+        totales.append(time.perf_counter() - inicio)
+    return primer_token, totales, textos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--muestras", required=True, help="Directorio con imágenes y sus .txt de referencia")
+    parser.add_argument("--modelo", default="qwen3b", choices=[m for m, c in ocr.OCR_CONFIG.items() if c["type"] == "transformers"])
+    args = parser.parse_args()
+
+    muestras = cargar_muestras(args.muestras)
+    imagenes = [(nombre, Image.open(io.BytesIO(datos)).convert("RGB")) for nombre, datos, _ in muestras]
+    referencias = [referencia for _, _, referencia in muestras]
+
+    # Cargar y calentar el modelo antes de medir (el calentamiento también crea la cache del prefijo)
+    ocr.preload_model(args.modelo)
+
+    print(f"{len(imagenes)} muestras con {args.modelo} en {ocr.select_device()[0]}")
+    print(f"{'modo':<14}{'TTFT p50 s':>12}{'TTFT p95 s':>12}{'total p50 s':>13}{'total p95 s':>13}{'CER medio':>11}")
+    resultados = {}
+    for modo, activado in (("sin_cache", False), ("con_cache", True)):
+        ocr.OCR_PREFIX_CACHE = activado
+        primer_token, totales, textos = medir(imagenes, args.modelo)
+        resultados[modo] = textos
+        errores = [cer(referencia, texto) for referencia, texto in zip(referencias, textos)]
+        print(
+            f"{modo:<14}{percentil(primer_token, 50):>12.3f}{percentil(primer_token, 95):>12.3f}"
+            f"{percentil(totales, 50):>13.2f}{percentil(totales, 95):>13.2f}{sum(errores) / len(errores):>11.4f}"
+        )
+
+    estadisticas = ocr.prefix_cache_stats
+    tokens_por_peticion = estadisticas["tokens_reused"] / max(1, estadisticas["hits"])
+    print(f"Tokens de prefijo reutilizados por petición: {tokens_por_peticion:.0f}")
+    distintas = [nombre for (nombre, _), a, b in zip(imagenes, resultados["sin_cache"], resultados["con_cache"]) if a != b]
+    print(f"Transcripciones distintas entre modos: {len(distintas)}" + (f" ({', '.join(distintas)})" if distintas else ""))
+
+
+if __name__ == "__main__":
+    main()
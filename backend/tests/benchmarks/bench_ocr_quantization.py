@@ -0,0 +1,77 @@
+"""
+Benchmark de la inferencia OCR en CPU: modelo en float32 frente a su variante cuantizada en int8.
+
+Cada variante se ejecuta en un subproceso para medir su pico de memoria (RSS) por separado.
+Informa de la latencia, el pico de RSS y el CER frente a la transcripción de referencia.
+
+Uso (en el entorno del servidor OCR, desde el directorio backend):
+python tests/benchmarks/bench_ocr_quantization.py --muestras ruta/a/muestras --modelo qwen3b --cuantizado qwen3b-int8
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils import cargar_muestras, cer, percentil
+
+
+def ejecutar_variante(modelo: str, directorio: str) -> dict:
+    """Ejecuta todas las muestras con un modelo en CPU (se llama dentro del subproceso)"""
+    os.environ["OCR_DEVICE"] = "cpu"
+    from PIL import Image
+    import ocr
+
+    muestras = cargar_muestras(directorio)
+    ocr.load_qwen_model(modelo)
+    latencias, errores = [], []
+    for _, datos, referencia in muestras:
+        imagen = Image.open(io.BytesIO(datos)).convert("RGB")
+        inicio = time.perf_counter()
+        texto = ocr.process_qwen_response(imagen, modelo)
+        latencias.append(time.perf_counter() - inicio)
+        errores.append(cer(referencia, texto))
+    return {
+        "modelo": modelo,
+        "p50": percentil(latencias, 50),
+        "p95": percentil(latencias, 95),
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # ru_maxrss está en KB en Linux
+        "memoria_pesos_mb": ocr.model_manager.footprints.get(modelo, 0) / 1024**2,
+        "cer": sum(errores) / len(errores),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--muestras", required=True, help="Directorio con imágenes y sus .txt de referencia")
+    parser.add_argument("--modelo", default="qwen3b", help="Entrada de OCR_CONFIG en precisión completa")
+    parser.add_argument("--cuantizado", default="qwen3b-int8", help="Entrada de OCR_CONFIG con quantization int8")
+    parser.add_argument("--variante", help=argparse.SUPPRESS)  # Uso interno del subproceso
+    args = parser.parse_args()
+
+    if args.variante:
+        print(json.dumps(ejecutar_variante(args.variante, args.muestras)))
+        return
+
+    print(f"{'modelo':<16}{'p50 s':>10}{'p95 s':>10}{'RSS MB':>10}{'pesos MB':>10}{'CER':>10}")
+    for modelo in (args.modelo, args.cuantizado):
+        salida = subprocess.run(
+            [sys.executable, __file__, "--muestras", args.muestras, "--variante", modelo],
+            check=True, capture_output=True, text=True
+        ).stdout
+        r = json.loads(salida.strip().splitlines()[-1])
+        print(
+            f"{r['modelo']:<16}{r['p50']:>10.2f}{r['p95']:>10.2f}"
+            f"{r['rss_mb']:>10.0f}{r['memoria_pesos_mb']:>10.0f}{r['cer']:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
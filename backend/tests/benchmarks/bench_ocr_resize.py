@@ -0,0 +1,67 @@
+"""
+Benchmark del redimensionado de imágenes para los modelos Qwen: tamaño fijo 640x640
+frente al presupuesto de píxeles que mantiene la relación de aspecto.
+
+Informa de los tokens de visión, la latencia y el CER de cada estrategia.
+
+Uso (en el entorno del servidor OCR, desde el directorio backend):
+python tests/benchmarks/bench_ocr_resize.py --muestras ruta/a/muestras --modelo qwen3b
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import io
+from PIL import Image
+import ocr
+from utils import cargar_muestras, cer, percentil
+
+
+def redimension_fija(image, model_name):
+    return image.resize((640, 640), Image.LANCZOS)
+
+
+ESTRATEGIAS = {
+    "fijo_640": redimension_fija,
+    "presupuesto": ocr.prepare_image,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--muestras", required=True, help="Directorio con imágenes y sus .txt de referencia")
+    parser.add_argument("--modelo", default="qwen3b", choices=[m for m, c in ocr.OCR_CONFIG.items() if c["type"] == "transformers"])
+    args = parser.parse_args()
+
+    muestras = cargar_muestras(args.muestras)
+    imagenes = [(nombre, Image.open(io.BytesIO(datos)).convert("RGB"), referencia) for nombre, datos, referencia in muestras]
+
+    # Cargar y calentar el modelo antes de medir
+    ocr.preload_model(args.modelo)
+
+    print(f"{len(imagenes)} muestras con {args.modelo} en {ocr.select_device()[0]}")
+    print(f"{'estrategia':<14}{'tokens':>10}{'p50 s':>10}{'p95 s':>10}{'CER':>10}")
+    for nombre, estrategia in ESTRATEGIAS.items():
+        ocr.prepare_image = estrategia
+        tokens, latencias, errores = [], [], []
+        for _, imagen, referencia in imagenes:
+            redimensionada = estrategia(imagen, args.modelo)
+            tokens.append(ocr.vision_token_count(*redimensionada.size))
+            inicio = time.perf_counter()
+            texto = ocr.process_qwen_response(imagen, args.modelo)
+            latencias.append(time.perf_counter() - inicio)
+            errores.append(cer(referencia, texto))
+        print(
+            f"{nombre:<14}{sum(tokens) / len(tokens):>10.0f}"
+            f"{percentil(latencias, 50):>10.2f}{percentil(latencias, 95):>10.2f}"
+            f"{sum(errores) / len(errores):>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark del OCR por franjas frente a la transcripción de la imagen completa.
+
+Informa del tiempo total (wall time) y el CER de cada modo sobre las muestras.
+
+Uso (en el entorno del servidor OCR, desde el directorio backend):
+python tests/benchmarks/bench_ocr_tiling.py --muestras ruta/a/muestras --modelo qwen3b
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image
+import ocr
+from utils import cargar_muestras, cer, percentil
+
+
+async def medir(modo: str, imagenes, modelo: str):
+    latencias, errores = [], []
+    for _, imagen, referencia in imagenes:
+        inicio = time.perf_counter()
+        if modo == "franjas":
+            texto = await ocr.process_tiled(imagen, modelo)
+        else:
+            texto = await ocr.get_batcher(modelo).submit(imagen)
+        latencias.append(time.perf_counter() - inicio)
+        errores.append(cer(referencia, texto))
+    return latencias, errores
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--muestras", required=True, help="Directorio con imágenes y sus .txt de referencia")
+    parser.add_argument("--modelo", default="qwen3b", choices=[m for m, c in ocr.OCR_CONFIG.items() if c["type"] == "transformers"])
+    args = parser.parse_args()
+
+    imagenes = [
+        (nombre, Image.open(io.BytesIO(datos)).convert("RGB"), referencia)
+        for nombre, datos, referencia in cargar_muestras(args.muestras)
+    ]
+    ocr.preload_model(args.modelo)
+
+    franjas = sum(
+        len(ocr.split_into_strips(img, int(img.width * ocr.OCR_TILE_HEIGHT_RATIO), ocr.OCR_TILE_OVERLAP))
+        for _, img, _ in imagenes
+    )
+    print(f"{len(imagenes)} muestras ({franjas} franjas) con {args.modelo}, lote máximo {ocr.OCR_MAX_BATCH_SIZE}")
+    print(f"{'modo':<12}{'total s':>10}{'p50 s':>10}{'p95 s':>10}{'CER':>10}")
+    for modo in ("completa", "franjas"):
+        latencias, errores = await medir(modo, imagenes, args.modelo)
+        print(
+            f"{modo:<12}{sum(latencias):>10.2f}{percentil(latencias, 50):>10.2f}"
+            f"{percentil(latencias, 95):>10.2f}{sum(errores) / len(errores):>10.3f}"
+        )
+    await ocr.get_batcher(args.modelo).close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
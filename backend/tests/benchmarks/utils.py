@@ -0,0 +1,69 @@
+"""
+Utilidades comunes para los benchmarks de OCR y LLM.
+
+Las muestras se leen de un directorio con imágenes y, para cada imagen, un fichero
+.txt con el mismo nombre que contiene la transcripción correcta.
+"""
+
+import os
+from typing import List, Tuple
+
+EXTENSIONES_IMAGEN = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
+
+
+def distancia_levenshtein(a: str, b: str) -> int:
+    """Distancia de edición entre dos cadenas (inserciones, borrados y sustituciones)"""
+    if len(a) < len(b):
+        a, b = b, a
+    anterior = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        actual = [i]
+        for j, cb in enumerate(b, 1):
+            actual.append(min(
+                anterior[j] + 1,
+                actual[j - 1] + 1,
+                anterior[j - 1] + (ca != cb)
+            ))
+        anterior = actual
+    return anterior[-1]
+
+
+def cer(referencia: str, prediccion: str) -> float:
+    """Character error rate de una predicción frente a la transcripción de referencia"""
+    referencia = referencia.strip()
+    prediccion = prediccion.strip()
+    if not referencia:
+        return 0.0 if not prediccion else 1.0
+    return distancia_levenshtein(referencia, prediccion) / len(referencia)
+
+
+def cargar_muestras(directorio: str) -> List[Tuple[str, bytes, str]]:
+    """
+    Carga las imágenes de un directorio junto con su transcripción de referencia.
+
+    Returns:
+        Lista de tuplas (nombre, bytes de la imagen, transcripción)
+    """
+    muestras = []
+    for nombre in sorted(os.listdir(directorio)):
+        base, extension = os.path.splitext(nombre)
+        ruta_txt = os.path.join(directorio, base + ".txt")
+        if extension.lower() not in EXTENSIONES_IMAGEN or not os.path.exists(ruta_txt):
+            continue
+        with open(os.path.join(directorio, nombre), "rb") as f:
+            imagen = f.read()
+        with open(ruta_txt, encoding="utf-8") as f:
+            referencia = f.read()
+        muestras.append((nombre, imagen, referencia))
+    if not muestras:
+        raise SystemExit(f"No se encontraron muestras (imagen + .txt) en {directorio}")
+    return muestras
+
+
+def percentil(valores: List[float], p: float) -> float:
+    """Percentil p (0-100) de una lista de valores"""
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
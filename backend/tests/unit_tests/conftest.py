@@ -58,11 +58,13 @@ async def db_session() -> AsyncGenerator[AsyncSession, None]:
         await conn.run_sync(Base.metadata.drop_all)
 
 @pytest.fixture(scope="function")
-async def async_client(db_session: AsyncSession) -> AsyncGenerator[AsyncClient, None]:
+async def async_client(db_session: AsyncSession, monkeypatch) -> AsyncGenerator[AsyncClient, None]:
     async def override_get_db():
         yield db_session
 
     app.dependency_overrides[get_db] = override_get_db
+    # Las exportaciones CSV abren su propia sesión mientras envían la respuesta
+    monkeypatch.setattr("services.export_service.AsyncSessionLocal", TestingSessionLocal)
     async with AsyncClient(app=app, base_url="http://test") as ac:
         yield ac
     app.dependency_overrides.clear()
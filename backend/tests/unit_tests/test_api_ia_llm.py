@@ -0,0 +1,699 @@
+import pytest
+import asyncio
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+api_ia_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA")
+sys.path.insert(0, api_ia_dir)
+
+import llm
+from fastapi.testclient import TestClient
+
+
+class OllamaFalso:
+    """Servidor mínimo que imita /api/generate (con y sin stream) y /api/ps de Ollama"""
+    def __init__(self, retardo: float = 0, cargados=()):
+        self.retardo = retardo
+        self.cargados = list(cargados)
+        self.falla = False
+        self.sin_modelo = False  # Responder 404 como Ollama cuando el modelo no está instalado
+        self.recuentos = False  # Incluir los recuentos de tokens de Ollama en la respuesta
+        self.consultas_ps = 0
+        self.conexiones = set()
+        self.peticiones = []
+        self.activas = 0
+        self.max_activas = 0
+        self._lock = threading.Lock()
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                servidor.consultas_ps += 1
+                modelos = [{"name": nombre, "expires_at": "2030-01-01T00:00:00Z", "size_vram": 1} for nombre in servidor.cargados]
+                cuerpo = json.dumps({"models": modelos}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with servidor._lock:
+                    servidor.conexiones.add(self.client_address)
+                    servidor.peticiones.append(payload)
+                    servidor.activas += 1
+                    servidor.max_activas = max(servidor.max_activas, servidor.activas)
+                try:
+                    time.sleep(servidor.retardo)
+                    if servidor.sin_modelo:
+                        cuerpo = json.dumps({"error": f"model '{payload['model']}' not found"}).encode()
+                        self.send_response(404)
+                        self.send_header("Content-Type", "application/json")
+                        self.send_header("Content-Length", str(len(cuerpo)))
+                        self.end_headers()
+                        self.wfile.write(cuerpo)
+                        return
+                    if "prompt" not in payload:
+                        # Petición de carga del modelo
+                        servidor.cargados.append(payload["model"] if ":" in payload["model"] else f"{payload['model']}:latest")
+                    if payload.get("stream"):
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/x-ndjson")
+                        self.send_header("Connection", "close")
+                        self.end_headers()
+                        for fragmento in ["Hola", " mundo"]:
+                            self.wfile.write((json.dumps({"response": fragmento, "done": False}) + "\n").encode())
+                        self.wfile.write((json.dumps({"response": "", "done": True, **servidor.uso(payload)}) + "\n").encode())
+                        self.close_connection = True
+                        return
+                    codigo = 500 if servidor.falla or payload.get("prompt") == "falla" else 200
+                    cuerpo = json.dumps({"response": f"respuesta a {payload.get('prompt', '')}", "done": True, **servidor.uso(payload)}).encode()
+                    self.send_response(codigo)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(cuerpo)))
+                    self.end_headers()
+                    self.wfile.write(cuerpo)
+                finally:
+                    with servidor._lock:
+                        servidor.activas -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def uso(self, payload: dict) -> dict:
+        if not self.recuentos:
+            return {}
+        return {"prompt_eval_count": len(payload.get("prompt", "")) // 4, "eval_count": 20, "eval_duration": 500_000_000}
+
+    def cerrar(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def configurar_modelo(monkeypatch, nombre: str, *servidores: OllamaFalso, **extra):
+    monkeypatch.setitem(llm.LLM_CONFIG, nombre, {
+        "urls": [f"{servidor.url}/api/generate" for servidor in servidores],
+        "model_suffix": "",
+        "headers": {"Content-Type": "application/json"},
+        "processor": "process_ollama_response",
+        **extra
+    })
+
+
+@pytest.fixture
+def ollama():
+    servidor = OllamaFalso()
+    yield servidor
+    servidor.cerrar()
+
+
+def test_chat_reutiliza_conexiones(monkeypatch, ollama):
+    """Verifica que las consultas consecutivas reutilizan la conexión con el servidor"""
+    configurar_modelo(monkeypatch, "llama3", ollama)
+
+    with TestClient(llm.app) as client:
+        for i in range(3):
+            response = client.post("/chat/llama3", json={"model": "llama3", "prompt": f"p{i}"})
+            assert response.status_code == 200
+            assert response.json() == {"response": f"respuesta a p{i}"}
+
+    assert len(ollama.peticiones) == 3
+    assert len(ollama.conexiones) == 1
+    assert llm.clients == {}
+
+
+def test_chat_reenvia_streaming(monkeypatch, ollama):
+    """Verifica que con stream: true se reenvían las líneas NDJSON de Ollama"""
+    configurar_modelo(monkeypatch, "llama3", ollama)
+
+    with TestClient(llm.app) as client:
+        response = client.post("/chat/llama3", json={"model": "llama3", "prompt": "hola", "stream": True})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lineas = [json.loads(linea) for linea in response.text.splitlines()]
+    assert "".join(linea["response"] for linea in lineas) == "Hola mundo"
+    assert lineas[-1]["done"] is True
+    assert ollama.peticiones[0]["stream"] is True
+
+
+@pytest.mark.asyncio
+async def test_limite_de_conexiones_por_servidor(monkeypatch):
+    """Verifica que los modelos de un mismo servidor comparten cliente y su límite de conexiones"""
+    servidor = OllamaFalso(retardo=0.1)
+    configurar_modelo(monkeypatch, "gemma3:4b", servidor, max_connections=1)
+    configurar_modelo(monkeypatch, "llama3", servidor, max_connections=1)
+    try:
+        assert llm.get_client("gemma3:4b") is llm.get_client("llama3")
+        items = [llm.Item(model="llama3", prompt=f"p{i}") for i in range(3)]
+        resultados = await asyncio.gather(*(llm.query_llm("llama3", item) for item in items))
+        assert [r["response"] for r in resultados] == ["respuesta a p0", "respuesta a p1", "respuesta a p2"]
+        assert servidor.max_activas == 1
+    finally:
+        await llm.close_clients()
+        servidor.cerrar()
+
+
+class PeticionFalsa:
+    def __init__(self):
+        self.desconectado = False
+        self.url = type("URL", (), {"path": "/chat/llama3"})()
+
+    async def is_disconnected(self):
+        return self.desconectado
+
+
+@pytest.mark.asyncio
+async def test_desconexion_del_cliente_cancela_la_consulta(monkeypatch):
+    """Verifica que si el cliente se desconecta se cancela la consulta en curso"""
+    monkeypatch.setattr(llm, "LLM_DISCONNECT_POLL_INTERVAL", 0.01)
+    peticion = PeticionFalsa()
+    cancelada = asyncio.Event()
+
+    async def consulta_lenta():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelada.set()
+            raise
+
+    async def desconectar():
+        await asyncio.sleep(0.05)
+        peticion.desconectado = True
+
+    asyncio.ensure_future(desconectar())
+    assert await llm.run_until_disconnected(peticion, consulta_lenta()) is None
+    await asyncio.wait_for(cancelada.wait(), 1)
+
+    assert await llm.run_until_disconnected(PeticionFalsa(), asyncio.sleep(0, result={"response": "ok"})) == {"response": "ok"}
+
+
+@pytest.mark.asyncio
+async def test_peticiones_identicas_comparten_generacion(monkeypatch):
+    """Verifica que las peticiones idénticas concurrentes (también en streaming) se agrupan en una sola"""
+    import httpx
+    servidor = OllamaFalso(retardo=0.2)
+    configurar_modelo(monkeypatch, "llama3", servidor)
+    monkeypatch.setattr(llm, "coalescing_stats", {"upstream": 0, "coalesced": 0})
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=llm.app), base_url="http://test") as client:
+            def consulta(prompt, stream=False):
+                return client.post("/chat/llama3", json={"model": "llama3", "prompt": prompt, "stream": stream})
+
+            respuestas = await asyncio.gather(consulta("a"), consulta("a"), consulta("a"), consulta("b"))
+            assert [r.json()["response"] for r in respuestas] == ["respuesta a a"] * 3 + ["respuesta a b"]
+            assert len(servidor.peticiones) == 2
+
+            respuestas = await asyncio.gather(consulta("c", stream=True), consulta("c", stream=True))
+            assert respuestas[0].text == respuestas[1].text
+            assert respuestas[0].text.count("\n") == 3
+            assert len(servidor.peticiones) == 3
+
+            metricas = (await client.get("/metrics")).json()["coalescing"]
+        assert metricas == {"upstream": 3, "coalesced": 3, "ratio": 0.5}
+        assert llm.single_flight.flights == {} and llm.stream_flights == {}
+    finally:
+        await llm.close_clients()
+        servidor.cerrar()
+
+
+@pytest.mark.asyncio
+async def test_streaming_cancela_la_generacion_si_el_cliente_se_va_antes_de_la_respuesta(monkeypatch, servidores):
+    """Verifica que si el cliente se desconecta antes de que responda el servidor se libera la plaza"""
+    servidor = OllamaFalso(retardo=1)
+    servidores.append(servidor)
+    configurar_modelo(monkeypatch, "llama3", servidor, max_concurrent=1)
+    item = llm.Item(model="llama3", prompt="largo", stream=True)
+    try:
+        peticion = asyncio.ensure_future(llm.stream_llm("llama3", item))
+        await asyncio.sleep(0.1)
+        assert llm.get_scheduler("llama3").active == 1
+
+        peticion.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await peticion
+        await asyncio.sleep(0.05)
+
+        assert llm.get_scheduler("llama3").active == 0
+        assert llm.stream_flights == {}
+    finally:
+        await llm.close_clients()
+
+
+@pytest.mark.asyncio
+async def test_single_flight_solo_cancela_si_no_quedan_peticiones():
+    """Verifica que la consulta compartida sigue mientras quede alguna petición esperándola"""
+    liberar = asyncio.Event()
+    cancelada = asyncio.Event()
+
+    async def consulta():
+        try:
+            await liberar.wait()
+            return {"response": "ok"}
+        except asyncio.CancelledError:
+            cancelada.set()
+            raise
+
+    grupo = llm.SingleFlight()
+    primera = asyncio.ensure_future(grupo.do("clave", consulta))
+    segunda = asyncio.ensure_future(grupo.do("clave", consulta))
+    await asyncio.sleep(0.01)
+
+    primera.cancel()
+    await asyncio.sleep(0.01)
+    assert not cancelada.is_set()
+    liberar.set()
+    assert await segunda == {"response": "ok"}
+
+    liberar.clear()
+    tercera = asyncio.ensure_future(grupo.do("clave", consulta))
+    await asyncio.sleep(0.01)
+    tercera.cancel()
+    await asyncio.wait_for(cancelada.wait(), 1)
+    assert grupo.flights == {}
+
+
+@pytest.mark.asyncio
+async def test_planificador_atiende_antes_las_interactivas():
+    """Verifica que con el modelo ocupado las peticiones interactivas adelantan a las batch"""
+    planificador = llm.ModelScheduler("llama3", max_concurrent=1)
+    orden = []
+    liberar = asyncio.Event()
+
+    async def peticion(nombre, prioridad):
+        async with planificador.slot(prioridad):
+            orden.append(nombre)
+            await liberar.wait()
+
+    ocupada = asyncio.ensure_future(peticion("primera", "batch"))
+    await asyncio.sleep(0.01)
+    pendientes = [
+        asyncio.ensure_future(peticion("batch", "batch")),
+        asyncio.ensure_future(peticion("interactiva", "interactive")),
+    ]
+    await asyncio.sleep(0.01)
+    estado = planificador.status()
+    assert estado["active"] == 1
+    assert estado["queues"]["batch"]["depth"] == 1 and estado["queues"]["interactive"]["depth"] == 1
+
+    liberar.set()
+    await asyncio.gather(ocupada, *pendientes)
+    assert orden == ["primera", "interactiva", "batch"]
+    assert planificador.active == 0
+    assert planificador.status()["queues"]["batch"]["avg_wait_s"] > 0
+
+
+@pytest.mark.asyncio
+async def test_planificador_rechaza_con_429_si_no_llega_al_plazo():
+    """Verifica que se responde 429 si la espera estimada o la real superan el plazo"""
+    planificador = llm.ModelScheduler("llama3", max_concurrent=1)
+    liberar = asyncio.Event()
+
+    async def ocupar():
+        async with planificador.slot():
+            await liberar.wait()
+
+    ocupada = asyncio.ensure_future(ocupar())
+    await asyncio.sleep(0.01)
+
+    # Sin historial no se puede estimar: se rechaza al vencer el plazo
+    with pytest.raises(llm.HTTPException) as excinfo:
+        async with planificador.slot("interactive", deadline=0.05):
+            pass
+    assert excinfo.value.status_code == 429
+
+    # Con historial se rechaza sin esperar
+    planificador.avg_duration = 10
+    with pytest.raises(llm.HTTPException) as excinfo:
+        async with planificador.slot("interactive", deadline=5):
+            pass
+    assert excinfo.value.headers["Retry-After"] == "10"
+    assert planificador.status()["queues"]["interactive"]["rejected"] == 2
+
+    # Una petición cancelada mientras espera no se queda con la plaza
+    cancelada = asyncio.ensure_future(ocupar())
+    await asyncio.sleep(0.01)
+    cancelada.cancel()
+    liberar.set()
+    await ocupada
+    assert planificador.active == 0 and planificador.queued() == 0
+
+
+def test_chat_rechaza_prioridad_no_valida(monkeypatch, ollama):
+    """Verifica que la cabecera X-Priority solo admite las prioridades configuradas"""
+    configurar_modelo(monkeypatch, "llama3", ollama)
+    with TestClient(llm.app) as client:
+        response = client.post("/chat/llama3", json={"model": "llama3", "prompt": "p"}, headers={"X-Priority": "urgente"})
+        assert response.status_code == 400
+        response = client.post("/chat/llama3", json={"model": "llama3", "prompt": "p"}, headers={"X-Priority": "batch"})
+        assert response.status_code == 200
+        assert "llama3" in client.get("/metrics").json()["schedulers"]
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    cache = llm.ResponseCache(str(tmp_path / "cache.sqlite3"), max_bytes=1024**2)
+    monkeypatch.setattr(llm, "response_cache", cache)
+    yield cache
+    cache.close()
+
+
+def test_cache_sirve_las_consultas_deterministas(monkeypatch, ollama, cache):
+    """Verifica que con temperature 0 (o cache: true) la respuesta se sirve desde la cache"""
+    configurar_modelo(monkeypatch, "llama3", ollama)
+
+    with TestClient(llm.app) as client:
+        consulta = {"model": "llama3", "prompt": "p", "temperature": 0}
+        primera = client.post("/chat/llama3", json=consulta)
+        segunda = client.post("/chat/llama3", json=consulta)
+        assert primera.json() == segunda.json() == {"response": "respuesta a p"}
+        assert "x-cache" not in primera.headers and segunda.headers["x-cache"] == "HIT"
+        assert len(ollama.peticiones) == 1
+
+        # Con muestreo no se cachea salvo que se pida expresamente
+        for _ in range(2):
+            client.post("/chat/llama3", json={"model": "llama3", "prompt": "p"})
+        assert len(ollama.peticiones) == 3
+        for _ in range(2):
+            client.post("/chat/llama3", json={"model": "llama3", "prompt": "p", "cache": True})
+        client.post("/chat/llama3", json={**consulta, "cache": False})
+        assert len(ollama.peticiones) == 5
+
+        # La cache persiste entre conexiones a la base de datos
+        cache.close()
+        assert client.post("/chat/llama3", json=consulta).headers["x-cache"] == "HIT"
+
+        monkeypatch.setattr(llm, "LLM_ADMIN_TOKEN", "secreto")
+        admin = {"X-Admin-Token": "secreto"}
+        estado = client.get("/admin/cache", headers=admin).json()
+        assert estado["entries"] == 2 and estado["hits"] == 3
+        assert estado["models"]["llama3"]["entries"] == 2
+        assert client.delete("/admin/cache", params={"model": "otro"}, headers=admin).json() == {"deleted": 0}
+        assert client.delete("/admin/cache", params={"model": "llama3"}, headers=admin).json() == {"deleted": 2}
+        assert "x-cache" not in client.post("/chat/llama3", json=consulta).headers
+
+
+@pytest.mark.asyncio
+async def test_cache_descarta_las_entradas_menos_usadas(tmp_path):
+    """Verifica que al superar el tamaño máximo se descartan las entradas usadas hace más tiempo"""
+    cache = llm.ResponseCache(str(tmp_path / "cache.sqlite3"), max_bytes=1000)
+    try:
+        for i in range(3):
+            await cache.put(f"clave{i}", "llama3", {"response": "x" * 300})
+        await cache.get("clave0")
+        await cache.put("clave3", "llama3", {"response": "x" * 300})
+
+        assert await cache.get("clave1") is None
+        assert await cache.get("clave0") is not None and await cache.get("clave3") is not None
+        estado = await cache.status()
+        assert estado["evictions"] >= 1 and estado["entries"] < 4
+    finally:
+        cache.close()
+
+
+def test_admin_cache_exige_token(monkeypatch, cache):
+    """Verifica que la administración de la cache exige el token y está desactivada sin LLM_ADMIN_TOKEN"""
+    monkeypatch.setattr(llm, "LLM_ADMIN_TOKEN", None)
+    with TestClient(llm.app) as client:
+        assert client.get("/admin/cache").status_code == 403
+        assert client.delete("/admin/cache").status_code == 403
+        assert client.delete("/admin/cache", headers={"X-Admin-Token": ""}).status_code == 403
+
+    monkeypatch.setattr(llm, "LLM_ADMIN_TOKEN", "secreto")
+    with TestClient(llm.app) as client:
+        assert client.get("/admin/cache").status_code == 403
+        assert client.delete("/admin/cache", headers={"X-Admin-Token": "malo"}).status_code == 403
+        assert client.get("/admin/cache", headers={"X-Admin-Token": "secreto"}).status_code == 200
+
+
+@pytest.fixture
+def servidores(monkeypatch):
+    # Estado de servidores y planificadores limpio para cada prueba
+    monkeypatch.setattr(llm, "hosts", {})
+    monkeypatch.setattr(llm, "schedulers", {})
+    monkeypatch.setattr(llm, "_host_rotation", itertools.count())
+    monkeypatch.setattr(llm, "token_counters", {})
+    monkeypatch.setattr(llm, "token_stats", {})
+    lista = []
+    yield lista
+    for servidor in lista:
+        servidor.cerrar()
+
+
+@pytest.mark.asyncio
+async def test_reparto_prefiere_servidores_con_el_modelo_cargado(monkeypatch, servidores):
+    """Verifica que se elige el servidor con menos peticiones en curso, penalizando al que no tiene el modelo cargado"""
+    frio = OllamaFalso(retardo=0.2)
+    caliente = OllamaFalso(retardo=0.2, cargados=["llama3:latest"])
+    servidores += [frio, caliente]
+    configurar_modelo(monkeypatch, "llama3", frio, caliente)
+    try:
+        # Secuencialmente todas van al servidor que ya tiene el modelo
+        for i in range(3):
+            assert (await llm.query_llm("llama3", llm.Item(model="llama3", prompt=f"s{i}")))["response"] == f"respuesta a s{i}"
+        assert (len(frio.peticiones), len(caliente.peticiones)) == (0, 3)
+
+        # Con carga, el servidor frío solo recibe peticiones cuando el caliente tiene 2 más en curso
+        items = [llm.Item(model="llama3", prompt=f"c{i}") for i in range(4)]
+        await asyncio.gather(*(llm.query_llm("llama3", item) for item in items))
+        assert (len(frio.peticiones), len(caliente.peticiones)) == (1, 6)
+        assert frio.consultas_ps == caliente.consultas_ps == 1
+        assert llm.get_scheduler("llama3").max_concurrent == 2 * llm.LLM_MAX_CONCURRENT
+        assert "llama3:latest" in llm.hosts[frio.url].loaded
+    finally:
+        await llm.close_clients()
+
+
+@pytest.mark.asyncio
+async def test_servidor_sin_el_modelo_no_cuenta_como_cargado_ni_recibe_mas_peticiones(monkeypatch, servidores):
+    """Verifica que un 404 de Ollama no marca el modelo como cargado y aparta ese servidor"""
+    sin_modelo = OllamaFalso()
+    sin_modelo.sin_modelo = True
+    con_modelo = OllamaFalso()
+    servidores += [sin_modelo, con_modelo]
+    try:
+        configurar_modelo(monkeypatch, "llama3", sin_modelo)
+        assert (await llm.query_llm("llama3", llm.Item(model="llama3", prompt="a")))["error"] == "Error HTTP 404"
+        host = llm.hosts[sin_modelo.url]
+        assert "llama3:latest" not in host.loaded
+        assert host.status()["missing_models"] == ["llama3:latest"]
+        assert host.consecutive_failures == 0
+
+        configurar_modelo(monkeypatch, "llama3", sin_modelo, con_modelo)
+        for i in range(3):
+            assert (await llm.query_llm("llama3", llm.Item(model="llama3", prompt=f"b{i}")))["response"] == f"respuesta a b{i}"
+        assert (len(sin_modelo.peticiones), len(con_modelo.peticiones)) == (1, 3)
+
+        # Pasado el tiempo de espera se vuelve a probar el servidor
+        host.missing["llama3:latest"] = 0
+        assert not host.lacks("llama3")
+    finally:
+        await llm.close_clients()
+
+
+def test_servidor_con_fallos_se_expulsa_y_se_readmite(monkeypatch, servidores):
+    """Verifica que un servidor que falla varias veces seguidas deja de recibir peticiones un tiempo"""
+    monkeypatch.setattr(llm, "LLM_EJECTION_THRESHOLD", 2)
+    monkeypatch.setattr(llm, "LLM_EJECTION_TIME", 0.3)
+    averiado = OllamaFalso(cargados=["llama3:latest"])
+    sano = OllamaFalso()
+    servidores += [averiado, sano]
+    configurar_modelo(monkeypatch, "llama3", averiado, sano)
+    averiado.falla = True
+
+    with TestClient(llm.app) as client:
+        def consulta(prompt):
+            return client.post("/chat/llama3", json={"model": "llama3", "prompt": prompt})
+
+        assert [consulta(f"a{i}").status_code for i in range(2)] == [500, 500]
+        assert all(consulta(f"b{i}").status_code == 200 for i in range(3))
+        assert (len(averiado.peticiones), len(sano.peticiones)) == (2, 3)
+        estado = client.get("/metrics").json()["hosts"][averiado.url]
+        assert estado["ejections"] == 1 and estado["ejected_for_s"] > 0
+
+        # Pasado el tiempo de expulsión vuelve a recibir peticiones (ambos tienen ya el modelo
+        # cargado y sin carga empatan, así que se alternan)
+        averiado.falla = False
+        time.sleep(0.35)
+        assert all(consulta(f"c{i}").status_code == 200 for i in range(2))
+        assert len(averiado.peticiones) == 3
+
+
+def test_reintenta_en_otro_servidor_si_no_conecta(monkeypatch, servidores):
+    """Verifica que si no se puede conectar con un servidor la petición se envía a otro"""
+    caido = OllamaFalso(cargados=["llama3:latest"])
+    sano = OllamaFalso()
+    servidores.append(sano)
+    configurar_modelo(monkeypatch, "llama3", caido, sano)
+    caido.cerrar()
+
+    # El primer intento va al servidor caído (empatan y es el primero de la lista)
+    with TestClient(llm.app) as client:
+        response = client.post("/chat/llama3", json={"model": "llama3", "prompt": "p"})
+        assert response.json() == {"response": "respuesta a p"}
+        response = client.post("/chat/llama3", json={"model": "llama3", "prompt": "q", "stream": True})
+        assert response.status_code == 200 and response.text.count("\n") == 3
+    assert llm.hosts[caido.url].failures == 1 and llm.hosts[caido.url].outstanding == 0
+    assert llm.hosts[sano.url].outstanding == 0
+
+
+def test_sin_franjas_no_se_envia_keep_alive(monkeypatch, ollama):
+    """Verifica que sin franjas ni LLM_KEEP_ALIVE las consultas no sobrescriben el keep_alive de Ollama"""
+    configurar_modelo(monkeypatch, "llama3", ollama)
+    monkeypatch.setattr(llm, "residency", llm.ResidencyManager([]))
+    with TestClient(llm.app) as client:
+        assert client.post("/chat/llama3", json={"model": "llama3", "prompt": "hola"}).status_code == 200
+    assert "keep_alive" not in ollama.peticiones[-1]
+
+
+def test_franjas_de_residencia():
+    """Verifica el keep_alive dentro y fuera de las franjas en las que los modelos se mantienen cargados"""
+    residencia = llm.ResidencyManager([], "1-5 08:00-21:00; 6 09:00-14:00", keep_alive="5m")
+    # 2025-03-03 es lunes
+    assert residencia.keep_alive(datetime(2025, 3, 3, 20, 0, 0)) == 3600
+    assert residencia.keep_alive(datetime(2025, 3, 3, 21, 0, 0)) == "5m"
+    assert residencia.keep_alive(datetime(2025, 3, 8, 13, 59, 30)) == 30
+    assert residencia.keep_alive(datetime(2025, 3, 9, 12, 0, 0)) == "5m"
+    assert llm.ResidencyManager([], "7 00:00-24:00").warm_until(datetime(2025, 3, 9, 23, 0)) == datetime(2025, 3, 10)
+    # Sin LLM_KEEP_ALIVE fuera de las franjas no se envía keep_alive: manda el del servidor
+    sin_valor = llm.ResidencyManager([], "1-5 08:00-21:00")
+    assert sin_valor.keep_alive(datetime(2025, 3, 3, 21, 0, 0)) is None
+    assert sin_valor.keep_alive(datetime(2025, 3, 3, 20, 0, 0)) == 3600
+
+    for franja in ("lunes 08:00-21:00", "1-5 21:00-08:00", "0 08:00-09:00"):
+        with pytest.raises(ValueError):
+            llm.parse_schedule(franja)
+
+
+@pytest.mark.asyncio
+async def test_precarga_y_estado_de_residencia(monkeypatch, servidores):
+    """Verifica que los modelos se precargan en todos sus servidores y se informa de su uso"""
+    cargado = OllamaFalso(cargados=["llama3:latest"])
+    vacio = OllamaFalso()
+    servidores += [cargado, vacio]
+    monkeypatch.setattr(llm, "LLM_CONFIG", {})
+    configurar_modelo(monkeypatch, "llama3", cargado, vacio)
+    residencia = llm.ResidencyManager(["llama3", "desconocido"], "1-7 00:00-24:00")
+    monkeypatch.setattr(llm, "residency", residencia)
+    try:
+        await residencia.load_all()
+        assert cargado.peticiones == []
+        assert vacio.peticiones == [{"model": "llama3", "keep_alive": vacio.peticiones[0]["keep_alive"], "options": {"num_ctx": llm.LLM_NUM_CTX}}]
+        assert vacio.peticiones[0]["keep_alive"] > 0
+        assert await residencia.load("llama3") == 0
+
+        # Las consultas también piden conservar el modelo hasta el final de la franja
+        await llm.query_llm("llama3", llm.Item(model="llama3", prompt="p"))
+        assert isinstance((cargado.peticiones + vacio.peticiones)[-1]["keep_alive"], int)
+
+        estado = await residencia.status()
+        modelo = estado["models"]["llama3"]
+        assert modelo["preload"] and len(modelo["resident"]) == 2
+        assert modelo["idle_s"] is not None and modelo["idle_s"] < 5
+        assert estado["loads"] == 1 and estado["warm_until"] is not None
+    finally:
+        await llm.close_clients()
+
+
+def test_lote_devuelve_resultados_en_orden_con_errores_por_elemento(monkeypatch, servidores):
+    """Verifica que el lote respeta el paralelismo, conserva el orden y aísla los errores de cada consulta"""
+    ollama = OllamaFalso(retardo=0.05)
+    servidores.append(ollama)
+    configurar_modelo(monkeypatch, "llama3", ollama, max_concurrent=8)
+    prompts = ["p0", "falla", "p2", "p3", "p4", "p5"]
+    items = [{"model": "llama3", "prompt": prompt} for prompt in prompts] + [{"model": "llama3", "prompt": "p", "stream": True}]
+
+    with TestClient(llm.app) as client:
+        response = client.post("/chat/llama3/batch", json={"items": items, "parallelism": 2})
+        assert response.status_code == 200
+        datos = response.json()
+        assert [r["index"] for r in datos["results"]] == list(range(7))
+        assert [r["status_code"] for r in datos["results"]] == [200, 500, 200, 200, 200, 200, 400]
+        assert datos["results"][2]["result"] == {"response": "respuesta a p2"}
+        assert datos["summary"] == {"total": 7, "ok": 5, "errors": 2}
+        assert ollama.max_activas == 2
+        assert client.get("/metrics").json()["schedulers"]["llama3"]["queues"]["batch"]["depth"] == 0
+
+        assert client.post("/chat/llama3/batch", json={"items": []}).status_code == 400
+        assert client.post("/chat/otro/batch", json={"items": items}).status_code == 404
+
+
+def test_lote_en_streaming(monkeypatch, servidores):
+    """Verifica que con stream: true cada resultado se envía en una línea NDJSON al terminar"""
+    ollama = OllamaFalso()
+    servidores.append(ollama)
+    configurar_modelo(monkeypatch, "llama3", ollama)
+    items = [{"model": "llama3", "prompt": f"p{i}"} for i in range(5)]
+
+    with TestClient(llm.app) as client:
+        response = client.post("/chat/llama3/batch", json={"items": items, "stream": True})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lineas = [json.loads(linea) for linea in response.text.splitlines()]
+    assert sorted(linea["index"] for linea in lineas) == list(range(5))
+    assert all(linea["result"] == {"response": f"respuesta a p{linea['index']}"} for linea in lineas)
+
+
+def test_recorte_del_prompt_al_contexto(monkeypatch, servidores):
+    """Verifica que la parte variable del prompt se recorta por el centro conservando las instrucciones"""
+    servidores.append(OllamaFalso())
+    configurar_modelo(monkeypatch, "llama3", *servidores, num_ctx=400)
+    solucion = "inicio " + "x" * 3000 + " final"
+    item = llm.Item(model="llama3", prompt=f"Evalúa la solución: {solucion}. Nota: n/10", max_tokens=100, truncatable=solucion)
+    contador = llm.get_token_counter("llama3")
+
+    ajustado, recorte = llm.fit_context("llama3", item)
+    assert ajustado.prompt.startswith("Evalúa la solución: inicio ") and ajustado.prompt.endswith(" final. Nota: n/10")
+    assert "caracteres omitidos" in ajustado.prompt
+    assert contador.count(ajustado.prompt) <= 400 - 100 - llm.LLM_CONTEXT_MARGIN
+    assert recorte["removed_chars"] > 2000 and recorte["prompt_tokens"] == contador.count(ajustado.prompt)
+
+    # Sin fragmento variable se recorta el prompt entero; si cabe no se toca
+    assert "caracteres omitidos" in llm.fit_context("llama3", item.model_copy(update={"truncatable": None}))[0].prompt
+    corto = llm.Item(model="llama3", prompt="hola", max_tokens=100)
+    assert llm.fit_context("llama3", corto) == (corto, None)
+
+    with pytest.raises(llm.HTTPException) as excinfo:
+        llm.fit_context("llama3", item.model_copy(update={"prompt": "y" * 3000 + solucion}))
+    assert excinfo.value.status_code == 413
+    with pytest.raises(llm.HTTPException) as excinfo:
+        llm.fit_context("llama3", corto.model_copy(update={"max_tokens": 400}))
+    assert excinfo.value.status_code == 400
+
+
+def test_recuento_de_tokens_en_respuestas_y_metricas(monkeypatch, servidores):
+    """Verifica que se informa de los tokens y la velocidad, y que la estimación se calibra con Ollama"""
+    ollama = OllamaFalso()
+    ollama.recuentos = True
+    servidores.append(ollama)
+    configurar_modelo(monkeypatch, "llama3", ollama, num_ctx=400)
+    solucion = "s" * 3000
+
+    with TestClient(llm.app) as client:
+        consulta = {"model": "llama3", "prompt": f"Instrucciones. {solucion}", "max_tokens": 100, "truncatable": solucion}
+        datos = client.post("/chat/llama3", json=consulta).json()
+        assert datos["usage"]["completion_tokens"] == 20 and datos["usage"]["tokens_per_second"] == 40.0
+        assert datos["truncation"]["removed_chars"] > 0
+        assert ollama.peticiones[0]["prompt"].startswith("Instrucciones. ")
+        assert ollama.peticiones[0]["options"]["num_ctx"] == 400
+
+        response = client.post("/chat/llama3", json={**consulta, "stream": True})
+        assert int(response.headers["x-prompt-truncated"]) > 0
+
+        metricas = client.get("/metrics").json()["tokens"]["llama3"]
+        assert metricas["requests"] == 2 and metricas["completion_tokens"] == 40
+        assert metricas["tokens_per_second"] == 40.0 and metricas["truncated_prompts"] == 2
+        # El servidor falso cuenta 4 caracteres por token: la estimación se acerca a ese valor
+        assert 3.0 < metricas["chars_per_token"] < 4.0
@@ -0,0 +1,681 @@
+import pytest
+import asyncio
+import os
+import sys
+
+# El servidor OCR necesita torch, transformers y qwen_vl_utils
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("qwen_vl_utils")
+
+api_ia_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "api_IA")
+sys.path.insert(0, api_ia_dir)
+
+import ocr
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_agrupa_y_conserva_orden():
+    """Verifica que las peticiones concurrentes se agrupan en lotes y cada una recibe su resultado"""
+    lotes = []
+
+    def procesar_lote(items):
+        lotes.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = ocr.MicroBatcher(procesar_lote, max_batch_size=4, max_wait_ms=50)
+    resultados = await asyncio.gather(*(batcher.submit(i) for i in range(6)))
+
+    await batcher.close()
+
+    assert resultados == [i * 10 for i in range(6)]
+    assert [len(lote) for lote in lotes] == [4, 2]
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_propaga_errores_al_lote():
+    """Verifica que un error en el lote se devuelve a todas sus peticiones sin detener el planificador"""
+    def procesar_lote(items):
+        if "error" in items:
+            raise ValueError("fallo en generate")
+        return items
+
+    batcher = ocr.MicroBatcher(procesar_lote, max_batch_size=2, max_wait_ms=20)
+    resultados = await asyncio.gather(batcher.submit("error"), batcher.submit("a"), return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in resultados)
+
+    assert await batcher.submit("b") == "b"
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_admission_queue_rechaza_con_429_si_la_cola_esta_llena():
+    """Verifica que con la cola llena se responde 429 con Retry-After"""
+    cola = ocr.AdmissionQueue(max_concurrent=1, max_queue=1, retry_after=7)
+    liberar = asyncio.Event()
+
+    async def peticion():
+        async with cola.admitir():
+            await liberar.wait()
+
+    primera = asyncio.create_task(peticion())
+    segunda = asyncio.create_task(peticion())
+    await asyncio.sleep(0.01)
+    assert cola.status()["en_curso"] == 1
+    assert cola.status()["en_espera"] == 1
+
+    with pytest.raises(ocr.HTTPException) as excinfo:
+        async with cola.admitir():
+            pass
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.headers["Retry-After"] == "7"
+
+    liberar.set()
+    await asyncio.gather(primera, segunda)
+    assert cola.status()["en_curso"] == 0
+
+
+@pytest.mark.asyncio
+async def test_precarga_marca_modelos_listos_y_con_error(monkeypatch):
+    """Verifica que /health/ready solo está listo cuando todos los modelos precargados lo están"""
+    def cargar(model_name):
+        if model_name == "qwen3b":
+            raise RuntimeError("sin memoria")
+        return {}
+
+    monkeypatch.setattr(ocr, "load_qwen_model", cargar)
+    monkeypatch.setattr(ocr, "process_qwen_batch", lambda images, model_name, max_new_tokens=1024: [""])
+    monkeypatch.setattr(ocr, "model_status", {})
+
+    monkeypatch.setattr(ocr, "OCR_PRELOAD_MODELS", ["qwen7b"])
+    await ocr.preload_models()
+    assert ocr.readiness()["ready"] is True
+
+    monkeypatch.setattr(ocr, "OCR_PRELOAD_MODELS", ["qwen7b", "qwen3b"])
+    await ocr.preload_models()
+    response = ocr.readiness()
+    assert response.status_code == 503
+    assert ocr.model_status["qwen3b"].startswith("error")
+
+
+@pytest.mark.parametrize("width,height", [(1240, 1754), (300, 80), (4000, 3000), (28, 900)])
+def test_pixel_budget_size_respeta_rejilla_y_presupuesto(width, height):
+    """Verifica que el redimensionado mantiene la proporción, la rejilla de 28 px y los límites de píxeles"""
+    min_pixels, max_pixels = 256 * 28 * 28, 1280 * 28 * 28
+    new_width, new_height = ocr.pixel_budget_size(width, height, min_pixels, max_pixels)
+
+    assert new_width % 28 == 0 and new_height % 28 == 0
+    assert min_pixels <= new_width * new_height <= max_pixels
+    assert abs(new_width / new_height - width / height) / (width / height) < 0.15
+
+
+class ModeloFalso:
+    def __init__(self, gb):
+        self.gb = gb
+
+    def get_memory_footprint(self):
+        return int(self.gb * 1024**3)
+
+
+def test_model_manager_expulsa_lru_respetando_fijados():
+    """Verifica que al superar el presupuesto se descarga el modelo menos usado que no esté fijado"""
+    tamanos = {"fijo": 4, "a": 3, "b": 3, "c": 3}
+    cargados = []
+
+    def cargar(nombre):
+        cargados.append(nombre)
+        return {"model": ModeloFalso(tamanos[nombre])}
+
+    manager = ocr.ModelManager(cargar, memory_budget_gb=10, pinned=["fijo"])
+    manager.get("fijo")
+    manager.get("a")
+    manager.get("b")
+    manager.get("a")  # "a" pasa a ser el más reciente
+    manager.get("c")  # no cabe: se descarga "b" (LRU sin fijar)
+
+    assert list(manager.models) == ["fijo", "a", "c"]
+    assert manager.evictions == 1
+    assert cargados == ["fijo", "a", "b", "c"]
+
+    estado = manager.status()
+    assert estado["memory_used_gb"] == 10
+    assert {m["nombre"]: m["pinned"] for m in estado["modelos"]}["fijo"] is True
+
+
+def test_model_manager_no_expulsa_modelos_en_uso():
+    """Verifica que un modelo en uso no se descarga aunque sea el menos usado"""
+    manager = ocr.ModelManager(lambda nombre: {"model": ModeloFalso(4)}, memory_budget_gb=10)
+    with manager.use("a"):
+        manager.get("b")
+        manager.get("c")  # "a" es el menos usado pero está en uso: se descarga "b"
+        assert set(manager.models) == {"a", "c"}
+
+
+def test_model_manager_hace_sitio_antes_de_la_primera_carga(monkeypatch):
+    """Verifica que con "memory_gb" se descarga el modelo LRU antes de cargar uno nuevo"""
+    monkeypatch.setitem(ocr.OCR_CONFIG, "a", {"type": "transformers", "memory_gb": 6})
+    monkeypatch.setitem(ocr.OCR_CONFIG, "b", {"type": "transformers", "memory_gb": 6})
+    cargados_al_cargar = []
+
+    def cargar(nombre):
+        cargados_al_cargar.append(list(manager.models))
+        return {"model": ModeloFalso(6)}
+
+    manager = ocr.ModelManager(cargar, memory_budget_gb=10)
+    manager.get("a")
+    manager.get("b")
+
+    # "a" ya se había descargado cuando empezó la carga de "b"
+    assert cargados_al_cargar == [[], []]
+    assert list(manager.models) == ["b"]
+
+
+def test_model_manager_avisa_de_memoria_desconocida_y_fijados_sobre_el_presupuesto(caplog):
+    """Verifica que se avisa si no se puede estimar un modelo o si los fijados no caben"""
+    import logging
+    manager = ocr.ModelManager(lambda nombre: {"model": ModeloFalso(12)}, memory_budget_gb=10, pinned=["fijo"])
+    with caplog.at_level(logging.WARNING, logger=ocr.logger.name):
+        manager.get("fijo")
+
+    assert "Se desconoce la memoria de fijo" in caplog.text
+    assert "Los modelos fijados ocupan 12.0 GB" in caplog.text
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger=ocr.logger.name):
+        ocr.ModelManager(lambda nombre: {}, memory_budget_gb=10, pinned=["qwen7b"])
+    assert "Los modelos fijados (qwen7b)" in caplog.text
+
+
+def test_model_manager_carga_fuera_del_cerrojo():
+    """Verifica que una carga lenta no bloquea los modelos cargados ni el estado y se hace una sola vez"""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    empezada = threading.Event()
+    continuar = threading.Event()
+    cargas = []
+
+    def cargar(nombre):
+        cargas.append(nombre)
+        if nombre == "lento":
+            empezada.set()
+            continuar.wait(5)
+        return {"model": ModeloFalso(1)}
+
+    manager = ocr.ModelManager(cargar)
+    rapido = manager.get("rapido")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        primera = pool.submit(manager.get, "lento")
+        assert empezada.wait(5)
+        segunda = pool.submit(manager.get, "lento")
+
+        # Mientras "lento" se carga, el resto sigue respondiendo
+        assert manager.get("rapido") is rapido
+        assert manager.status()["loading"] == ["lento"]
+        with manager.use("rapido"):
+            pass
+
+        continuar.set()
+        assert primera.result(5) is segunda.result(5)
+
+    assert cargas == ["rapido", "lento"]
+    assert manager.status()["loading"] == []
+
+
+def test_model_manager_propaga_el_error_de_carga_a_quien_espera():
+    """Verifica que si la carga falla, las peticiones que la esperaban reciben el error y se puede reintentar"""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    empezada = threading.Event()
+    continuar = threading.Event()
+    intentos = []
+
+    def cargar(nombre):
+        intentos.append(nombre)
+        if len(intentos) == 1:
+            empezada.set()
+            continuar.wait(5)
+            raise RuntimeError("sin memoria")
+        return {"model": ModeloFalso(1)}
+
+    manager = ocr.ModelManager(cargar)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        primera = pool.submit(manager.get, "a")
+        assert empezada.wait(5)
+        segunda = pool.submit(manager.get, "a")
+        # Dar tiempo a que la segunda petición se quede esperando a la carga en curso
+        time.sleep(0.2)
+        continuar.set()
+        for futuro in (primera, segunda):
+            with pytest.raises(RuntimeError, match="sin memoria"):
+                futuro.result(5)
+
+    assert "a" not in manager.loading
+    assert manager.get("a")["model"].gb == 1
+
+
+def test_cuantizacion_int8_reduce_memoria_y_conserva_salida():
+    """Verifica que la cuantización int8 reduce el tamaño de los pesos manteniendo la salida aproximada"""
+    import torch
+    torch.manual_seed(0)
+    modelo = torch.nn.Sequential(torch.nn.Linear(256, 256), torch.nn.ReLU(), torch.nn.Linear(256, 16)).eval()
+    entrada = torch.randn(4, 256)
+
+    cuantizado = ocr.quantize_int8(modelo)
+
+    assert ocr.state_dict_nbytes(cuantizado) < ocr.state_dict_nbytes(modelo) / 2
+    assert torch.allclose(cuantizado(entrada), modelo(entrada), atol=0.1)
+
+
+def test_split_into_strips_cubre_la_imagen_con_solape():
+    """Verifica que las franjas cubren toda la imagen y se solapan"""
+    from PIL import Image
+    imagen = Image.new("RGB", (600, 2000))
+    franjas = ocr.split_into_strips(imagen, strip_height=450, overlap=0.2)
+
+    assert all(f.size == (600, 450) for f in franjas)
+    assert len(franjas) == 6  # 0, 360, 720, 1080, 1440 y la última alineada abajo (1550)
+    assert ocr.split_into_strips(Image.new("RGB", (600, 400)), 450, 0.2)[0].size == (600, 400)
+
+
+def test_merge_overlapping_texts_elimina_lineas_repetidas():
+    """Verifica que las líneas del solape solo aparecen una vez al unir las franjas"""
+    primera = "def suma(a, b):\n    c = a + b\n    return c"
+    segunda = "    c = a + b\n    return  c\n\nprint(suma(1, 2))"
+    assert ocr.merge_overlapping_texts(primera, segunda) == (
+        "def suma(a, b):\n    c = a + b\n    return c\n\nprint(suma(1, 2))"
+    )
+
+    # Línea cortada por el borde de la franja
+    assert ocr.merge_overlapping_texts("for i in range(10):\n    pri", "    print(i)\nfin") == (
+        "for i in range(10):\n    print(i)\nfin"
+    )
+
+
+def test_predict_stream_emite_eventos_sse(monkeypatch):
+    """Verifica que el endpoint de streaming reenvía los fragmentos como eventos SSE"""
+    import io
+    import json
+    from PIL import Image
+    from fastapi.testclient import TestClient
+
+    def stream_falso(image, model_name, result=None, image_data=None, stop=None):
+        yield "def suma"
+        yield "(a, b):"
+
+    monkeypatch.setattr(ocr, "stream_ollama_response", stream_falso)
+    imagen = io.BytesIO()
+    Image.new("RGB", (40, 20), "white").save(imagen, format="PNG")
+
+    client = TestClient(ocr.app)
+    response = client.post("/predict/gemma3:4b/stream", files={"image": ("a.png", imagen.getvalue(), "image/png")})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    eventos = [json.loads(linea[len("data: "):]) for linea in response.text.split("\n\n") if linea]
+    assert eventos == [{"text": "def suma"}, {"text": "(a, b):"}, {"done": True}]
+    assert ocr.admission_queue.status()["en_curso"] == 0
+
+
+@pytest.mark.asyncio
+async def test_predict_stream_libera_la_plaza_si_el_cliente_se_desconecta(monkeypatch):
+    """Verifica que una desconexión mientras Ollama se lee en otro hilo libera la plaza y detiene la lectura"""
+    import io
+    import threading
+    from PIL import Image
+    from fastapi import UploadFile
+
+    leyendo = threading.Event()
+    continuar = threading.Event()
+    detenido = threading.Event()
+
+    def stream_falso(image, model_name, result=None, image_data=None, stop=None):
+        yield "def suma"
+        # Bloqueado a la espera del siguiente fragmento de Ollama
+        leyendo.set()
+        continuar.wait(5)
+        if stop.is_set():
+            detenido.set()
+            return
+        yield "(a, b):"
+
+    monkeypatch.setattr(ocr, "stream_ollama_response", stream_falso)
+    imagen = io.BytesIO()
+    Image.new("RGB", (40, 20), "white").save(imagen, format="PNG")
+    imagen.seek(0)
+
+    response = await ocr.predict_stream("gemma3:4b", UploadFile(file=imagen, filename="a.png"), None)
+    eventos = response.body_iterator
+    assert await eventos.__anext__() == 'data: {"text": "def suma"}\n\n'
+    siguiente = asyncio.ensure_future(eventos.__anext__())
+    await asyncio.get_running_loop().run_in_executor(None, leyendo.wait, 5)
+    assert ocr.admission_queue.status()["en_curso"] == 1
+
+    # El cliente se desconecta mientras el hilo está dentro de next()
+    siguiente.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await siguiente
+    assert ocr.admission_queue.status()["en_curso"] == 0
+
+    continuar.set()
+    assert await asyncio.get_running_loop().run_in_executor(None, detenido.wait, 5)
+
+
+@pytest.mark.asyncio
+async def test_predict_stream_libera_la_plaza_si_el_cliente_se_va_antes_del_primer_fragmento(monkeypatch):
+    """Verifica que la plaza se libera aunque el cuerpo de la respuesta no llegue a leerse"""
+    import io
+    from PIL import Image
+    from fastapi import UploadFile
+
+    def stream_falso(image, model_name, result=None, image_data=None, stop=None):
+        yield "def suma"
+
+    monkeypatch.setattr(ocr, "stream_ollama_response", stream_falso)
+    imagen = io.BytesIO()
+    Image.new("RGB", (40, 20), "white").save(imagen, format="PNG")
+    imagen.seek(0)
+
+    response = await ocr.predict_stream("gemma3:4b", UploadFile(file=imagen, filename="a.png"), None)
+    assert ocr.admission_queue.status()["en_curso"] == 1
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # El envío cede el control: la desconexión se detecta antes de leer el cuerpo
+        await asyncio.sleep(0.01)
+
+    await response({"type": "http", "asgi": {"spec_version": "2.0"}}, receive, send)
+    assert ocr.admission_queue.status()["en_curso"] == 0
+
+
+def test_predict_stream_coincide_con_predict_en_un_bucle(monkeypatch):
+    """Verifica que el streaming no envía las copias de un bucle que /predict recorta"""
+    import io
+    import json
+    import torch
+    from PIL import Image
+    from fastapi.testclient import TestClient
+
+    texto = "".join(f"linea {i}\n" for i in range(40)) + "x = x + 1\n" * 50
+
+    class Tokenizador:
+        # Un token por carácter; el 1 es el prompt
+        def decode(self, ids, **kwargs):
+            return "".join(chr(i) for i in ids if i > 1)
+
+    def generar_falso(images, model_name, assisted=False, stopping_criteria=None, streamer=None):
+        criterio = ocr.TokenBudgetCriteria(1, [len(texto)], [0])
+        ids = [1]
+        if streamer:
+            streamer.put(torch.tensor([ids]))
+        for caracter in texto:
+            ids.append(ord(caracter))
+            if streamer:
+                streamer.put(torch.tensor([ids[-1]]))
+            if criterio(torch.tensor([ids]), None)[0]:
+                break
+        if streamer:
+            streamer.end()
+        generados = ids[1:criterio.stop_at[0]]
+        return [
+            {"text": "".join(map(chr, generados)), "tokens": len(generados), "max_new_tokens": len(texto), "stop_reason": "loop"}
+            for _ in images
+        ]
+
+    monkeypatch.setitem(ocr.OCR_CONFIG, "bucle", {"type": "transformers"})
+    monkeypatch.setattr(ocr, "batchers", {})
+    monkeypatch.setattr(ocr, "load_qwen_model", lambda nombre: {"processor": type("Procesador", (), {"tokenizer": Tokenizador()})()})
+    monkeypatch.setattr(ocr, "generate_qwen_batch", generar_falso)
+    imagen = io.BytesIO()
+    Image.new("RGB", (40, 20), "white").save(imagen, format="PNG")
+    ficheros = {"image": ("a.png", imagen.getvalue(), "image/png")}
+
+    client = TestClient(ocr.app)
+    prediccion = client.post("/predict/bucle", files=ficheros).json()
+    response = client.post("/predict/bucle/stream", files=ficheros)
+
+    eventos = [json.loads(linea[len("data: "):]) for linea in response.text.split("\n\n") if linea]
+    fragmentos = [evento["text"] for evento in eventos if "text" in evento]
+    assert prediccion["stop_reason"] == "loop"
+    assert prediccion["prediction"].endswith("linea 39\nx = x + 1")
+    # Se envía texto antes de terminar, pero nunca las copias recortadas
+    assert len(fragmentos) > 1
+    assert "".join(fragmentos) == prediccion["prediction"]
+    assert eventos[-1]["done"] and eventos[-1]["stop_reason"] == "loop"
+
+
+def modelo_qwen_diminuto(vocab_size: int = 200):
+    """Modelo Qwen2.5-VL aleatorio y diminuto, con una entrada de prefijo + imagen + texto"""
+    import torch
+    from transformers import Qwen2_5_VLConfig, Qwen2_5_VLForConditionalGeneration
+    torch.manual_seed(0)
+    config = Qwen2_5_VLConfig(
+        text_config=dict(
+            vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+            num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512,
+            rope_scaling={"type": "mrope", "mrope_section": [2, 3, 3]}
+        ),
+        vision_config=dict(
+            depth=2, hidden_size=32, intermediate_size=64, num_heads=2, out_hidden_size=64,
+            fullatt_block_indexes=[1], patch_size=14, spatial_merge_size=2, temporal_patch_size=2, window_size=56
+        ),
+        image_token_id=5, video_token_id=6, vision_start_token_id=4, vision_end_token_id=7
+    )
+    modelo = Qwen2_5_VLForConditionalGeneration(config).eval()
+
+    prefijo = torch.randint(10, 200, (1, 12))
+    prefijo[0, -1] = 4
+    input_ids = torch.cat([prefijo, torch.full((1, 4), 5), torch.tensor([[7, 50, 60, 70]])], dim=1)
+    inputs = {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "pixel_values": torch.randn(16, 3 * 2 * 14 * 14),
+        "image_grid_thw": torch.tensor([[1, 4, 4]]),
+        "mm_token_type_ids": (input_ids == 5).int()
+    }
+    return modelo, inputs
+
+
+def test_cache_de_prefijo_genera_lo_mismo_que_sin_cache(monkeypatch):
+    """Verifica que reutilizar la cache KV del prefijo no cambia la salida y que se calcula una sola vez"""
+    modelo, inputs = modelo_qwen_diminuto()
+    monkeypatch.setattr(ocr, "prefix_cache_stats", {"hits": 0, "misses": 0, "tokens_reused": 0})
+    model_data = {"model": modelo}
+
+    import torch
+    opciones = dict(max_new_tokens=8, do_sample=False, output_scores=True, return_dict_in_generate=True)
+
+    monkeypatch.setattr(ocr, "OCR_PREFIX_CACHE", False)
+    esperado = ocr.qwen_generate(model_data, inputs, **opciones)
+
+    monkeypatch.setattr(ocr, "OCR_PREFIX_CACHE", True)
+    for _ in range(2):
+        generado = ocr.qwen_generate(model_data, inputs, **opciones)
+        assert generado.sequences.tolist() == esperado.sequences.tolist()
+        assert all(torch.allclose(a, b, atol=1e-4) for a, b in zip(generado.scores, esperado.scores))
+
+    assert ocr.prefix_cache_stats == {"hits": 1, "misses": 1, "tokens_reused": 12}
+    # La cache compartida no crece con las peticiones
+    assert model_data["prefix_cache"]["cache"].get_seq_length() == 12
+
+
+def test_orden_de_la_instruccion_depende_de_la_cache_de_prefijo(monkeypatch):
+    """Verifica que la instrucción solo se adelanta a la imagen cuando se usa la cache del prefijo"""
+    from PIL import Image
+
+    class Procesador:
+        def apply_chat_template(self, messages, **kwargs):
+            return [parte["type"] for parte in messages[0]["content"]]
+
+        def __call__(self, text, **kwargs):
+            return type("Entradas", (), {"to": lambda entradas, device: text})()
+
+    monkeypatch.setattr(ocr, "process_vision_info", lambda messages: (None, None))
+    imagen = Image.new("RGB", (40, 20), "white")
+
+    monkeypatch.setattr(ocr, "OCR_PREFIX_CACHE", False)
+    assert ocr.build_qwen_inputs([imagen], "qwen3b", Procesador(), "cpu") == [["image", "text"]]
+    monkeypatch.setattr(ocr, "OCR_PREFIX_CACHE", True)
+    assert ocr.build_qwen_inputs([imagen], "qwen3b", Procesador(), "cpu") == [["text", "image"]]
+
+
+@pytest.fixture
+def modelos_asistidos(monkeypatch):
+    """Modelo principal y borrador diminutos gestionados por un ModelManager de prueba"""
+    principal, inputs = modelo_qwen_diminuto()
+    borrador, _ = modelo_qwen_diminuto()
+    monkeypatch.setitem(ocr.OCR_CONFIG, "principal", {"type": "transformers", "draft_model": "borrador"})
+    monkeypatch.setitem(ocr.OCR_CONFIG, "borrador", {"type": "transformers"})
+    modelos = {"principal": principal, "borrador": borrador}
+    llamadas_borrador = []
+    borrador.register_forward_hook(lambda *args: llamadas_borrador.append(1))
+    return modelos, inputs, llamadas_borrador
+
+
+def test_decodificacion_asistida_usa_el_borrador(monkeypatch, modelos_asistidos):
+    """Verifica que la decodificación asistida usa el borrador y obtiene la misma transcripción"""
+    modelos, inputs, llamadas_borrador = modelos_asistidos
+    monkeypatch.setattr(ocr, "model_manager", ocr.ModelManager(lambda nombre: {"model": modelos[nombre]}))
+
+    with ocr.model_manager.use("principal") as model_data:
+        esperado = ocr.qwen_generate(model_data, inputs, max_new_tokens=8, do_sample=False)
+        generado = ocr.assisted_generate(model_data, "principal", inputs, max_new_tokens=8, do_sample=False)
+
+    assert generado.tolist() == esperado.tolist()
+    assert llamadas_borrador
+    assert "borrador" in ocr.model_manager.models
+
+
+def test_decodificacion_asistida_con_borrador_de_otro_vocabulario(monkeypatch, modelos_asistidos):
+    """Verifica que un borrador con otro tamaño de vocabulario no hace fallar la petición"""
+    modelos, inputs, llamadas_borrador = modelos_asistidos
+    borrador, _ = modelo_qwen_diminuto(vocab_size=256)
+    assert borrador.config.get_text_config().vocab_size != modelos["principal"].config.get_text_config().vocab_size
+    modelos["borrador"] = borrador
+    monkeypatch.setattr(ocr, "model_manager", ocr.ModelManager(lambda nombre: {"model": modelos[nombre]}))
+
+    with ocr.model_manager.use("principal") as model_data:
+        esperado = ocr.qwen_generate(model_data, inputs, max_new_tokens=8, do_sample=False)
+        generado = ocr.assisted_generate(model_data, "principal", inputs, max_new_tokens=8, do_sample=False)
+
+    assert generado.tolist() == esperado.tolist()
+
+
+def test_decodificacion_asistida_sin_memoria_para_el_borrador(monkeypatch, modelos_asistidos):
+    """Verifica que si el borrador no cabe junto al principal se genera sin él y se descarga"""
+    modelos, inputs, llamadas_borrador = modelos_asistidos
+    huella = modelos["principal"].get_memory_footprint()
+    manager = ocr.ModelManager(lambda nombre: {"model": modelos[nombre]}, memory_budget_gb=1.5 * huella / 1024**3)
+    monkeypatch.setattr(ocr, "model_manager", manager)
+
+    with manager.use("principal") as model_data:
+        generado = ocr.assisted_generate(model_data, "principal", inputs, max_new_tokens=8, do_sample=False)
+        assert generado.shape[1] == inputs["input_ids"].shape[1] + 8
+        # Con la huella ya conocida no se vuelve a intentar cargar
+        assert not manager.can_fit("borrador")
+        assert ocr.load_draft_model("principal") is None
+
+    assert not llamadas_borrador
+    assert list(manager.models) == ["principal"]
+
+
+def test_borrador_en_uso_no_se_descarga_al_superar_el_presupuesto(monkeypatch):
+    """Verifica que el borrador solo se descarga por falta de memoria cuando nadie lo está usando"""
+    monkeypatch.setitem(ocr.OCR_CONFIG, "principal", {"type": "transformers", "draft_model": "borrador"})
+    monkeypatch.setitem(ocr.OCR_CONFIG, "borrador", {"type": "transformers"})
+    manager = ocr.ModelManager(lambda nombre: {"model": ModeloFalso(6)}, memory_budget_gb=10)
+    monkeypatch.setattr(ocr, "model_manager", manager)
+
+    with manager.use("principal"):
+        with manager.use("borrador"):
+            assert manager.over_budget()
+            assert ocr.load_draft_model("principal") == "borrador"
+            assert "borrador" in manager.models
+        assert ocr.load_draft_model("principal") is None
+        assert list(manager.models) == ["principal"]
+
+
+def test_find_repetition_detecta_bucles_y_no_lineas_repetidas():
+    """Verifica que se detecta un bloque repetido en bucle pero no unas pocas líneas iguales"""
+    linea = [11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
+    assert ocr.find_repetition([1, 2, 3] + linea * 7, max_period=32, min_repeats=6, min_tokens=48) == (10, 7)
+    assert ocr.find_repetition([1, 2, 3] + linea * 3 + [4], max_period=32, min_repeats=6, min_tokens=48) is None
+    # Un único token repetido necesita cubrir min_tokens
+    assert ocr.find_repetition([7] * 20, max_period=32, min_repeats=6, min_tokens=48) is None
+    assert ocr.find_repetition([7] * 48, max_period=32, min_repeats=6, min_tokens=48) == (1, 48)
+
+
+def imagen_con_lineas(lineas: int, interlineado: int = 30, angulo: float = 0):
+    from PIL import Image, ImageDraw
+    imagen = Image.new("RGB", (800, 40 + lineas * interlineado), "white")
+    dibujo = ImageDraw.Draw(imagen)
+    for i in range(lineas):
+        dibujo.text((20, 20 + i * interlineado), "    resultado = suma(a, b) * 2  # comentario", fill="black", font_size=18)
+    return imagen.rotate(angulo, expand=True, fillcolor="white")
+
+
+def test_estimate_max_new_tokens_crece_con_el_texto():
+    """Verifica que el presupuesto de tokens depende de la cantidad de texto y respeta el máximo"""
+    from PIL import Image
+    corto = ocr.estimate_max_new_tokens(imagen_con_lineas(5), max_tokens=1024)
+    largo = ocr.estimate_max_new_tokens(imagen_con_lineas(20), max_tokens=1024)
+
+    assert len(ocr.detect_text_lines(imagen_con_lineas(20))) == 20
+    assert 1024 * ocr.OCR_MIN_TOKEN_FRACTION <= corto < largo < 1024
+    assert ocr.estimate_max_new_tokens(imagen_con_lineas(60), max_tokens=300) == 300
+    # Sin texto detectable o con muy pocas líneas no se recorta el presupuesto
+    assert ocr.estimate_max_new_tokens(Image.new("RGB", (400, 400), "white"), max_tokens=1024) == 1024
+    assert ocr.estimate_max_new_tokens(imagen_con_lineas(1), max_tokens=1024) == 1024
+
+
+def test_estimate_max_new_tokens_no_recorta_paginas_torcidas_o_apretadas():
+    """Verifica que si las líneas se funden (página torcida o interlineado estrecho) se usa el máximo"""
+    torcida = imagen_con_lineas(20, angulo=5)
+    apretada = imagen_con_lineas(20, interlineado=15)
+
+    assert len(ocr.detect_text_lines(torcida)) < 20
+    assert len(ocr.detect_text_lines(apretada)) < 20
+    assert ocr.estimate_max_new_tokens(torcida, max_tokens=1024) == 1024
+    assert ocr.estimate_max_new_tokens(apretada, max_tokens=1024) == 1024
+    # Unas pocas líneas fundidas entre líneas normales también invalidan la estimación
+    from PIL import Image
+    mixta = Image.new("RGB", (800, 1000), "white")
+    mixta.paste(imagen_con_lineas(10), (0, 0))
+    mixta.paste(imagen_con_lineas(6, interlineado=15), (0, 360))
+    assert ocr.estimate_max_new_tokens(mixta, max_tokens=1024) == 1024
+
+
+def test_token_budget_criteria_para_cada_secuencia_por_su_motivo():
+    """Verifica que cada secuencia del lote se detiene por su presupuesto o por bucle, y no las ya terminadas"""
+    import torch
+    prompt = [1, 2, 3]
+    bucle = prompt + [11, 12, 13, 14, 15, 16, 17, 18] * 6
+    presupuesto = prompt + list(range(20, 68))
+    en_curso = prompt + list(range(100, 148))
+    terminada = prompt + list(range(200, 208)) + [0] * 40
+    criterio = ocr.TokenBudgetCriteria(len(prompt), budgets=[100, 48, 100, 100], finished_ids=[0])
+
+    parar = criterio(torch.tensor([bucle, presupuesto, en_curso, terminada]), None)
+
+    assert parar.tolist() == [True, True, False, False]
+    assert criterio.stop_reasons == {0: "loop", 1: "length"}
+    # En el bucle solo se conserva la primera copia del bloque
+    assert criterio.stop_at[0] == len(prompt) + 8
+
+
+@pytest.mark.parametrize("formato,reenviado", [("JPEG", True), ("PNG", True), ("BMP", False), ("WEBP", False)])
+def test_encode_image_for_ollama_reenvia_los_bytes_originales(formato, reenviado):
+    """Verifica que los formatos que acepta Ollama se envían sin recodificar y el resto se pasa a JPEG"""
+    import base64
+    import io
+    from PIL import Image
+    original = io.BytesIO()
+    Image.new("RGB", (64, 32), "white").save(original, format=formato)
+    datos = original.getvalue()
+
+    enviado = base64.b64decode(ocr.encode_image_for_ollama(ocr.decode_image(datos), datos))
+
+    assert (enviado == datos) is reenviado
+    assert Image.open(io.BytesIO(enviado)).format == (formato if reenviado else "JPEG")
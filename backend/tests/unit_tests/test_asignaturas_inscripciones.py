@@ -9,6 +9,12 @@ from httpx import AsyncClient
 from sqlalchemy import select
 from passlib.context import CryptContext
 from sqlalchemy.orm import selectinload
+from sqlalchemy import event
+from models.actividad import Actividad
+from models.entrega import Entrega
+from datetime import datetime, UTC
+import csv
+import io
 
 # Configurar el marcador de pytest para todas las pruebas asíncronas
 pytestmark = pytest.mark.asyncio
@@ -487,6 +493,72 @@ async def test_exportar_calificaciones_csv(
     assert "Email" in headers
     assert "Nota Media" in headers
 
+# Test del contenido del CSV de calificaciones
+async def test_exportar_calificaciones_csv_contenido(
+    async_client: AsyncClient,
+    db_session: AsyncSession,
+    token_profesor: str,
+    asignatura_profesor: Asignatura,
+    inscripcion_alumno
+):
+    """Test para verificar las notas del CSV y que se obtienen con un número fijo de consultas sin leer las imágenes"""
+    asignatura_id = asignatura_profesor.id
+    alumnos = [inscripcion_alumno.alumno]
+    for i in range(2):
+        alumno = Usuario(
+            nombre=f"Alumno{i}",
+            apellidos="CSV",
+            email=f"alumno_csv{i}@test.com",
+            contrasena=get_password_hash("testpassword"),
+            tipo_usuario=TipoUsuario.ALUMNO
+        )
+        db_session.add(alumno)
+        await db_session.flush()
+        db_session.add(Inscripcion(alumno_id=alumno.id, asignatura_id=asignatura_id))
+        alumnos.append(alumno)
+    actividades = [
+        Actividad(titulo=f"Actividad {i}", descripcion="-", fecha_entrega=datetime.now(UTC), asignatura_id=asignatura_id)
+        for i in range(2)
+    ]
+    db_session.add_all(actividades)
+    await db_session.flush()
+    db_session.add_all([
+        Entrega(alumno_id=alumnos[0].id, actividad_id=actividades[0].id, calificacion=8.0, imagen=b"imagen" * 1000),
+        Entrega(alumno_id=alumnos[0].id, actividad_id=actividades[1].id, calificacion=None),
+        Entrega(alumno_id=alumnos[1].id, actividad_id=actividades[1].id, calificacion=3.0),
+        # Si hay varias entregas de una actividad cuenta la última
+        Entrega(alumno_id=alumnos[1].id, actividad_id=actividades[1].id, calificacion=5.0),
+    ])
+    await db_session.commit()
+    nombres = [(a.nombre, a.apellidos, a.email) for a in alumnos]
+
+    sentencias = []
+    def registrar(conn, cursor, statement, *args):
+        sentencias.append(statement)
+    event.listen(db_session.bind.sync_engine, "before_cursor_execute", registrar)
+    try:
+        response = await async_client.get(
+            f"/api/v1/asignaturas/{asignatura_id}/export-csv",
+            headers={"Authorization": f"Bearer {token_profesor}"}
+        )
+    finally:
+        event.remove(db_session.bind.sync_engine, "before_cursor_execute", registrar)
+
+    assert response.status_code == status.HTTP_200_OK
+    filas = list(csv.reader(io.StringIO(response.content.decode("utf-8"))))
+    assert filas[0] == [
+        "Nombre", "Apellidos", "Email",
+        "Actividad 0 - Estado", "Actividad 0 - Nota", "Actividad 1 - Estado", "Actividad 1 - Nota", "Nota Media"
+    ]
+    assert filas[1:] == [
+        [*nombres[0], "Entregado", "8.0", "Sin calificar", "0", "4.00"],
+        [*nombres[1], "No entregado", "0", "Entregado", "5.0", "2.50"],
+        [*nombres[2], "No entregado", "0", "No entregado", "0", "0.00"],
+    ]
+    # Usuario autenticado, asignatura, actividades y notas
+    assert len(sentencias) <= 4
+    assert not any("imagen" in sentencia for sentencia in sentencias)
+
 # Test para intento de exportar CSV por un alumno (debe fallar)
 async def test_exportar_calificaciones_como_alumno(
     async_client: AsyncClient,
@@ -1,5 +1,5 @@
 import pytest
-from fastapi import status
+from fastapi import status, HTTPException
 from models.usuario import Usuario, TipoUsuario
 from models.asignatura import Asignatura
 from models.actividad import Actividad
@@ -15,6 +15,9 @@ import io
 from passlib.context import CryptContext
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
+import asyncio
+import time
+from services.ocr_service import OCRService, OCRServiceFactory
 
 pytestmark = pytest.mark.asyncio
 
@@ -469,3 +472,195 @@ async def test_procesar_ocr(
     ocr_text = response.json() if isinstance(response.json(), str) else response.text
     # No exigimos coincidencia exacta, pero debe contener al menos parte del texto
     assert "Hola" in ocr_text or "OCR" in ocr_text
+
+
+async def test_procesar_ocr_lote(
+    async_client: AsyncClient,
+    token_alumno: str,
+    monkeypatch
+):
+    """Verifica que el OCR por lotes conserve el orden de las páginas aunque terminen desordenadas"""
+    class OCRFalso(OCRService):
+        async def process_image(self, image, current_user):
+            contenido = (await image.read()).decode()
+            # La primera página tarda más que las demás
+            await asyncio.sleep(0.05 if contenido == "pagina 1" else 0)
+            return contenido
+
+    monkeypatch.setattr(OCRServiceFactory, "get_ocr_service", classmethod(lambda cls: OCRFalso()))
+
+    files = [
+        ("images", (f"p{i}.jpg", f"pagina {i}".encode(), "image/jpeg"))
+        for i in range(1, 4)
+    ]
+    response = await async_client.post(
+        "/api/v1/entregas/ocr/process-batch",
+        headers={"Authorization": f"Bearer {token_alumno}"},
+        files=files
+    )
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data["texto"] == "pagina 1\n\npagina 2\n\npagina 3"
+    assert [p["pagina"] for p in data["paginas"]] == [1, 2, 3]
+    assert all(p["tiempo_ms"] >= 0 for p in data["paginas"])
+
+
+
+async def test_procesar_ocr_lote_cancela_las_paginas_pendientes_si_una_falla(
+    async_client: AsyncClient,
+    token_alumno: str,
+    monkeypatch
+):
+    """Verifica que si falla una página se cancelan las demás en lugar de esperar a que terminen"""
+    canceladas = []
+
+    class OCRFalso(OCRService):
+        async def process_image(self, image, current_user):
+            contenido = (await image.read()).decode()
+            if contenido == "pagina 1":
+                raise HTTPException(status_code=500, detail="Error en el servidor OCR")
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                canceladas.append(contenido)
+                raise
+            return contenido
+
+    monkeypatch.setattr(OCRServiceFactory, "get_ocr_service", classmethod(lambda cls: OCRFalso()))
+
+    files = [
+        ("images", (f"p{i}.jpg", f"pagina {i}".encode(), "image/jpeg"))
+        for i in range(1, 4)
+    ]
+    inicio = time.perf_counter()
+    response = await async_client.post(
+        "/api/v1/entregas/ocr/process-batch",
+        headers={"Authorization": f"Bearer {token_alumno}"},
+        files=files
+    )
+    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+    assert time.perf_counter() - inicio < 5
+    assert sorted(canceladas) == ["pagina 2", "pagina 3"]
+
+
+async def test_procesar_ocr_streaming(
+    async_client: AsyncClient,
+    token_alumno: str,
+    monkeypatch
+):
+    """Verifica que el OCR en streaming devuelve el texto como eventos SSE"""
+    class OCRFalso(OCRService):
+        async def process_image(self, image, current_user):
+            return (await image.read()).decode()
+
+    monkeypatch.setattr(OCRServiceFactory, "get_ocr_service", classmethod(lambda cls: OCRFalso()))
+
+    response = await async_client.post(
+        "/api/v1/entregas/ocr/process-stream",
+        headers={"Authorization": f"Bearer {token_alumno}"},
+        files={"image": ("p.jpg", b"print('hola')", "image/jpeg")}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/event-stream")
+    eventos = [linea for linea in response.text.split("\n\n") if linea]
+    assert eventos == ['data: {"text": "print(\'hola\')"}', 'data: {"done": true}']
+
+
+async def test_procesar_ocr_streaming_error_de_conexion(
+    async_client: AsyncClient,
+    token_alumno: str,
+    monkeypatch
+):
+    """Verifica que un fallo de conexión con el servidor OCR se devuelve como evento de error"""
+    import json
+    import requests as http
+
+    class OCRCaido(OCRService):
+        async def process_image(self, image, current_user):
+            raise http.ConnectionError("conexión rechazada")
+
+    monkeypatch.setattr(OCRServiceFactory, "get_ocr_service", classmethod(lambda cls: OCRCaido()))
+
+    response = await async_client.post(
+        "/api/v1/entregas/ocr/process-stream",
+        headers={"Authorization": f"Bearer {token_alumno}"},
+        files={"image": ("p.jpg", b"print('hola')", "image/jpeg")}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    eventos = [json.loads(linea[len("data: "):]) for linea in response.text.split("\n\n") if linea]
+    assert len(eventos) == 1
+    assert "conexión rechazada" in eventos[0]["error"]
+
+# Test para exportar las entregas de una actividad en CSV
+async def test_exportar_entregas_csv(
+    async_client: AsyncClient,
+    db_session: AsyncSession,
+    token_profesor: str,
+    token_alumno: str,
+    entrega_prueba: Entrega,
+    actividad_prueba: Actividad,
+    alumno: Usuario
+):
+    """Test para verificar el CSV de entregas y que se genera sin leer las imágenes"""
+    import csv
+    from sqlalchemy import event
+
+    actividad_id = actividad_prueba.id
+    entrega_prueba.calificacion = 7.5
+    sin_entrega = Usuario(
+        nombre="Sin",
+        apellidos="Entrega",
+        email="sin_entrega@test.com",
+        contrasena=get_password_hash("testpassword"),
+        tipo_usuario=TipoUsuario.ALUMNO
+    )
+    db_session.add(sin_entrega)
+    await db_session.flush()
+    db_session.add(Inscripcion(alumno_id=sin_entrega.id, asignatura_id=actividad_prueba.asignatura_id))
+    # Si el alumno entrega dos veces cuenta la última entrega
+    db_session.add(Entrega(
+        texto_ocr="def suma(a, b): return b + a",
+        actividad_id=actividad_id,
+        alumno_id=alumno.id,
+        fecha_entrega=datetime(2030, 1, 2, 10, 30, tzinfo=UTC),
+        calificacion=9.0,
+        imagen=b"img",
+        tipo_imagen="image/jpeg",
+        nombre_archivo="b.jpg"
+    ))
+    await db_session.commit()
+    fecha = "2030-01-02 10:30:00"
+    datos_alumno = [alumno.nombre, alumno.apellidos, alumno.email]
+
+    sentencias = []
+    def registrar(conn, cursor, statement, *args):
+        sentencias.append(statement)
+    event.listen(db_session.bind.sync_engine, "before_cursor_execute", registrar)
+    try:
+        response = await async_client.get(
+            f"/api/v1/entregas/actividad/{actividad_id}/export-csv",
+            headers={"Authorization": f"Bearer {token_profesor}"}
+        )
+    finally:
+        event.remove(db_session.bind.sync_engine, "before_cursor_execute", registrar)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert "text/csv" in response.headers["content-type"]
+    filas = list(csv.reader(io.StringIO(response.content.decode("utf-8"))))
+    assert filas == [
+        ["Nombre", "Apellidos", "Email", "Calificación", "Estado", "Fecha Entrega"],
+        [*datos_alumno, "9.0", "Entregado", fecha],
+        ["Sin", "Entrega", "sin_entrega@test.com", "No entregado", "No entregado", "-"],
+    ]
+    assert not any("imagen" in sentencia for sentencia in sentencias)
+
+    response = await async_client.get(
+        f"/api/v1/entregas/actividad/{actividad_id}/export-csv",
+        headers={"Authorization": f"Bearer {token_alumno}"}
+    )
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    response = await async_client.get(
+        "/api/v1/entregas/actividad/99999/export-csv",
+        headers={"Authorization": f"Bearer {token_profesor}"}
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
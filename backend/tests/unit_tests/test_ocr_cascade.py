@@ -0,0 +1,74 @@
+import pytest
+import io
+from fastapi import UploadFile
+from models.usuario import Usuario, TipoUsuario
+from services import ocr_service
+from services.ocr_service import OCRService, CascadeOCRService, parsear_tsv_tesseract
+
+CABECERA_TSV = "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext"
+
+
+def fila_palabra(bloque, linea, left, texto, conf):
+    return f"5\t1\t{bloque}\t1\t{linea}\t1\t{left}\t0\t{len(texto) * 10}\t10\t{conf}\t{texto}"
+
+
+class OCRRespaldo(OCRService):
+    async def process_image(self, image, current_user):
+        return "texto del modelo de visión " + (await image.read()).decode()
+
+
+def test_parsear_tsv_conserva_sangria():
+    """Verifica que la sangría se reconstruye a partir de la posición de las palabras"""
+    tsv = "\n".join([
+        CABECERA_TSV,
+        fila_palabra(1, 1, 0, "def", 90),
+        fila_palabra(1, 1, 40, "f():", 90),
+        fila_palabra(1, 2, 40, "return", 70),
+    ])
+    texto, confianza = parsear_tsv_tesseract(tsv)
+    assert texto == "def f():\n    return"
+    assert 70 < confianza < 90
+
+
+@pytest.mark.asyncio
+async def test_cascada_usa_tesseract_con_confianza_alta(monkeypatch):
+    async def tesseract_falso(contenido):
+        return "print('hola')", 95.0
+    monkeypatch.setattr(ocr_service, "ejecutar_tesseract", tesseract_falso)
+    monkeypatch.setattr(CascadeOCRService, "estadisticas", {"tesseract": 0, "fallback": 0})
+
+    servicio = CascadeOCRService(fallback=OCRRespaldo(), threshold=80)
+    imagen = UploadFile(file=io.BytesIO(b"img"), filename="a.jpg")
+    texto = await servicio.process_image(imagen, Usuario(tipo_usuario=TipoUsuario.ALUMNO))
+    assert texto == "print('hola')"
+    assert servicio.estadisticas == {"tesseract": 1, "fallback": 0}
+
+
+@pytest.mark.asyncio
+async def test_cascada_escala_con_confianza_baja(monkeypatch):
+    async def tesseract_falso(contenido):
+        return "pr1nt(h0la", 40.0
+    monkeypatch.setattr(ocr_service, "ejecutar_tesseract", tesseract_falso)
+    monkeypatch.setattr(CascadeOCRService, "estadisticas", {"tesseract": 0, "fallback": 0})
+
+    servicio = CascadeOCRService(fallback=OCRRespaldo(), threshold=80)
+    imagen = UploadFile(file=io.BytesIO(b"img"), filename="a.jpg")
+    texto = await servicio.process_image(imagen, Usuario(tipo_usuario=TipoUsuario.ALUMNO))
+    # El respaldo debe recibir la imagen completa de nuevo
+    assert texto == "texto del modelo de visión img"
+    assert servicio.estadisticas == {"tesseract": 0, "fallback": 1}
+
+
+@pytest.mark.asyncio
+async def test_cascada_comparte_estadisticas_entre_peticiones(monkeypatch):
+    """Verifica que las estadísticas acumulan todas las peticiones aunque cada una cree su servicio"""
+    async def tesseract_falso(contenido):
+        return "print('hola')", 95.0
+    monkeypatch.setattr(ocr_service, "ejecutar_tesseract", tesseract_falso)
+    monkeypatch.setattr(CascadeOCRService, "estadisticas", {"tesseract": 0, "fallback": 0})
+
+    for _ in range(3):
+        servicio = CascadeOCRService(fallback=OCRRespaldo(), threshold=80)
+        imagen = UploadFile(file=io.BytesIO(b"img"), filename="a.jpg")
+        await servicio.process_image(imagen, Usuario(tipo_usuario=TipoUsuario.ALUMNO))
+    assert CascadeOCRService.estadisticas == {"tesseract": 3, "fallback": 0}
@@ -0,0 +1,159 @@
+import pytest
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+from fastapi import UploadFile
+from models.usuario import Usuario, TipoUsuario
+from services.ocr_service import OCRBackendPool, QWEN3BOCRService
+
+pytestmark = pytest.mark.asyncio
+
+
+class ServidorOCRFalso:
+    """Servidor OCR mínimo que responde a /models, /health/ready y /predict/{modelo}"""
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        self.sano = True
+        self.peticiones = 0
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _responder(self, codigo: int, datos: dict):
+                cuerpo = json.dumps(datos).encode()
+                self.send_response(codigo)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_GET(self):
+                # /models responde aunque los modelos no estén listos
+                if self.path == "/models":
+                    self._responder(200, {"modelos": ["qwen3b"]})
+                elif self.path == "/health/ready" and servidor.sano:
+                    self._responder(200, {"ready": True})
+                elif self.path == "/health/ready":
+                    self._responder(503, {"ready": False})
+                else:
+                    self._responder(404, {"detail": "Not Found"})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                servidor.peticiones += 1
+                if "/desconocido" in self.path:
+                    self._responder(404, {"detail": "Not Found"})
+                    return
+                if self.path.endswith("/stream"):
+                    eventos = [{"text": servidor.nombre}, {"text": " fin"}, {"done": True}]
+                    cuerpo = "".join(f"data: {json.dumps(e)}\n\n" for e in eventos).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Content-Length", str(len(cuerpo)))
+                    self.end_headers()
+                    self.wfile.write(cuerpo)
+                    return
+                self._responder(200, {"prediction": servidor.nombre})
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def cerrar(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def servidores():
+    lista = [ServidorOCRFalso(f"servidor{i}") for i in range(3)]
+    yield lista
+    for servidor in lista:
+        servidor.cerrar()
+
+
+async def test_pool_reparte_peticiones(servidores):
+    """Verifica que las peticiones se reparten entre todos los servidores sanos"""
+    pool = OCRBackendPool([s.url for s in servidores])
+    for _ in range(6):
+        response = await pool.post("/predict/qwen3b", files={"image": ("a.jpg", b"x", "image/jpeg")})
+        assert response.status_code == 200
+    assert all(s.peticiones == 2 for s in servidores)
+
+
+async def test_pool_expulsa_y_readmite_servidor(servidores):
+    """Verifica que un servidor que falla las sondas se expulsa y vuelve al recuperarse"""
+    pool = OCRBackendPool([s.url for s in servidores], failure_threshold=2, recovery_threshold=2)
+    servidores[0].sano = False
+
+    await pool.check_all()
+    await pool.check_all()
+    assert [b.healthy for b in pool.backends] == [False, True, True]
+
+    for _ in range(4):
+        await pool.post("/predict/qwen3b", files={"image": ("a.jpg", b"x", "image/jpeg")})
+    assert servidores[0].peticiones == 0
+
+    servidores[0].sano = True
+    await pool.check_all()
+    assert not pool.backends[0].healthy
+    await pool.check_all()
+    assert pool.backends[0].healthy
+
+
+async def test_pool_reintenta_en_otro_servidor(servidores):
+    """Verifica que si un servidor no responde la petición se reintenta en otro"""
+    servidores[0].cerrar()
+    pool = OCRBackendPool([s.url for s in servidores[:2]], failure_threshold=1)
+
+    response = await pool.post("/predict/qwen3b", files={"image": ("a.jpg", b"x", "image/jpeg")})
+    assert response.json()["prediction"] == "servidor1"
+    assert not pool.backends[0].healthy
+
+
+async def test_servicio_remoto_reenvia_streaming(servidores):
+    """Verifica que el servicio OCR remoto reenvía los fragmentos del streaming de la API OCR"""
+    servicio = QWEN3BOCRService(pool=OCRBackendPool([servidores[0].url]))
+    imagen = UploadFile(file=io.BytesIO(b"img"), filename="a.jpg")
+
+    fragmentos = [f async for f in servicio.process_image_stream(imagen, Usuario(tipo_usuario=TipoUsuario.ALUMNO))]
+    assert fragmentos == ["servidor0", " fin"]
+
+
+
+async def test_pool_cuenta_el_streaming_en_curso_hasta_cerrar_la_respuesta(servidores):
+    """Verifica que una petición en streaming sigue en curso hasta que se cierra la respuesta"""
+    pool = OCRBackendPool([servidores[0].url])
+    backend = pool.backends[0]
+
+    response = await pool.post("/predict/qwen3b/stream", files={"image": ("a.jpg", b"x", "image/jpeg")}, stream=True)
+    assert backend.outstanding == 1
+    response.close()
+    response.close()
+    assert backend.outstanding == 0
+
+    with await pool.post("/predict/qwen3b/stream", files={"image": ("a.jpg", b"x", "image/jpeg")}, stream=True):
+        assert backend.outstanding == 1
+    assert backend.outstanding == 0
+
+    await pool.post("/predict/qwen3b", files={"image": ("a.jpg", b"x", "image/jpeg")})
+    assert backend.outstanding == 0
+
+
+async def test_servicio_remoto_devuelve_500_si_la_api_ocr_responde_404(servidores):
+    """Verifica que un 404 de la API OCR (modelo o ruta inexistente) se devuelve como error 500"""
+    from fastapi import HTTPException
+
+    class OCRDesconocido(QWEN3BOCRService):
+        modelo = "desconocido"
+
+    servicio = OCRDesconocido(pool=OCRBackendPool([servidores[0].url]))
+    imagen = UploadFile(file=io.BytesIO(b"img"), filename="a.jpg")
+
+    with pytest.raises(HTTPException) as error:
+        await servicio.process_image(imagen, Usuario(tipo_usuario=TipoUsuario.ALUMNO))
+    assert error.value.status_code == 500
+    assert "Servicio OCR no encontrado" in error.value.detail